@@ -1,7 +1,12 @@
 import os
-from datetime import date, datetime, timedelta
+import threading
 from flask import Flask, jsonify, render_template, session
 from .db import init_db, get_db
+from .migracoes import aplicar_migracoes
+from .configuracoes import configuracoes, obter_perfil_maquina
+from .fechamento_mensal import iniciar_job_fechamento_mensal
+from .snapshots import iniciar_geracao_snapshots
+from .fechamento_inventario import retomar_jobs_pendentes
 from .utils import format_reais, format_datetime_br
 
 
@@ -10,11 +15,8 @@ def iniciar_job_sincronizacao(app):
     Inicia job em background que exporta o banco de dados para Google Drive
     a cada 30 minutos (apenas para LOJA ou CADASTRO).
     """
-    from dotenv import load_dotenv
-    load_dotenv()
-    
-    perfil = os.getenv('PERFIL_MAQUINA', '').strip().upper()
-    caminho_drive = os.getenv('CAMINHO_GOOGLE_DRIVE', '').strip()
+    perfil = obter_perfil_maquina('')
+    caminho_drive = configuracoes.env('CAMINHO_GOOGLE_DRIVE')
     
     # Só ativa job para LOJA ou CADASTRO
     if perfil not in ['LOJA', 'CADASTRO'] or not caminho_drive:
@@ -48,6 +50,20 @@ def iniciar_job_sincronizacao(app):
         app.logger.warning("   Instale com: pip install apscheduler")
 
 
+def iniciar_jobs_agendados(app):
+    """
+    Agenda os jobs (sincronização com o Drive e checkpoints mensais) em uma
+    thread, para que o import do APScheduler não atrase a subida do servidor.
+    """
+    def _iniciar():
+        iniciar_job_sincronizacao(app)
+        iniciar_job_fechamento_mensal(app)
+
+    thread = threading.Thread(target=_iniciar, name='jobs_agendados', daemon=True)
+    thread.start()
+    return thread
+
+
 def create_app(config_object=None):
     app = Flask(__name__, template_folder='templates', static_folder='static')
 
@@ -65,114 +81,18 @@ def create_app(config_object=None):
     # Database
     init_db(app)
 
-    def _garantir_colunas_financeiras():
-        """Garante que estoque_saldos tenha valor_total e custo_medio sem sobrescrever dados existentes."""
-        db = get_db()
-        cols = {row['name'] for row in db.execute('PRAGMA table_info(estoque_saldos)').fetchall()}
-
-        precisa_seed = False
-        if 'valor_total' not in cols:
-            db.execute('ALTER TABLE estoque_saldos ADD COLUMN valor_total REAL NOT NULL DEFAULT 0.0')
-            precisa_seed = True
-        if 'custo_medio' not in cols:
-            db.execute('ALTER TABLE estoque_saldos ADD COLUMN custo_medio REAL NOT NULL DEFAULT 0.0')
-            precisa_seed = True
-
-        if not precisa_seed:
-            row = db.execute(
-                '''SELECT COUNT(*) AS faltantes FROM estoque_saldos
-                   WHERE saldo <> 0 AND valor_total = 0'''
-            ).fetchone()
-            precisa_seed = row and row['faltantes'] > 0
-
-        if precisa_seed:
-            db.execute('''
-                UPDATE estoque_saldos es
-                SET valor_total = CASE
-                    WHEN valor_total = 0 THEN COALESCE((SELECT COALESCE(p.preco_custo, 0) * es.saldo FROM produtos p WHERE p.id = es.produto_id), 0)
-                    ELSE valor_total
-                END
-            ''')
-            db.execute('''
-                UPDATE estoque_saldos
-                SET custo_medio = CASE WHEN saldo <> 0 THEN valor_total / saldo ELSE 0 END
-            ''')
-            db.commit()
-
-    # Snapshot diário do dia anterior (preenche gaps até ontem)
-    def _gerar_snapshot_dia(db, data_ref):
-        sql = '''
-            SELECT es.produto_id, SUM(es.saldo) AS saldo, SUM(es.valor_total) AS valor_total
-            FROM estoque_saldos es
-            JOIN produtos p ON p.id = es.produto_id
-            WHERE p.ativo = 1 AND p.controla_estoque = 1
-            GROUP BY es.produto_id
-        '''
-        rows = db.execute(sql).fetchall()
-        inseridos = 0
-        for r in rows:
-            saldo = float(r['saldo'] or 0)
-            if saldo <= 0:
-                continue
-            valor_total = float(r['valor_total'] or 0)
-            custo = (valor_total / saldo) if saldo > 0 else 0.0
-            db.execute(
-                '''
-                INSERT OR IGNORE INTO saldos_historico 
-                (data_ref, produto_id, quantidade, preco_custo_unitario, valor_total)
-                VALUES (?, ?, ?, ?, ?)
-                ''',
-                (data_ref.isoformat(), r['produto_id'], saldo, custo, valor_total)
-            )
-            inseridos += 1
-
-        db.execute(
-            '''
-            INSERT INTO logs_auditoria (acao, descricao, data_hora)
-            VALUES (?, ?, ?)
-            ''',
-            (
-                'SNAPSHOT_SALDO',
-                f"Snapshot gerado para {data_ref.isoformat()}: {inseridos} produto(s)",
-                datetime.now().isoformat()
-            )
-        )
-
-    def _gerar_snapshots_pendentes():
-        ontem = date.today() - timedelta(days=1)
-        if ontem < date(1970, 1, 1):  # guard-rail
-            return
-
-        db = get_db()
-        row = db.execute('SELECT MAX(data_ref) AS max_ref FROM saldos_historico').fetchone()
-        max_ref = row['max_ref'] if row else None
-
-        if max_ref:
-            try:
-                inicio = date.fromisoformat(max_ref) + timedelta(days=1)
-            except ValueError:
-                inicio = ontem
-        else:
-            inicio = ontem
-
-        if inicio > ontem:
-            return
-
-        dia = inicio
-        while dia <= ontem:
-            _gerar_snapshot_dia(db, dia)
-            dia += timedelta(days=1)
-
-        db.commit()
-
     with app.app_context():
         try:
-            _garantir_colunas_financeiras()
-            _gerar_snapshots_pendentes()
+            aplicar_migracoes(get_db(), app.logger)
         except Exception:
             # Não bloquear startup; logar no stderr
             import traceback
             traceback.print_exc()
+        else:
+            # Snapshots diários e checkpoints mensais pendentes: em background
+            iniciar_geracao_snapshots(app)
+            # Fechamentos de inventário interrompidos por queda ou reinício
+            retomar_jobs_pendentes(app)
 
     # Filters
     app.add_template_filter(format_reais, name='reais')
@@ -186,9 +106,7 @@ def create_app(config_object=None):
     # Context processor para injetar variáveis de perfil em todos os templates
     @app.context_processor
     def inject_perfil():
-        from dotenv import load_dotenv
-        load_dotenv()
-        perfil = os.getenv('PERFIL_MAQUINA', 'LOJA').strip().upper()
+        perfil = obter_perfil_maquina()
         return {
             'PERFIL_SISTEMA': perfil,
             'MODO_LEITURA': perfil == 'GERENTE',
@@ -210,8 +128,8 @@ def create_app(config_object=None):
     app.register_blueprint(api_bp)
     app.register_blueprint(lotes_bp)
 
-    # Inicializar job de sincronização para LOJA/CADASTRO
-    iniciar_job_sincronizacao(app)
+    # Sincronização para LOJA/CADASTRO e checkpoints mensais de saldo (dia 1 de cada mês)
+    iniciar_jobs_agendados(app)
 
     # Error handlers
     @app.errorhandler(404)
@@ -1,113 +1,85 @@
 import csv
 import io
-import math
 import os
 import traceback
 import uuid
-import pandas as pd
 from datetime import date, datetime
 import sqlite3
 from flask import Blueprint, render_template, redirect, url_for, request, session, flash, jsonify, send_file, current_app
 from werkzeug.utils import secure_filename
-from ..db import get_db
-from ..utils import get_local_ip, registrar_movimento
-from dotenv import load_dotenv
+from ..db import get_db, iniciar_transacao_imediata
+from ..utils import get_local_ip, registrar_movimentos, obter_nivel_controle, obter_requer_aprovacao, filtro_periodo
+from ..configuracoes import configuracoes, obter_perfil_maquina
+from ..fechamento_mensal import saldo_em
+from ..busca_produtos import sql_busca
+from ..paginacao import preparar_pagina, montar_pagina, agregar_com_cache
+from ..eventos import contar_pendencias
+from ..fechamento_inventario import (
+    obter_plano, itens_plano, resumo_plano, job_ativo, criar_job, iniciar_execucao, retomar_job, progresso_job
+)
 
 bp = Blueprint('admin', __name__, url_prefix='/admin')
 
+# Movimentações por página no Kardex do produto
+KARDEX_POR_PAGINA = 100
 
-# Helpers
+# Ícone e cor de cada tipo de ajuste no preview do fechamento
+ICONES_AJUSTE = {
+    'OK': ('✅', 'emerald'),
+    'ENTRADA': ('📈', 'blue'),
+    'SAIDA': ('📉', 'red'),
+}
 
-def ensure_finance_schema(db):
-    cols = [row['name'] for row in db.execute('PRAGMA table_info(lotes_movimentacao)').fetchall()]
-    if 'exportado_financeiro' not in cols:
-        db.execute("ALTER TABLE lotes_movimentacao ADD COLUMN exportado_financeiro INTEGER NOT NULL DEFAULT 0")
-
-    db.execute('''
-        CREATE TABLE IF NOT EXISTS fornecedores (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nome TEXT NOT NULL,
-            cnpj TEXT,
-            ie TEXT,
-            contato TEXT,
-            ativo INTEGER NOT NULL DEFAULT 1,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            updated_at TEXT
-        )
-    ''')
-
-    db.execute('''
-        CREATE TABLE IF NOT EXISTS planos_contas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            codigo TEXT,
-            descricao TEXT NOT NULL,
-            tipo TEXT,
-            ativo INTEGER NOT NULL DEFAULT 1,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            updated_at TEXT
-        )
-    ''')
-
-    db.execute('''
-        CREATE TABLE IF NOT EXISTS compras_lote (
-            id_lote INTEGER PRIMARY KEY,
-            id_fornecedor INTEGER NOT NULL,
-            id_plano_contas INTEGER NOT NULL,
-            num_doc TEXT,
-            observacao TEXT,
-            valor_total REAL NOT NULL,
-            data_emissao TEXT,
-            data_vencimento TEXT,
-            data_pagamento TEXT,
-            valor_pago REAL,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            updated_at TEXT,
-            FOREIGN KEY (id_lote) REFERENCES lotes_movimentacao(id),
-            FOREIGN KEY (id_fornecedor) REFERENCES fornecedores(id),
-            FOREIGN KEY (id_plano_contas) REFERENCES planos_contas(id)
-        )
-    ''')
-
-    db.execute('''
-        CREATE TABLE IF NOT EXISTS compras_parcelas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            id_lote INTEGER NOT NULL,
-            parcela_num INTEGER NOT NULL,
-            valor REAL NOT NULL,
-            data_vencimento TEXT NOT NULL,
-            data_pagamento TEXT,
-            valor_pago REAL,
-            FOREIGN KEY (id_lote) REFERENCES lotes_movimentacao(id)
-        )
-    ''')
-    db.execute('CREATE INDEX IF NOT EXISTS idx_compras_parcelas_lote ON compras_parcelas(id_lote)')
-
-
-def ensure_materias_primas_schema(db):
-    cols = [row['name'] for row in db.execute('PRAGMA table_info(produtos)').fetchall()]
-    if 'materia_prima_id' not in cols:
-        db.execute("ALTER TABLE produtos ADD COLUMN materia_prima_id INTEGER")
-        db.execute("CREATE INDEX IF NOT EXISTS idx_produtos_materia_prima ON produtos(materia_prima_id)")
-
-    db.execute('''
-        CREATE TABLE IF NOT EXISTS materias_primas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nome TEXT NOT NULL,
-            codigo_interno TEXT,
-            descricao TEXT,
-            ativo INTEGER NOT NULL DEFAULT 1,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            updated_at TEXT
-        )
-    ''')
 
-    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_materias_primas_nome ON materias_primas(nome)")
-    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_materias_primas_codigo ON materias_primas(codigo_interno) WHERE codigo_interno IS NOT NULL")
+# Helpers
 
 def gerente_required():
     return session.get('is_gerente')
 
 
+def relatorio_contado(db, inv_id):
+    """
+    Totais contados por produto no inventário, lidos de contagens_totais_produto
+    (mantida por triggers): detalhamento por unidade usada, total na unidade
+    padrão e valor, com fator e preço atuais.
+    """
+    sql = '''
+        SELECT t.id_produto, t.quantidade, p.nome, p.preco_custo,
+               u.sigla, u_pad.sigla as padrao_sigla,
+               COALESCE(pu.fator_conversao, 1.0) as fator
+        FROM contagens_totais_produto t
+        JOIN produtos p ON t.id_produto = p.id
+        JOIN unidades_medida u ON t.id_unidade = u.id
+        JOIN unidades_medida u_pad ON p.id_unidade_padrao = u_pad.id
+        LEFT JOIN produtos_unidades pu ON t.id_produto = pu.id_produto AND t.id_unidade = pu.id_unidade
+        WHERE t.id_inventario = ?
+        ORDER BY p.nome, t.id_produto, u.sigla
+    '''
+    relatorio = []
+    for r in db.execute(sql, (inv_id,)).fetchall():
+        if not relatorio or relatorio[-1]['produto_id'] != r['id_produto']:
+            relatorio.append({
+                'produto_id': r['id_produto'],
+                'produto_nome': r['nome'],
+                'partes': [],
+                'total_padrao': 0.0,
+                'unidade_padrao_sigla': r['padrao_sigla'],
+                'valor_total': 0.0
+            })
+        item = relatorio[-1]
+        qty = r['quantidade']
+        qtd_convertida = qty * float(r['fator'])
+        item['partes'].append(f"{int(qty) if qty == int(qty) else round(qty, 2)} {r['sigla']}")
+        item['total_padrao'] += qtd_convertida
+        item['valor_total'] += qtd_convertida * (r['preco_custo'] or 0.0)
+
+    for item in relatorio:
+        item['detalhamento'] = ", ".join(item.pop('partes'))
+        item['total_padrao'] = round(item['total_padrao'], 2)
+        item['valor_total'] = round(item['valor_total'], 2)
+    return relatorio
+
+
 @bp.route('/dashboard')
 def dashboard():
     if not gerente_required():
@@ -146,11 +118,11 @@ def dashboard():
         kpis['percentual'] = round((concluidos/total_loc*100), 1) if total_loc > 0 else 0
 
         sql_financeiro = '''
-            SELECT SUM(c.quantidade * COALESCE(pu.fator_conversao, 1.0) * COALESCE(p.preco_custo, 0)) as total_reais
-            FROM contagens c
-            JOIN produtos p ON c.id_produto = p.id
-            LEFT JOIN produtos_unidades pu ON p.id = pu.id_produto AND c.id_unidade_usada = pu.id_unidade
-            WHERE c.id_inventario = ?
+            SELECT SUM(t.quantidade * COALESCE(pu.fator_conversao, 1.0) * COALESCE(p.preco_custo, 0)) as total_reais
+            FROM contagens_totais_produto t
+            JOIN produtos p ON t.id_produto = p.id
+            LEFT JOIN produtos_unidades pu ON p.id = pu.id_produto AND t.id_unidade = pu.id_unidade
+            WHERE t.id_inventario = ?
         '''
         resultado_fin = db.execute(sql_financeiro, (inv_id,)).fetchone()
         valor_calculado = resultado_fin['total_reais'] if resultado_fin and resultado_fin['total_reais'] else 0.0
@@ -175,77 +147,9 @@ def dashboard():
         logs = [dict(r) for r in db.execute('SELECT * FROM logs_auditoria ORDER BY id DESC LIMIT 10').fetchall()]
 
         # Pendências filtra por categoria se inventário for PARCIAL
-        if inventario_aberto['tipo_inventario'] == 'PARCIAL' and inventario_aberto['id_categoria_escopo']:
-            sql_nao = '''
-                SELECT COUNT(*) as total 
-                FROM produtos p 
-                JOIN produto_categoria_inventario pc ON p.id = pc.id_produto
-                LEFT JOIN contagens c ON p.id = c.id_produto AND c.id_inventario = ? 
-                WHERE c.id IS NULL 
-                AND p.ativo = 1
-                AND pc.id_categoria = ?
-            '''
-            total_pendencias = db.execute(sql_nao, (inv_id, inventario_aberto['id_categoria_escopo'])).fetchone()['total']
-        else:
-            sql_nao = '''
-                SELECT COUNT(*) as total FROM produtos p 
-                LEFT JOIN contagens c ON p.id = c.id_produto AND c.id_inventario = ? 
-                WHERE c.id IS NULL AND p.ativo = 1
-            '''
-            total_pendencias = db.execute(sql_nao, (inv_id,)).fetchone()['total']
-        
-        nao_contados = total_pendencias
-
-        sql_rel = '''
-            SELECT c.quantidade, u.sigla, p.id as prod_id, p.nome,
-                   p.id_unidade_padrao, u_pad.sigla as padrao_sigla,
-                   COALESCE(pu.fator_conversao, 1.0) as fator,
-                   p.preco_custo
-            FROM contagens c
-            JOIN produtos p ON c.id_produto = p.id
-            JOIN unidades_medida u ON c.id_unidade_usada = u.id
-            JOIN unidades_medida u_pad ON p.id_unidade_padrao = u_pad.id
-            LEFT JOIN produtos_unidades pu ON p.id = pu.id_produto AND c.id_unidade_usada = pu.id_unidade
-            WHERE c.id_inventario = ?
-        '''
-        rows = db.execute(sql_rel, (inv_id,)).fetchall()
-
-        temp_rel = {}
-        for r in rows:
-            pid = r['prod_id']
-            sigla = r['sigla']
-            qtd = r['quantidade']
-
-            if pid not in temp_rel:
-                temp_rel[pid] = {
-                    'produto_id': pid,
-                    'nome': r['nome'],
-                    'padrao': r['padrao_sigla'],
-                    'soma_por_unidade': {},
-                    'total_consolidado': 0.0,
-                    'preco_custo': r['preco_custo'] or 0
-                }
-
-            if sigla not in temp_rel[pid]['soma_por_unidade']:
-                temp_rel[pid]['soma_por_unidade'][sigla] = 0
-            temp_rel[pid]['soma_por_unidade'][sigla] += qtd
-            temp_rel[pid]['total_consolidado'] += (qtd * r['fator'])
-
-        for pid, dados in temp_rel.items():
-            partes = []
-            for sigla, total_unid in dados['soma_por_unidade'].items():
-                qtd_fmt = int(total_unid) if total_unid.is_integer() else total_unid
-                partes.append(f"{qtd_fmt} {sigla}")
-
-            resumo_detalhes = ", ".join(partes)
-            relatorio.append({
-                'produto_id': dados['produto_id'],
-                'produto_nome': dados['nome'],
-                'detalhamento': resumo_detalhes,
-                'total_final': round(dados['total_consolidado'], 2),
-                'unidade_padrao': dados['padrao'],
-                'valor_total': round(dados['total_consolidado'] * dados['preco_custo'], 2)
-            })
+        nao_contados = contar_pendencias(db, inv_id)
+
+        relatorio = relatorio_contado(db, inv_id)
 
     ocorrencias_pendentes = 0
     if inventario_aberto:
@@ -258,14 +162,17 @@ def dashboard():
 
     # Contar lotes pendentes de aprovação
     lotes_pendentes_count = 0
-    result_lotes = db.execute(
-        "SELECT COUNT(*) as count FROM lotes_movimentacao WHERE status = 'PENDENTE_APROVACAO'"
-    ).fetchone()
+    result_lotes = db.execute('SELECT COUNT(*) as count FROM v_lotes_fila').fetchone()
     lotes_pendentes_count = result_lotes['count'] if result_lotes else 0
 
+    # Fechamento em andamento (job em background): progresso no lugar dos botões da sessão
+    job = job_ativo(db)
+    fechamento = progresso_job(job) if job else None
+
     return render_template(
         'admin/dashboard.html',
         inventario_aberto=inventario_aberto,
+        fechamento=fechamento,
         kpis=kpis,
         relatorio=relatorio,
         progresso_setores=progresso,
@@ -287,9 +194,8 @@ def sincronizar_manual():
     if not gerente_required():
         return jsonify({'erro': 'Acesso negado'}), 403
     
-    load_dotenv()
-    perfil = os.getenv('PERFIL_MAQUINA', '').strip().upper()
-    caminho_drive = os.getenv('CAMINHO_GOOGLE_DRIVE', '').strip()
+    perfil = obter_perfil_maquina('')
+    caminho_drive = configuracoes.env('CAMINHO_GOOGLE_DRIVE')
     
     # Apenas GERENTE pode fazer sincronização manual
     if perfil != 'GERENTE':
@@ -300,7 +206,13 @@ def sincronizar_manual():
     
     try:
         from app.sync_drive import sincronizar_do_nuvem_forcado
+        from ..db import close_db, fechar_conexoes
+        # O arquivo .db será substituído: libera a conexão desta requisição e o pool
+        close_db()
+        fechar_conexoes(current_app)
         sucesso = sincronizar_do_nuvem_forcado(caminho_drive)
+        # A tabela configs veio do banco baixado
+        configuracoes.invalidar()
         
         if sucesso:
             return jsonify({'mensagem': 'Dados sincronizados com sucesso!'}), 200
@@ -310,11 +222,26 @@ def sincronizar_manual():
         return jsonify({'erro': f'Erro ao sincronizar: {str(e)}'}), 500
 
 
+@bp.route('/configuracoes/recarregar', methods=['POST'])
+def recarregar_configuracoes():
+    """Relê o .env e a tabela configs (após edição manual de qualquer um dos dois)."""
+    if not gerente_required():
+        return jsonify({'erro': 'Acesso negado'}), 403
+
+    configuracoes.recarregar()
+    db = get_db()
+    return jsonify({
+        'mensagem': 'Configurações recarregadas.',
+        'perfil': obter_perfil_maquina(),
+        'nivel_controle': obter_nivel_controle(db),
+        'requer_aprovacao': obter_requer_aprovacao(db)
+    })
+
+
 @bp.route('/gerar_qrcode')
 def gerar_qrcode():
     
-    load_dotenv()
-    perfil = os.getenv('PERFIL_MAQUINA', 'LOJA').strip().upper()
+    perfil = obter_perfil_maquina()
     
     ip = get_local_ip()
     # LOJA: QR Code aponta para contagem (seleção de usuário)
@@ -338,9 +265,7 @@ def gerar_qrcode():
 @bp.route('/get_url_servidor')
 def get_url_servidor():
     """Retorna a URL do servidor para ser exibida no modal QR Code."""
-    from dotenv import load_dotenv
-    load_dotenv()
-    perfil = os.getenv('PERFIL_MAQUINA', 'LOJA').strip().upper()
+    perfil = obter_perfil_maquina()
     
     ip = get_local_ip()
     # LOJA: URL para contagem | GERENTE/CADASTRO: URL para admin
@@ -377,58 +302,9 @@ def monitoramento():
             row['percentual'] = round((row['concluidos']/row['total']*100), 1) if row['total'] > 0 else 0
             progresso_setores.append(row)
 
-        sql_rel = '''
-            SELECT c.id, c.quantidade, p.id as prod_id, p.nome as prod_nome, p.preco_custo,
-                   u.sigla as unit_sigla, u_pad.sigla as padrao_sigla,
-                   COALESCE(pu.fator_conversao, 1.0) as fator
-            FROM contagens c
-            JOIN produtos p ON c.id_produto = p.id
-            JOIN unidades_medida u ON c.id_unidade_usada = u.id
-            JOIN unidades_medida u_pad ON p.id_unidade_padrao = u_pad.id
-            LEFT JOIN produtos_unidades pu ON p.id = pu.id_produto AND c.id_unidade_usada = pu.id_unidade
-            WHERE c.id_inventario = ?
-        '''
-        rows = db.execute(sql_rel, (inv_id,)).fetchall()
-
-        from collections import defaultdict
-        temp_rel = {}
-        for r in rows:
-            pid = r['prod_id']
-            if pid not in temp_rel:
-                temp_rel[pid] = {
-                    'nome': r['prod_nome'],
-                    'padrao_sigla': r['padrao_sigla'],
-                    'preco_custo': r['preco_custo'] or 0.0,
-                    'soma_por_unidade': defaultdict(float),
-                    'total_std': 0.0,
-                    'total_valor': 0.0
-                }
-            fator = float(r['fator']) if r['fator'] else 1.0
-            qtd_convertida = r['quantidade'] * fator
-            temp_rel[pid]['soma_por_unidade'][r['unit_sigla']] += r['quantidade']
-            temp_rel[pid]['total_std'] += qtd_convertida
-            temp_rel[pid]['total_valor'] += qtd_convertida * temp_rel[pid]['preco_custo']
-
-        for pid, dados in temp_rel.items():
-            detalhes_str = ", ".join([
-                f"{int(qty) if qty == int(qty) else round(qty, 2)} {unidade}"
-                for unidade, qty in sorted(dados['soma_por_unidade'].items())
-            ])
-            relatorio.append({
-                'produto_id': pid,
-                'produto_nome': dados['nome'],
-                'detalhamento': detalhes_str,
-                'total_padrao': round(dados['total_std'], 2),
-                'unidade_padrao_sigla': dados['padrao_sigla'],
-                'valor_total': round(dados['total_valor'], 2)
-            })
+        relatorio = relatorio_contado(db, inv_id)
 
-        sql_count_pendencias = '''
-            SELECT COUNT(*) as total FROM produtos p
-            LEFT JOIN contagens c ON p.id = c.id_produto AND c.id_inventario = ?
-            WHERE c.id IS NULL AND p.ativo = 1
-        '''
-        total_pendencias = db.execute(sql_count_pendencias, (inv_id,)).fetchone()['total']
+        total_pendencias = contar_pendencias(db, inv_id)
     else:
         total_pendencias = 0
 
@@ -455,59 +331,46 @@ def monitoramento_pendencias():
     inv_id = inv['id']
     inv_dict = dict(inv)
     
-    pagina = request.args.get('page', 1, type=int)
     itens_por_pagina = 50
-    offset = (pagina - 1) * itens_por_pagina
+    pagina = preparar_pagina(request.args, ['p.nome', 'p.id'])
 
-    # Filtrar por categoria se inventário for PARCIAL
+    # Produtos ativos ainda sem contagem; filtrar por categoria se inventário for PARCIAL
+    where_sql = '''
+        WHERE NOT EXISTS (
+            SELECT 1 FROM contagens_totais_produto t
+            WHERE t.id_inventario = ? AND t.id_produto = p.id
+        )
+        AND p.ativo = 1
+    '''
+    join_categoria = ''
+    params = [inv_id]
     if inv_dict['tipo_inventario'] == 'PARCIAL' and inv_dict['id_categoria_escopo']:
-        sql_pendencias = '''
-            SELECT p.id, p.nome, p.categoria, p.preco_custo
-            FROM produtos p
-            JOIN produto_categoria_inventario pc ON p.id = pc.id_produto
-            LEFT JOIN contagens c ON p.id = c.id_produto AND c.id_inventario = ?
-            WHERE c.id IS NULL 
-            AND p.ativo = 1
-            AND pc.id_categoria = ?
-            ORDER BY p.nome
-            LIMIT ? OFFSET ?
-        '''
-        pendencias = [dict(r) for r in db.execute(sql_pendencias, (inv_id, inv_dict['id_categoria_escopo'], itens_por_pagina, offset)).fetchall()]
-
-        sql_count = '''
-            SELECT COUNT(*) as total FROM produtos p
-            JOIN produto_categoria_inventario pc ON p.id = pc.id_produto
-            LEFT JOIN contagens c ON p.id = c.id_produto AND c.id_inventario = ?
-            WHERE c.id IS NULL 
-            AND p.ativo = 1
-            AND pc.id_categoria = ?
-        '''
-        total = db.execute(sql_count, (inv_id, inv_dict['id_categoria_escopo'])).fetchone()['total']
-    else:
-        sql_pendencias = '''
-            SELECT p.id, p.nome, p.categoria, p.preco_custo
-            FROM produtos p
-            LEFT JOIN contagens c ON p.id = c.id_produto AND c.id_inventario = ?
-            WHERE c.id IS NULL AND p.ativo = 1
-            ORDER BY p.nome
-            LIMIT ? OFFSET ?
-        '''
-        pendencias = [dict(r) for r in db.execute(sql_pendencias, (inv_id, itens_por_pagina, offset)).fetchall()]
+        join_categoria = 'JOIN produto_categoria_inventario pc ON p.id = pc.id_produto'
+        where_sql += ' AND pc.id_categoria = ?'
+        params.append(inv_dict['id_categoria_escopo'])
+    where_pagina = f"{where_sql} AND {pagina['where']}" if pagina['where'] else where_sql
 
-        sql_count = '''
-            SELECT COUNT(*) as total FROM produtos p
-            LEFT JOIN contagens c ON p.id = c.id_produto AND c.id_inventario = ?
-            WHERE c.id IS NULL AND p.ativo = 1
-        '''
-        total = db.execute(sql_count, (inv_id,)).fetchone()['total']
-    
-    total_paginas = (total + itens_por_pagina - 1) // itens_por_pagina
+    sql_pendencias = f'''
+        SELECT p.id, p.nome, p.categoria, p.preco_custo
+        FROM produtos p
+        {join_categoria}
+        {where_pagina}
+        ORDER BY {pagina['order_by']}
+        LIMIT ?
+    '''
+    linhas = [dict(r) for r in db.execute(sql_pendencias, params + pagina['params'] + [itens_por_pagina + 1]).fetchall()]
+    paginacao = montar_pagina(pagina, linhas, itens_por_pagina, lambda p: [p['nome'], p['id']])
+
+    # Muda com as contagens (versao_dados) e com o catálogo
+    sql_count = f'SELECT COUNT(*) as total FROM produtos p {join_categoria} {where_sql}'
+    total = agregar_com_cache(db, sql_count, params, '''
+        SELECT (SELECT versao FROM versao_dados WHERE id = 1), (SELECT versao FROM catalogo_versao WHERE id = 1)
+    ''')['total']
 
     return render_template(
         'admin/monitoramento_pendencias.html',
-        pendencias=pendencias,
-        pagina_atual=pagina,
-        total_paginas=total_paginas,
+        pendencias=paginacao['itens'],
+        paginacao=paginacao,
         total_pendencias=total,
         is_gerente=True
     )
@@ -530,9 +393,9 @@ def monitoramento_setor(setor_id):
     inv_id = inv['id']
 
     sql_locais = '''
-        SELECT l.*, COALESCE(COUNT(c.id), 0) as qtd_contagens
+        SELECT l.*, COALESCE(SUM(t.qtd_contagens), 0) as qtd_contagens
         FROM locais l
-        LEFT JOIN contagens c ON l.id = c.id_local AND c.id_inventario = ?
+        LEFT JOIN contagens_totais_local t ON l.id = t.id_local AND t.id_inventario = ?
         WHERE l.id_setor = ?
         GROUP BY l.id ORDER BY l.nome
     '''
@@ -550,12 +413,12 @@ def monitoramento_setor(setor_id):
             loc['status_color'] = 'green'
 
     sql_itens = '''
-        SELECT p.nome as prod_nome, u.sigla, SUM(c.quantidade) as total_qtd
-        FROM contagens c
-        JOIN produtos p ON c.id_produto = p.id
-        JOIN unidades_medida u ON c.id_unidade_usada = u.id
-        JOIN locais l ON c.id_local = l.id
-        WHERE l.id_setor = ? AND c.id_inventario = ?
+        SELECT p.nome as prod_nome, u.sigla, SUM(t.quantidade) as total_qtd
+        FROM contagens_totais_local t
+        JOIN produtos p ON t.id_produto = p.id
+        JOIN unidades_medida u ON t.id_unidade = u.id
+        JOIN locais l ON t.id_local = l.id
+        WHERE l.id_setor = ? AND t.id_inventario = ?
         GROUP BY p.id, u.id ORDER BY p.nome
     '''
     itens = [dict(r) for r in db.execute(sql_itens, (setor_id, inv_id)).fetchall()]
@@ -586,13 +449,13 @@ def detalhe_produto_inventario(produto_id):
 
     sql_resumo = '''
         SELECT 
-            COALESCE(SUM(c.quantidade * COALESCE(pu.fator_conversao, 1.0)), 0.0) as total_padrao,
-            COALESCE(SUM(c.quantidade * COALESCE(pu.fator_conversao, 1.0) * ?), 0.0) as valor_total
-        FROM contagens c
-        LEFT JOIN produtos_unidades pu ON c.id_produto = pu.id_produto AND c.id_unidade_usada = pu.id_unidade
-        WHERE c.id_produto = ? AND c.id_inventario = ?
+            COALESCE(SUM(t.quantidade * COALESCE(pu.fator_conversao, 1.0)), 0.0) as total_padrao,
+            COALESCE(SUM(t.quantidade * COALESCE(pu.fator_conversao, 1.0) * ?), 0.0) as valor_total
+        FROM contagens_totais_produto t
+        LEFT JOIN produtos_unidades pu ON t.id_produto = pu.id_produto AND t.id_unidade = pu.id_unidade
+        WHERE t.id_inventario = ? AND t.id_produto = ?
     '''
-    resumo = db.execute(sql_resumo, (float(produto['preco_custo'] or 0.0), produto_id, inv_id)).fetchone()
+    resumo = db.execute(sql_resumo, (float(produto['preco_custo'] or 0.0), inv_id, produto_id)).fetchone()
 
     sql_detalhes = '''
         SELECT 
@@ -688,6 +551,10 @@ def preview_fechamento():
     inv_id = inv['id']
     inv_dict = dict(inv)
     
+    if job_ativo(db, inv_id):
+        flash('⏳ O fechamento deste inventário já está em andamento.', 'info')
+        return redirect(url_for('admin.dashboard'))
+    
     # Verificar ocorrências pendentes
     ocorrencias_pendentes = db.execute(
         "SELECT COUNT(*) as count FROM ocorrencias WHERE id_inventario = ? AND resolvido = 0",
@@ -698,136 +565,22 @@ def preview_fechamento():
         flash(f"❌ Existem {ocorrencias_pendentes['count']} ocorrências pendentes! Resolva todas antes de fechar.", 'error')
         return redirect(url_for('admin.admin_ocorrencias'))
     
-    # Determinar escopo dos produtos (COMPLETO ou PARCIAL)
+    # Plano de fechamento: reaproveitado enquanto contagens, saldos e catálogo não mudarem
+    versao = obter_plano(db, inv_dict)
+    comparacao = itens_plano(db, inv_id)
+    for item in comparacao:
+        item['icone_ajuste'], item['cor_ajuste'] = ICONES_AJUSTE[item['tipo_ajuste']]
+        item['foi_contado'] = item['total_contagens'] > 0
+    
+    stats = resumo_plano(db, inv_id)
+    
+    nome_categoria = None
     if inv_dict['tipo_inventario'] == 'PARCIAL' and inv_dict['id_categoria_escopo']:
-        # Inventário PARCIAL: apenas produtos da categoria
-        sql_produtos = '''
-            SELECT 
-                p.id as produto_id,
-                p.nome as produto_nome,
-                p.id_erp,
-                p.gtin,
-                COALESCE((SELECT SUM(saldo) FROM estoque_saldos WHERE produto_id = p.id), 0) as estoque_atual,
-                COALESCE((SELECT SUM(valor_total) FROM estoque_saldos WHERE produto_id = p.id), 0) as valor_total_estoque,
-                p.preco_custo,
-                COALESCE(SUM(c.quantidade_padrao), 0) as quantidade_contada,
-                u.sigla as unidade_padrao,
-                COUNT(c.id) as total_contagens
-            FROM produtos p
-            JOIN produto_categoria_inventario pc ON p.id = pc.id_produto
-            LEFT JOIN contagens c ON p.id = c.id_produto AND c.id_inventario = ?
-            LEFT JOIN unidades_medida u ON p.id_unidade_padrao = u.id
-            WHERE p.ativo = 1 
-            AND p.controla_estoque = 1
-            AND pc.id_categoria = ?
-            GROUP BY p.id
-            ORDER BY p.nome
-        '''
-        produtos = db.execute(sql_produtos, (inv_id, inv_dict['id_categoria_escopo'])).fetchall()
-        
-        # Buscar nome da categoria
         categoria = db.execute(
             "SELECT nome FROM categorias_inventario WHERE id = ?",
             (inv_dict['id_categoria_escopo'],)
         ).fetchone()
         nome_categoria = categoria['nome'] if categoria else 'Categoria'
-    else:
-        # Inventário COMPLETO: todos os produtos ativos
-        sql_produtos = '''
-            SELECT 
-                p.id as produto_id,
-                p.nome as produto_nome,
-                p.id_erp,
-                p.gtin,
-                COALESCE((SELECT SUM(saldo) FROM estoque_saldos WHERE produto_id = p.id), 0) as estoque_atual,
-                COALESCE((SELECT SUM(valor_total) FROM estoque_saldos WHERE produto_id = p.id), 0) as valor_total_estoque,
-                p.preco_custo,
-                COALESCE(SUM(c.quantidade_padrao), 0) as quantidade_contada,
-                u.sigla as unidade_padrao,
-                COUNT(c.id) as total_contagens
-            FROM produtos p
-            LEFT JOIN contagens c ON p.id = c.id_produto AND c.id_inventario = ?
-            LEFT JOIN unidades_medida u ON p.id_unidade_padrao = u.id
-            WHERE p.ativo = 1 AND p.controla_estoque = 1
-            GROUP BY p.id
-            ORDER BY p.nome
-        '''
-        produtos = db.execute(sql_produtos, (inv_id,)).fetchall()
-        nome_categoria = None
-    
-    # Processar divergências e calcular totalizadores
-    comparacao = []
-    total_produtos = 0
-    total_divergencias = 0
-    total_entradas = 0
-    total_saidas = 0
-    total_ok = 0
-    total_nao_contados = 0
-    valor_total_ajustes = 0.0
-    
-    for produto in produtos:
-        estoque_sistema = float(produto['estoque_atual'] or 0)
-        quantidade_contada = float(produto['quantidade_contada'] or 0)
-        diferenca = quantidade_contada - estoque_sistema
-        valor_total_estoque = float(produto['valor_total_estoque'] or 0)
-        custo_medio_atual = (valor_total_estoque / estoque_sistema) if estoque_sistema > 0 else float(produto['preco_custo'] or 0)
-        valor_ajuste = abs(diferenca) * custo_medio_atual
-        foi_contado = produto['total_contagens'] > 0
-        
-        # Determinar tipo de ajuste
-        if abs(diferenca) < 0.001:
-            tipo_ajuste = 'OK'
-            icone_ajuste = '✅'
-            cor_ajuste = 'emerald'
-            total_ok += 1
-        elif diferenca > 0:
-            tipo_ajuste = 'ENTRADA'
-            icone_ajuste = '📈'
-            cor_ajuste = 'blue'
-            total_entradas += 1
-            total_divergencias += 1
-            valor_total_ajustes += valor_ajuste
-        else:
-            tipo_ajuste = 'SAIDA'
-            icone_ajuste = '📉'
-            cor_ajuste = 'red'
-            total_saidas += 1
-            total_divergencias += 1
-            valor_total_ajustes += valor_ajuste
-        
-        if not foi_contado:
-            total_nao_contados += 1
-        
-        comparacao.append({
-            'produto_id': produto['produto_id'],
-            'produto_nome': produto['produto_nome'],
-            'id_erp': produto['id_erp'],
-            'gtin': produto['gtin'],
-            'estoque_sistema': estoque_sistema,
-            'quantidade_contada': quantidade_contada,
-            'diferenca': diferenca,
-            'tipo_ajuste': tipo_ajuste,
-            'icone_ajuste': icone_ajuste,
-            'cor_ajuste': cor_ajuste,
-            'preco_custo': float(produto['preco_custo'] or 0),
-            'custo_medio_atual': custo_medio_atual,
-            'valor_ajuste': valor_ajuste,
-            'unidade_padrao': produto['unidade_padrao'],
-            'foi_contado': foi_contado
-        })
-        
-        total_produtos += 1
-    
-    # Estatísticas
-    stats = {
-        'total_produtos': total_produtos,
-        'total_divergencias': total_divergencias,
-        'total_entradas': total_entradas,
-        'total_saidas': total_saidas,
-        'total_ok': total_ok,
-        'total_nao_contados': total_nao_contados,
-        'valor_total_ajustes': valor_total_ajustes
-    }
     
     return render_template(
         'admin/preview_fechamento.html',
@@ -835,13 +588,14 @@ def preview_fechamento():
         comparacao=comparacao,
         stats=stats,
         nome_categoria=nome_categoria,
+        versao_plano=versao,
         is_gerente=True
     )
 
 
 @bp.route('/confirmar_fechamento', methods=['POST'])
 def confirmar_fechamento():
-    """Confirma e executa o fechamento do inventário após revisão."""
+    """Confirma o fechamento revisado e dispara o job que o executa em background."""
     if not gerente_required():
         return redirect(url_for('auth.login_admin'))
     
@@ -852,7 +606,6 @@ def confirmar_fechamento():
         return redirect(url_for('admin.dashboard'))
 
     inv_id = inv['id']
-    inv_dict = dict(inv)
     
     # Verificar ocorrências pendentes
     ocorrencias_pendentes = db.execute(
@@ -863,129 +616,51 @@ def confirmar_fechamento():
         flash(f"❌ Existem {ocorrencias_pendentes['count']} ocorrências pendentes! Resolva todas antes de fechar o inventário.", 'error')
         return redirect(url_for('admin.ocorrencias'))
 
-    # Salvar snapshot do status dos locais
-    db.execute("DELETE FROM historico_status_locais WHERE id_inventario = ?", (inv_id,))
-    locais = db.execute("SELECT id, status FROM locais").fetchall()
-    entries = [(inv_id, l['id'], l['status']) for l in locais]
-    if entries:
-        db.executemany(
-            "INSERT INTO historico_status_locais (id_inventario, id_local, status_registrado) VALUES (?, ?, ?)",
-            entries
-        )
-
-    # GERAR AJUSTES AUTOMÁTICOS NO KARDEX
-    # Buscar usuário Sistema para registrar as movimentações
+    # Buscar usuário Sistema para registrar os ajustes no Kardex
     usuario_sistema = db.execute("SELECT id FROM usuarios WHERE nome = 'Sistema'").fetchone()
     id_usuario_sistema = usuario_sistema['id'] if usuario_sistema else None
     
-    # Determinar escopo dos produtos (COMPLETO ou PARCIAL)
-    if inv_dict['tipo_inventario'] == 'PARCIAL' and inv_dict['id_categoria_escopo']:
-        # Inventário PARCIAL: apenas produtos da categoria
-        sql_produtos_contados = '''
-            SELECT 
-                p.id as produto_id,
-                p.nome as produto_nome,
-                COALESCE((SELECT SUM(saldo) FROM estoque_saldos WHERE produto_id = p.id), 0) as estoque_atual,
-                COALESCE((SELECT SUM(valor_total) FROM estoque_saldos WHERE produto_id = p.id), 0) as valor_total_estoque,
-                p.preco_custo,
-                COALESCE(SUM(c.quantidade_padrao), 0) as quantidade_contada,
-                u.sigla as unidade_padrao
-            FROM produtos p
-            JOIN produto_categoria_inventario pc ON p.id = pc.id_produto
-            LEFT JOIN contagens c ON p.id = c.id_produto AND c.id_inventario = ?
-            LEFT JOIN unidades_medida u ON p.id_unidade_padrao = u.id
-            WHERE p.ativo = 1 
-            AND p.controla_estoque = 1
-            AND pc.id_categoria = ?
-            GROUP BY p.id
-        '''
-        produtos_para_ajustar = db.execute(
-            sql_produtos_contados,
-            (inv_id, inv_dict['id_categoria_escopo'])
-        ).fetchall()
-    else:
-        # Inventário COMPLETO: todos os produtos ativos
-        sql_produtos_contados = '''
-            SELECT 
-                p.id as produto_id,
-                p.nome as produto_nome,
-                COALESCE((SELECT SUM(saldo) FROM estoque_saldos WHERE produto_id = p.id), 0) as estoque_atual,
-                COALESCE((SELECT SUM(valor_total) FROM estoque_saldos WHERE produto_id = p.id), 0) as valor_total_estoque,
-                p.preco_custo,
-                COALESCE(SUM(c.quantidade_padrao), 0) as quantidade_contada,
-                u.sigla as unidade_padrao
-            FROM produtos p
-            LEFT JOIN contagens c ON p.id = c.id_produto AND c.id_inventario = ?
-            LEFT JOIN unidades_medida u ON p.id_unidade_padrao = u.id
-            WHERE p.ativo = 1 AND p.controla_estoque = 1
-            GROUP BY p.id
-        '''
-        produtos_para_ajustar = db.execute(sql_produtos_contados, (inv_id,)).fetchall()
-    
-    # Processar ajustes
-    total_ajustes = 0
-    total_entradas = 0
-    total_saidas = 0
-    
-    for produto in produtos_para_ajustar:
-        estoque_sistema = float(produto['estoque_atual'] or 0)
-        quantidade_contada = float(produto['quantidade_contada'] or 0)
-        diferenca = quantidade_contada - estoque_sistema
-        valor_total_estoque = float(produto['valor_total_estoque'] or 0)
-        custo_medio_atual = (valor_total_estoque / estoque_sistema) if estoque_sistema > 0 else float(produto['preco_custo'] or 0)
-        
-        # Apenas gerar movimentação se houver diferença
-        if abs(diferenca) > 0.001:  # Tolerância para erros de arredondamento
-            if diferenca > 0:
-                # Entrada (contado > sistema)
-                registrar_movimento(
-                    db=db,
-                    produto_id=produto['produto_id'],
-                    tipo='ENTRADA',
-                    quantidade_original=abs(diferenca),
-                    motivo='AJUSTE_INVENTARIO',
-                    unidade_movimentacao=produto['unidade_padrao'],
-                    fator_conversao=1.0,
-                    origem=f'Fechamento Inventário #{inv_id} - Ajuste Automático',
-                    usuario_id=id_usuario_sistema,
-                    observacao=f'Contado: {quantidade_contada:.2f} | Sistema: {estoque_sistema:.2f} | Diferença: +{diferenca:.2f}'
-                )
-                total_entradas += 1
-            else:
-                # Saída (contado < sistema)
-                registrar_movimento(
-                    db=db,
-                    produto_id=produto['produto_id'],
-                    tipo='SAIDA',
-                    quantidade_original=abs(diferenca),
-                    motivo='AJUSTE_INVENTARIO',
-                    unidade_movimentacao=produto['unidade_padrao'],
-                    fator_conversao=1.0,
-                    origem=f'Fechamento Inventário #{inv_id} - Ajuste Automático',
-                    usuario_id=id_usuario_sistema,
-                    observacao=f'Contado: {quantidade_contada:.2f} | Sistema: {estoque_sistema:.2f} | Diferença: {diferenca:.2f}'
-                )
-                total_saidas += 1
-            
-            total_ajustes += 1
+    # Registrar o job com o plano revisado no preview (recusado se já houver
+    # fechamento em andamento ou se as contagens ou o estoque mudaram)
+    try:
+        job_id = criar_job(db, inv_id, request.form.get('versao_plano'), id_usuario_sistema)
+        db.commit()
+    except ValueError as e:
+        db.rollback()
+        flash(f'❌ {e}', 'error')
+        if job_ativo(db, inv_id):
+            return redirect(url_for('admin.dashboard'))
+        return redirect(url_for('admin.preview_fechamento'))
+    
+    iniciar_execucao(current_app._get_current_object(), job_id)
+    flash('⏳ Fechamento iniciado! Os ajustes estão sendo gerados em segundo plano; acompanhe o progresso abaixo.', 'info')
+    return redirect(url_for('admin.dashboard'))
 
-    # Resetar status dos locais para próximo inventário
-    db.execute("UPDATE locais SET status = 0")
 
-    # Fechar inventário
-    db.execute(
-        "UPDATE inventarios SET status='Fechado', data_fechamento = CURRENT_TIMESTAMP WHERE id = ? AND status='Aberto'",
-        (inv_id,)
-    )
-    
-    db.commit()
+@bp.route('/fechamento/<int:job_id>/status')
+def status_fechamento(job_id):
+    """Progresso do job de fechamento (JSON, consultado pelo dashboard)."""
+    if not gerente_required():
+        return jsonify({'erro': 'Acesso negado'}), 403
     
-    # Mensagem de sucesso com detalhes
-    if total_ajustes > 0:
-        flash(f'✅ Inventário fechado com sucesso! {total_ajustes} ajuste(s) gerado(s): {total_entradas} entrada(s), {total_saidas} saída(s). Locais resetados.', 'success')
-    else:
-        flash('✅ Inventário fechado com sucesso! Nenhum ajuste necessário (estoque já estava correto). Locais resetados.', 'success')
+    db = get_db()
+    job = db.execute('SELECT * FROM fechamento_jobs WHERE id = ?', (job_id,)).fetchone()
+    if not job:
+        return jsonify({'erro': 'Fechamento não encontrado'}), 404
+    return jsonify(progresso_job(job))
+
+
+@bp.route('/fechamento/<int:job_id>/retomar', methods=['POST'])
+def retomar_fechamento(job_id):
+    """Retoma um fechamento que parou com erro, do ponto em que parou."""
+    if not gerente_required():
+        return redirect(url_for('auth.login_admin'))
     
+    db = get_db()
+    if retomar_job(db, job_id):
+        db.commit()
+        flash('⏳ Fechamento retomado do ponto em que parou.', 'info')
+    iniciar_execucao(current_app._get_current_object(), job_id)
     return redirect(url_for('admin.dashboard'))
 
 
@@ -1043,6 +718,10 @@ def cancelar_inventario():
     
     inv_id = inv['id']
     
+    if job_ativo(db, inv_id):
+        flash('❌ O fechamento deste inventário já está em andamento e não pode ser cancelado.', 'error')
+        return redirect(url_for('admin.dashboard'))
+    
     try:
         # Registrar no log ANTES de deletar
         db.execute(
@@ -1060,6 +739,10 @@ def cancelar_inventario():
         # Deletar histórico de status dos locais
         db.execute("DELETE FROM historico_status_locais WHERE id_inventario = ?", (inv_id,))
         
+        # Deletar o plano de fechamento
+        db.execute("DELETE FROM fechamento_plano WHERE id_inventario = ?", (inv_id,))
+        db.execute("DELETE FROM fechamento_plano_estado WHERE id_inventario = ?", (inv_id,))
+        
         # Deletar o inventário
         db.execute("DELETE FROM inventarios WHERE id = ?", (inv_id,))
         
@@ -1137,6 +820,8 @@ def exportar_preview_fechamento():
     if not gerente_required():
         return redirect(url_for('auth.login_admin'))
     
+    import pandas as pd
+    
     db = get_db()
     inv = db.execute("SELECT * FROM inventarios WHERE status='Aberto' LIMIT 1").fetchone()
     if not inv:
@@ -1146,82 +831,34 @@ def exportar_preview_fechamento():
     inv_id = inv['id']
     inv_dict = dict(inv)
     
-    # Determinar escopo dos produtos (mesma lógica do preview)
+    # Mesmo plano exibido no preview (gerado agora se ainda não existir ou estiver desatualizado)
+    obter_plano(db, inv_dict)
+    
     if inv_dict['tipo_inventario'] == 'PARCIAL' and inv_dict['id_categoria_escopo']:
-        sql_produtos = '''
-            SELECT 
-                p.id as produto_id,
-                p.nome as produto_nome,
-                p.id_erp,
-                p.gtin,
-                p.estoque_atual,
-                p.preco_custo,
-                COALESCE(SUM(c.quantidade_padrao), 0) as quantidade_contada,
-                u.sigla as unidade_padrao,
-                COUNT(c.id) as total_contagens
-            FROM produtos p
-            JOIN produto_categoria_inventario pc ON p.id = pc.id_produto
-            LEFT JOIN contagens c ON p.id = c.id_produto AND c.id_inventario = ?
-            LEFT JOIN unidades_medida u ON p.id_unidade_padrao = u.id
-            WHERE p.ativo = 1 AND p.controla_estoque = 1 AND pc.id_categoria = ?
-            GROUP BY p.id
-            ORDER BY p.nome
-        '''
-        produtos = db.execute(sql_produtos, (inv_id, inv_dict['id_categoria_escopo'])).fetchall()
         categoria = db.execute("SELECT nome FROM categorias_inventario WHERE id = ?", (inv_dict['id_categoria_escopo'],)).fetchone()
         tipo_info = f"PARCIAL - {categoria['nome']}" if categoria else "PARCIAL"
     else:
-        sql_produtos = '''
-            SELECT 
-                p.id as produto_id,
-                p.nome as produto_nome,
-                p.id_erp,
-                p.gtin,
-                p.estoque_atual,
-                p.preco_custo,
-                COALESCE(SUM(c.quantidade_padrao), 0) as quantidade_contada,
-                u.sigla as unidade_padrao,
-                COUNT(c.id) as total_contagens
-            FROM produtos p
-            LEFT JOIN contagens c ON p.id = c.id_produto AND c.id_inventario = ?
-            LEFT JOIN unidades_medida u ON p.id_unidade_padrao = u.id
-            WHERE p.ativo = 1 AND p.controla_estoque = 1
-            GROUP BY p.id
-            ORDER BY p.nome
-        '''
-        produtos = db.execute(sql_produtos, (inv_id,)).fetchall()
         tipo_info = "COMPLETO"
     
+    rotulos_ajuste = {'OK': 'OK - Sem Ajuste', 'ENTRADA': 'ENTRADA', 'SAIDA': 'SAÍDA'}
+    
     # Montar dados para Excel
-    dados_excel = []
-    for produto in produtos:
-        estoque_sistema = float(produto['estoque_atual'] or 0)
-        quantidade_contada = float(produto['quantidade_contada'] or 0)
-        diferenca = quantidade_contada - estoque_sistema
-        preco_custo = float(produto['preco_custo'] or 0)
-        valor_ajuste = abs(diferenca) * preco_custo
-        foi_contado = produto['total_contagens'] > 0
-        
-        if abs(diferenca) < 0.001:
-            tipo_ajuste = 'OK - Sem Ajuste'
-        elif diferenca > 0:
-            tipo_ajuste = 'ENTRADA'
-        else:
-            tipo_ajuste = 'SAÍDA'
-        
-        dados_excel.append({
-            'ID ERP': produto['id_erp'] or '-',
-            'GTIN': produto['gtin'] or '-',
-            'Produto': produto['produto_nome'],
-            'Unidade': produto['unidade_padrao'],
-            'Estoque Sistema': estoque_sistema,
-            'Quantidade Contada': quantidade_contada,
-            'Diferença': diferenca,
-            'Tipo Ajuste': tipo_ajuste,
-            'Preço Custo Unit.': preco_custo,
-            'Valor do Ajuste': valor_ajuste,
-            'Foi Contado?': 'Sim' if foi_contado else 'Não'
-        })
+    dados_excel = [
+        {
+            'ID ERP': item['id_erp'] or '-',
+            'GTIN': item['gtin'] or '-',
+            'Produto': item['produto_nome'],
+            'Unidade': item['unidade_padrao'],
+            'Estoque Sistema': item['estoque_sistema'],
+            'Quantidade Contada': item['quantidade_contada'],
+            'Diferença': item['diferenca'],
+            'Tipo Ajuste': rotulos_ajuste[item['tipo_ajuste']],
+            'Custo Médio Unit.': item['custo_medio_atual'],
+            'Valor do Ajuste': item['valor_ajuste'],
+            'Foi Contado?': 'Sim' if item['total_contagens'] > 0 else 'Não'
+        }
+        for item in itens_plano(db, inv_id)
+    ]
     
     # Criar DataFrame e Excel
     df = pd.DataFrame(dados_excel)
@@ -1257,7 +894,6 @@ def admin_produtos():
         return redirect(url_for('auth.login_admin'))
 
     db = get_db()
-    ensure_materias_primas_schema(db)
 
     if request.method == 'POST':
         produto_id = request.form.get('produto_id')
@@ -1322,29 +958,49 @@ def admin_produtos():
             return redirect(url_for('admin.admin_produtos'))
 
     termo = request.args.get('q', '').strip()
-    pagina = request.args.get('page', 1, type=int)
     itens_por_pagina = 50
 
+    join_busca = ""
+    coluna_relevancia = "NULL"
     where_sql = "WHERE (p.ativo=1 or p.ativo=0)"
+    chaves = ['p.nome', 'p.id']
     params = []
     if termo:
-        where_sql += " AND (p.nome LIKE ? OR p.gtin LIKE ? OR p.id_erp LIKE ?)"
-        wildcard = f'%{termo}%'
-        params = [wildcard, wildcard, wildcard]
-
-    total_itens = db.execute(f"SELECT COUNT(*) as total FROM produtos p {where_sql}", params).fetchone()['total']
-    total_paginas = math.ceil(total_itens / itens_por_pagina)
-    offset = (pagina - 1) * itens_por_pagina
-
+        sql_filtro, params = sql_busca(termo)
+        if sql_filtro:
+            join_busca = f"JOIN ({sql_filtro}) busca ON busca.produto_id = p.id"
+            coluna_relevancia = "busca.relevancia"
+            chaves = ['busca.relevancia', 'p.nome', 'p.id']
+        else:
+            where_sql += " AND 0"
+            params = []
+    pagina = preparar_pagina(request.args, chaves)
+
+    total_itens = agregar_com_cache(
+        db,
+        f"SELECT COUNT(*) as total FROM produtos p {join_busca} {where_sql}",
+        params,
+        # A busca também casa a categoria, que não muda catalogo_versao
+        "SELECT versao FROM produtos_versao WHERE id = 1"
+    )['total']
+
+    where_pagina = f"{where_sql} AND {pagina['where']}" if pagina['where'] else where_sql
     sql_data = f'''
-        SELECT p.id, p.nome, p.categoria, p.id_erp, p.gtin, p.preco_custo, p.preco_venda, p.id_unidade_padrao, p.ativo, u.sigla as unidade_padrao 
+        SELECT p.id, p.nome, p.categoria, p.id_erp, p.gtin, p.preco_custo, p.preco_venda, p.id_unidade_padrao, p.ativo, u.sigla as unidade_padrao,
+               {coluna_relevancia} as relevancia
         FROM produtos p 
+        {join_busca}
         LEFT JOIN unidades_medida u ON p.id_unidade_padrao = u.id 
-        {where_sql}
-        ORDER BY p.nome 
-        LIMIT ? OFFSET ?
+        {where_pagina}
+        ORDER BY {pagina['order_by']} 
+        LIMIT ?
     '''
-    produtos = [dict(r) for r in db.execute(sql_data, params + [itens_por_pagina, offset]).fetchall()]
+    linhas = [dict(r) for r in db.execute(sql_data, params + pagina['params'] + [itens_por_pagina + 1]).fetchall()]
+    paginacao = montar_pagina(
+        pagina, linhas, itens_por_pagina,
+        lambda p: ([p['relevancia']] if join_busca else []) + [p['nome'], p['id']]
+    )
+    produtos = paginacao['itens']
     unidades = [dict(r) for r in db.execute("SELECT * FROM unidades_medida ORDER BY sigla").fetchall()]
     materias_primas = [dict(r) for r in db.execute("SELECT * FROM materias_primas WHERE ativo = 1 ORDER BY nome").fetchall()]
 
@@ -1354,8 +1010,7 @@ def admin_produtos():
         unidades=unidades,
         materias_primas=materias_primas,
         busca=termo,
-        pagina_atual=pagina,
-        total_paginas=total_paginas,
+        paginacao=paginacao,
         total_itens=total_itens,
         is_gerente=True
     )
@@ -1367,7 +1022,6 @@ def admin_produto_json(prod_id):
         return jsonify({'erro': 'Acesso negado'}), 403
 
     db = get_db()
-    ensure_materias_primas_schema(db)
     prod = db.execute("SELECT * FROM produtos WHERE id = ?", (prod_id,)).fetchone()
     if not prod:
         return jsonify({'erro': 'Produto não encontrado'}), 404
@@ -1433,6 +1087,8 @@ def analise_importacao():
     if not gerente_required():
         return redirect(url_for('auth.login_admin'))
 
+    import pandas as pd
+
     filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], 'temp_import.xlsx')
     if not os.path.exists(filepath):
         flash('Envie o arquivo primeiro.', 'error')
@@ -1542,6 +1198,8 @@ def confirmar_importacao():
     if not gerente_required():
         return jsonify({'erro': 'Acesso negado'}), 403
 
+    import pandas as pd
+
     filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], 'temp_import.xlsx')
     if not os.path.exists(filepath):
         return jsonify({'erro': 'Arquivo expirou'}), 400
@@ -1677,7 +1335,6 @@ def admin_materias_primas():
         return redirect(url_for('auth.login_admin'))
 
     db = get_db()
-    ensure_materias_primas_schema(db)
 
     if request.method == 'POST':
         action = request.form.get('action')
@@ -1749,6 +1406,8 @@ def modelo_materias_primas():
     if not gerente_required():
         return redirect(url_for('auth.login_admin'))
 
+    import pandas as pd
+
     df = pd.DataFrame([
         {'NOME': 'Açúcar', 'CODIGO_INTERNO': 'MP-001', 'DESCRICAO': 'Granulado', 'ATIVO': 1},
         {'NOME': 'Farinha de Trigo', 'CODIGO_INTERNO': 'MP-002', 'DESCRICAO': 'Tipo 1', 'ATIVO': 1},
@@ -1772,8 +1431,9 @@ def exportar_materias_primas():
     if not gerente_required():
         return redirect(url_for('auth.login_admin'))
 
+    import pandas as pd
+
     db = get_db()
-    ensure_materias_primas_schema(db)
 
     rows = db.execute('''
         SELECT mp.id, mp.nome, mp.codigo_interno, mp.descricao, mp.ativo,
@@ -1807,6 +1467,8 @@ def importar_materias_primas():
     if not gerente_required():
         return redirect(url_for('auth.login_admin'))
 
+    import pandas as pd
+
     file = request.files.get('arquivo')
     if not file or not file.filename.endswith(('.xlsx', '.xls')):
         flash('Envie um arquivo .xlsx', 'error')
@@ -1819,7 +1481,6 @@ def importar_materias_primas():
         return redirect(url_for('admin.admin_materias_primas'))
 
     db = get_db()
-    ensure_materias_primas_schema(db)
 
     criados, atualizados, ignorados = 0, 0, 0
     for _, row in df.iterrows():
@@ -1876,7 +1537,6 @@ def materia_prima_produtos(materia_id):
         return redirect(url_for('auth.login_admin'))
 
     db = get_db()
-    ensure_materias_primas_schema(db)
 
     materia = db.execute(
         'SELECT * FROM materias_primas WHERE id = ? AND ativo = 1',
@@ -2074,9 +1734,13 @@ def admin_unidades():
         action = request.form.get('action')
         if action == 'delete':
             unidade_id = request.form.get('unidade_id')
-            db.execute('DELETE FROM unidades_medida WHERE id = ?', (unidade_id,))
-            db.commit()
-            flash('Unidade removida com sucesso!', 'success')
+            try:
+                db.execute('DELETE FROM unidades_medida WHERE id = ?', (unidade_id,))
+                db.commit()
+                flash('Unidade removida com sucesso!', 'success')
+            except sqlite3.IntegrityError:
+                db.rollback()
+                flash('Unidade em uso por produtos, contagens ou conversões. Não pode ser removida.', 'error')
         else:
             sigla = request.form.get('sigla', '').strip().upper()
             nome = request.form.get('nome', '').strip()
@@ -2369,39 +2033,14 @@ def lotes_pendentes():
     
     db = get_db()
     
-    # Buscar lotes pendentes com informações do usuário criador
+    # Lotes pendentes em ordem de criação, com o número de lotes anteriores
+    # pendentes (para avisos) vindo da posição na fila (v_lotes_fila)
     lotes = db.execute('''
-        SELECT 
-            l.*,
-            u.nome as usuario_nome,
-            u.funcao as usuario_funcao,
-            COUNT(DISTINCT li.id) as total_itens,
-            SUM(li.quantidade_original * li.fator_conversao * COALESCE(li.preco_custo_unitario, 0)) as valor_total
-        FROM lotes_movimentacao l
-        LEFT JOIN usuarios u ON l.id_usuario = u.id
-        LEFT JOIN lotes_movimentacao_itens li ON l.id = li.id_lote
-        WHERE l.status = 'PENDENTE_APROVACAO'
-        GROUP BY l.id
-        ORDER BY l.data_criacao ASC
+        SELECT * FROM v_lotes_pendentes
+        ORDER BY posicao_fila
     ''').fetchall()
     
-    # Verificar se há lotes anteriores pendentes para cada um (para avisos)
-    lotes_com_aviso = []
-    for lote in lotes:
-        anteriores = db.execute('''
-            SELECT COUNT(*) as total
-            FROM lotes_movimentacao
-            WHERE status = 'PENDENTE_APROVACAO'
-              AND data_criacao < ?
-              AND id != ?
-        ''', (lote['data_criacao'], lote['id'])).fetchone()
-        
-        lotes_com_aviso.append({
-            **dict(lote),
-            'lotes_anteriores_pendentes': anteriores['total']
-        })
-    
-    return render_template('admin/lotes_pendentes.html', lotes=lotes_com_aviso)
+    return render_template('admin/lotes_pendentes.html', lotes=[dict(lote) for lote in lotes])
 
 
 @bp.route('/lotes/exportar', methods=['GET', 'POST'])
@@ -2410,8 +2049,9 @@ def lotes_exportar():
     if not gerente_required():
         return redirect(url_for('auth.login_admin'))
 
+    import pandas as pd
+
     db = get_db()
-    ensure_finance_schema(db)
     status = request.args.get('status', 'APROVADO').strip()
     tipo = request.args.get('tipo', '').strip()
     data_inicio = request.args.get('data_inicio', '').strip()
@@ -2428,13 +2068,9 @@ def lotes_exportar():
         where.append('l.tipo = ?')
         params.append(tipo)
 
-    if data_inicio:
-        where.append("DATE(l.data_criacao) >= ?")
-        params.append(data_inicio)
-
-    if data_fim:
-        where.append("DATE(l.data_criacao) <= ?")
-        params.append(data_fim)
+    clausulas_periodo, params_periodo = filtro_periodo('l.data_criacao', data_inicio, data_fim)
+    where.extend(clausulas_periodo)
+    params.extend(params_periodo)
 
     where_sql = ' AND '.join(where)
 
@@ -2586,7 +2222,6 @@ def lote_detalhe(id_lote):
         return redirect(url_for('auth.login_admin'))
     
     db = get_db()
-    ensure_finance_schema(db)
     
     # Buscar lote com dados do criador e aprovador
     lote = db.execute('''
@@ -2645,20 +2280,18 @@ def lote_detalhe(id_lote):
         preco = it['preco_custo_unitario'] or 0
         total_itens_valor += qtd_base * preco
     
-    # Verificar lotes anteriores pendentes
+    # Verificar lotes anteriores pendentes (posição do lote na fila de aprovação)
     anteriores = db.execute('''
-        SELECT COUNT(*) as total
-        FROM lotes_movimentacao
-        WHERE status = 'PENDENTE_APROVACAO'
-          AND data_criacao < ?
-          AND id != ?
-    ''', (lote['data_criacao'], id_lote)).fetchone()
+        SELECT posicao_fila - 1 as total
+        FROM v_lotes_fila
+        WHERE id = ?
+    ''', (id_lote,)).fetchone()
     
     return render_template(
         'admin/lote_detalhe.html', 
         lote=dict(lote),
         itens=[dict(i) for i in itens],
-        lotes_anteriores_pendentes=anteriores['total'],
+        lotes_anteriores_pendentes=anteriores['total'] if anteriores else 0,
         financeiro=dict(financeiro_row) if financeiro_row else None,
         parcelas_fin=[dict(p) for p in parcelas_fin],
         valor_itens_total=round(total_itens_valor, 2)
@@ -2680,10 +2313,9 @@ def movimentacoes():
     data_inicio = request.args.get('data_inicio', '')
     data_fim = request.args.get('data_fim', '')
     
-    # Paginação
-    pagina = request.args.get('page', 1, type=int)
+    # Paginação por cursor: mais recentes primeiro
     itens_por_pagina = 50
-    offset = (pagina - 1) * itens_por_pagina
+    pagina = preparar_pagina(request.args, ['m.data_movimento', 'm.id'], descendente=True)
     
     # Construir query com filtros
     where_clauses = []
@@ -2701,15 +2333,13 @@ def movimentacoes():
         where_clauses.append('m.motivo = ?')
         params.append(motivo)
     
-    if data_inicio:
-        where_clauses.append("DATE(m.data_movimento) >= ?")
-        params.append(data_inicio)
-    
-    if data_fim:
-        where_clauses.append("DATE(m.data_movimento) <= ?")
-        params.append(data_fim)
+    clausulas_periodo, params_periodo = filtro_periodo('m.data_movimento', data_inicio, data_fim)
+    where_clauses.extend(clausulas_periodo)
+    params.extend(params_periodo)
     
     where_sql = 'WHERE ' + ' AND '.join(where_clauses) if where_clauses else ''
+    clausulas_pagina = where_clauses + ([pagina['where']] if pagina['where'] else [])
+    where_pagina = 'WHERE ' + ' AND '.join(clausulas_pagina) if clausulas_pagina else ''
     
     # Query principal
     sql_movimentacoes = f'''
@@ -2736,27 +2366,19 @@ def movimentacoes():
         JOIN produtos p ON m.id_produto = p.id
         LEFT JOIN usuarios u ON m.id_usuario = u.id
         LEFT JOIN unidades_medida um ON p.id_unidade_padrao = um.id
-        {where_sql}
-        ORDER BY m.data_movimento DESC
-        LIMIT ? OFFSET ?
+        {where_pagina}
+        ORDER BY {pagina['order_by']}
+        LIMIT ?
     '''
     
-    movimentacoes_lista = [
+    linhas = [
         dict(r) for r in db.execute(
             sql_movimentacoes, 
-            params + [itens_por_pagina, offset]
+            params + pagina['params'] + [itens_por_pagina + 1]
         ).fetchall()
     ]
-    
-    # Contar total para paginação
-    sql_count = f'''
-        SELECT COUNT(*) as total 
-        FROM movimentacoes m
-        JOIN produtos p ON m.id_produto = p.id
-        {where_sql}
-    '''
-    total = db.execute(sql_count, params).fetchone()['total']
-    total_paginas = math.ceil(total / itens_por_pagina)
+    paginacao = montar_pagina(pagina, linhas, itens_por_pagina, lambda m: [m['data_movimento'], m['id']])
+    movimentacoes_lista = paginacao['itens']
     
     # Lista de produtos para o filtro
     produtos = [
@@ -2765,30 +2387,10 @@ def movimentacoes():
         ).fetchall()
     ]
     
-    # Calcular SALDO INICIAL GLOBAL (soma de todos os produtos antes do período)
-    saldo_inicial_global = 0.0
+    # SALDO INICIAL GLOBAL (todos os produtos, ou o filtrado): checkpoint mensal + movimentações do mês
+    saldo_inicial_global = {'saldo': 0.0, 'valor_total': 0.0}
     if data_inicio:
-        # Construir WHERE apenas com filtro de produto (se houver)
-        where_saldo = []
-        params_saldo = []
-        
-        if produto_id:
-            where_saldo.append('id_produto = ?')
-            params_saldo.append(produto_id)
-        
-        where_saldo.append("DATE(data_movimento) < ?")
-        params_saldo.append(data_inicio)
-        
-        where_sql_saldo = 'WHERE ' + ' AND '.join(where_saldo)
-        
-        sql_saldo_inicial = f'''
-            SELECT 
-                COALESCE(SUM(CASE WHEN tipo = 'ENTRADA' THEN quantidade ELSE -quantidade END), 0) as saldo
-            FROM movimentacoes
-            {where_sql_saldo}
-        '''
-        resultado = db.execute(sql_saldo_inicial, params_saldo).fetchone()
-        saldo_inicial_global = float(resultado['saldo'])
+        saldo_inicial_global = saldo_em(db, data_inicio, produto_id=produto_id)
     
     # Estatísticas do período
     sql_stats = f'''
@@ -2803,25 +2405,13 @@ def movimentacoes():
         JOIN produtos p ON m.id_produto = p.id
         {where_sql}
     '''
-    stats = dict(db.execute(sql_stats, params).fetchone())
-    
-    # Adicionar saldo inicial às estatísticas
-    stats['saldo_inicial'] = round(saldo_inicial_global, 2)
-    
-    # Calcular valor em R$ do saldo inicial
-    sql_valor_saldo_inicial = f'''
-        SELECT 
-            COALESCE(SUM(CASE WHEN tipo = 'ENTRADA' THEN valor_total ELSE -valor_total END), 0) as valor
-        FROM movimentacoes
-        WHERE {"id_produto = ? AND " if produto_id else ""}DATE(data_movimento) < ?
-    '''
-    params_valor_inicial = [produto_id, data_inicio] if produto_id else [data_inicio]
+    # Totais e contagem do filtro: recalculados só quando entra movimentação nova
+    stats = agregar_com_cache(db, sql_stats, params, 'SELECT MAX(id) FROM movimentacoes')
+    total = stats['total_movimentacoes']
     
-    if data_inicio:
-        resultado_valor = db.execute(sql_valor_saldo_inicial, params_valor_inicial).fetchone()
-        stats['valor_saldo_inicial'] = round(float(resultado_valor['valor']), 2)
-    else:
-        stats['valor_saldo_inicial'] = 0.0
+    # Adicionar saldo inicial (quantidade e R$) às estatísticas
+    stats['saldo_inicial'] = round(saldo_inicial_global['saldo'], 2)
+    stats['valor_saldo_inicial'] = round(saldo_inicial_global['valor_total'], 2)
     
     # Calcular saldo atual (quantidade): saldo_inicial + entradas - saídas
     stats['saldo_atual'] = round(
@@ -2835,8 +2425,7 @@ def movimentacoes():
         'admin/movimentacoes.html',
         movimentacoes=movimentacoes_lista,
         produtos=produtos,
-        pagina_atual=pagina,
-        total_paginas=total_paginas,
+        paginacao=paginacao,
         total_registros=total,
         stats=stats,
         filtros={
@@ -2863,20 +2452,31 @@ def estoque_atual():
     status = request.args.get('status', '').strip()
     categoria_inv = request.args.get('categoria_inv', '').strip()
     curva_abc = request.args.get('curva_abc', '').strip()
-    ordenacao = request.args.get('ordenacao', 'nome').strip()
+    ordenacao = request.args.get('ordenacao', 'relevancia' if busca else 'nome').strip()
     
-    # Paginação
-    pagina = request.args.get('page', 1, type=int)
     itens_por_pagina = 50
     
     # Construir WHERE dinâmico
+    join_busca = ""
+    coluna_relevancia = "NULL"
     where_conditions = ["p.ativo = 1"]
     params = []
     
     if busca:
-        where_conditions.append("(p.nome LIKE ? OR p.id_erp LIKE ? OR p.gtin LIKE ?)")
-        wildcard = f'%{busca}%'
-        params.extend([wildcard, wildcard, wildcard])
+        sql_filtro, params_filtro = sql_busca(busca)
+        if sql_filtro:
+            join_busca = f"JOIN ({sql_filtro}) busca ON busca.produto_id = p.id"
+            coluna_relevancia = "busca.relevancia"
+            params.extend(params_filtro)
+        else:
+            where_conditions.append("0")
+    
+    if status == 'zerado':
+        where_conditions.append("COALESCE(sp.saldo, 0) <= 0")
+    elif status == 'baixo':
+        where_conditions.append("COALESCE(sp.saldo, 0) > 0 AND COALESCE(sp.saldo, 0) < 10")
+    elif status == 'ok':
+        where_conditions.append("COALESCE(sp.saldo, 0) >= 10")
     
     if curva_abc:
         where_conditions.append("p.curva_abc = ?")
@@ -2893,36 +2493,30 @@ def estoque_atual():
     
     where_sql = " AND ".join(where_conditions)
     
-    # Definir ordenação
+    # Ordenação: (chaves SQL terminadas em p.id, descendente, valores das chaves na linha)
     order_map = {
-        'nome': 'p.nome ASC',
-        'quantidade': 'estoque_atual DESC',
-        'valor_total': 'valor_total DESC',
-        'ultima_mov': 'ultima_movimentacao DESC'
+        'nome': (['p.nome', 'p.id'], False, lambda p: [p['nome'], p['id']]),
+        'quantidade': (['COALESCE(sp.saldo, 0)', 'p.id'], True, lambda p: [p['estoque_atual'], p['id']]),
+        'valor_total': (
+            ['COALESCE(sp.saldo, 0) * COALESCE(p.preco_custo, 0)', 'p.id'], True,
+            lambda p: [p['valor_total'], p['id']]
+        ),
+        'ultima_mov': (
+            ["COALESCE(um.data_movimento, '')", 'p.id'], True,
+            lambda p: [p['ultima_movimentacao'] or '', p['id']]
+        ),
     }
-    order_by = order_map.get(ordenacao, 'p.nome ASC')
+    if join_busca:
+        order_map['relevancia'] = (
+            ['busca.relevancia', 'p.nome', 'p.id'], False,
+            lambda p: [p['relevancia'], p['nome'], p['id']]
+        )
+    chaves, descendente, chave_linha = order_map.get(ordenacao, order_map['nome'])
+    pagina = preparar_pagina(request.args, chaves, descendente)
+    where_pagina = f"{where_sql} AND {pagina['where']}" if pagina['where'] else where_sql
     
     # Query principal com estoque e valores
     sql_produtos = f'''
-        WITH ultima_mov AS (
-            SELECT 
-                m1.id_produto,
-                m1.data_movimento as ultima_movimentacao,
-                m1.tipo as tipo_ultima_mov
-            FROM movimentacoes m1
-            INNER JOIN (
-                SELECT id_produto, MAX(data_movimento) as max_data
-                FROM movimentacoes
-                GROUP BY id_produto
-            ) m2 ON m1.id_produto = m2.id_produto AND m1.data_movimento = m2.max_data
-        ),
-        saldos_produtos AS (
-            SELECT 
-                produto_id,
-                SUM(saldo) as saldo_total
-            FROM estoque_saldos
-            GROUP BY produto_id
-        )
         SELECT 
             p.id,
             p.nome,
@@ -2932,66 +2526,61 @@ def estoque_atual():
             p.preco_custo,
             p.curva_abc,
             u.sigla as unidade_padrao,
-            COALESCE(sp.saldo_total, 0) as estoque_atual,
-            COALESCE(sp.saldo_total, 0) * COALESCE(p.preco_custo, 0) as valor_total,
-            um.ultima_movimentacao,
-            um.tipo_ultima_mov
+            COALESCE(sp.saldo, 0) as estoque_atual,
+            COALESCE(sp.saldo, 0) * COALESCE(p.preco_custo, 0) as valor_total,
+            um.data_movimento as ultima_movimentacao,
+            um.tipo as tipo_ultima_mov,
+            {coluna_relevancia} as relevancia
         FROM produtos p
+        {join_busca}
         LEFT JOIN unidades_medida u ON p.id_unidade_padrao = u.id
-        LEFT JOIN ultima_mov um ON p.id = um.id_produto
-        LEFT JOIN saldos_produtos sp ON p.id = sp.produto_id
-        WHERE {where_sql}
-        ORDER BY {order_by}
-        LIMIT ? OFFSET ?
+        -- Última movimentação só dos produtos lidos (busca no índice do kardex, não agrupa a tabela)
+        LEFT JOIN movimentacoes um ON um.id = (
+            SELECT m.id FROM movimentacoes m
+            WHERE m.id_produto = p.id
+            ORDER BY m.data_movimento DESC, m.id DESC
+            LIMIT 1
+        )
+        LEFT JOIN estoque_saldos_produto sp ON p.id = sp.produto_id
+        WHERE {where_pagina}
+        ORDER BY {pagina['order_by']}
+        LIMIT ?
+    '''
+    
+    # Contagens e totais mudam com os produtos (preço, curva ABC, ativo...) e com os saldos (movimentações)
+    versao_estoque = '''
+        SELECT (SELECT versao FROM produtos_versao WHERE id = 1), (SELECT MAX(id) FROM movimentacoes)
     '''
     
     # Contar total para paginação
     sql_count = f'''
         SELECT COUNT(*) as total
         FROM produtos p
+        {join_busca}
+        LEFT JOIN estoque_saldos_produto sp ON p.id = sp.produto_id
         WHERE {where_sql}
     '''
-    
-    total_itens = db.execute(sql_count, params).fetchone()['total']
-    total_paginas = math.ceil(total_itens / itens_por_pagina)
-    offset = (pagina - 1) * itens_por_pagina
+    total_itens = agregar_com_cache(db, sql_count, params, versao_estoque)['total']
     
     # Executar query principal
-    produtos = [dict(r) for r in db.execute(sql_produtos, params + [itens_por_pagina, offset]).fetchall()]
-    
-    # Aplicar filtro de status pós-query (mais fácil que fazer no SQL)
-    if status:
-        if status == 'zerado':
-            produtos = [p for p in produtos if p['estoque_atual'] <= 0]
-        elif status == 'baixo':
-            produtos = [p for p in produtos if 0 < p['estoque_atual'] < 10]
-        elif status == 'ok':
-            produtos = [p for p in produtos if p['estoque_atual'] >= 10]
-        
-        # Recalcular paginação após filtro
-        total_itens = len(produtos)
-        total_paginas = math.ceil(total_itens / itens_por_pagina)
-        produtos = produtos[offset:offset + itens_por_pagina]
+    linhas = [dict(r) for r in db.execute(sql_produtos, params + pagina['params'] + [itens_por_pagina + 1]).fetchall()]
+    paginacao = montar_pagina(pagina, linhas, itens_por_pagina, chave_linha)
+    produtos = paginacao['itens']
     
     # Calcular estatísticas globais
     sql_stats = f'''
-        WITH saldos AS (
-            SELECT produto_id, SUM(saldo) as saldo_total
-            FROM estoque_saldos
-            GROUP BY produto_id
-        )
         SELECT 
             COUNT(DISTINCT p.id) as total_produtos,
-            COALESCE(SUM(COALESCE(s.saldo_total, 0) * COALESCE(p.preco_custo, 0)), 0) as valor_total,
-            COALESCE(SUM(CASE WHEN COALESCE(s.saldo_total, 0) <= 0 THEN 1 ELSE 0 END), 0) as produtos_zerados,
-            COALESCE(SUM(CASE WHEN COALESCE(s.saldo_total, 0) > 0 AND COALESCE(s.saldo_total, 0) < 10 THEN 1 ELSE 0 END), 0) as produtos_baixos,
-            COALESCE(SUM(CASE WHEN COALESCE(s.saldo_total, 0) >= 10 THEN 1 ELSE 0 END), 0) as produtos_ok
+            COALESCE(SUM(COALESCE(s.saldo, 0) * COALESCE(p.preco_custo, 0)), 0) as valor_total,
+            COALESCE(SUM(CASE WHEN COALESCE(s.saldo, 0) <= 0 THEN 1 ELSE 0 END), 0) as produtos_zerados,
+            COALESCE(SUM(CASE WHEN COALESCE(s.saldo, 0) > 0 AND COALESCE(s.saldo, 0) < 10 THEN 1 ELSE 0 END), 0) as produtos_baixos,
+            COALESCE(SUM(CASE WHEN COALESCE(s.saldo, 0) >= 10 THEN 1 ELSE 0 END), 0) as produtos_ok
         FROM produtos p
-        LEFT JOIN saldos s ON p.id = s.produto_id
+        LEFT JOIN estoque_saldos_produto s ON p.id = s.produto_id
         WHERE p.ativo = 1
     '''
     
-    stats = dict(db.execute(sql_stats).fetchone())
+    stats = agregar_com_cache(db, sql_stats, [], versao_estoque)
     
     # Buscar categorias para o filtro
     categorias = [dict(r) for r in db.execute('''
@@ -3006,8 +2595,8 @@ def estoque_atual():
         produtos=produtos,
         categorias=categorias,
         stats=stats,
-        pagina_atual=pagina,
-        total_paginas=total_paginas,
+        paginacao=paginacao,
+        total_itens=total_itens,
         filtros={
             'busca': busca,
             'status': status,
@@ -3044,12 +2633,10 @@ def produto_kardex(produto_id):
             p.ativo,
             u.sigla as unidade_sigla,
             u.nome as unidade_nome,
-            COALESCE(
-                (SELECT SUM(saldo) FROM estoque_saldos WHERE produto_id = p.id),
-                0
-            ) as estoque_atual
+            COALESCE(rs.saldo, 0) as estoque_atual
         FROM produtos p
         LEFT JOIN unidades_medida u ON p.id_unidade_padrao = u.id
+        LEFT JOIN estoque_saldos_produto rs ON rs.produto_id = p.id
         WHERE p.id = ?
     ''', (produto_id,)).fetchone()
     
@@ -3059,67 +2646,59 @@ def produto_kardex(produto_id):
     
     produto = dict(produto_row)
     
-    # Calcular SALDO INICIAL (antes do período filtrado)
-    # Se não houver filtro de data_inicio, saldo inicial = 0 (começou do zero)
-    # Se houver filtro, somar todas movimentações ANTES da data_inicio
+    # SALDO INICIAL: checkpoint mensal + movimentações do mês até data_inicio (0 sem filtro)
     saldo_inicial = 0.0
+    valor_saldo_inicial = 0.0
     if data_inicio:
-        sql_saldo_inicial = '''
-            SELECT 
-                COALESCE(SUM(CASE WHEN tipo = 'ENTRADA' THEN quantidade ELSE -quantidade END), 0) as saldo
-            FROM movimentacoes
-            WHERE id_produto = ? AND DATE(data_movimento) < ?
-        '''
-        resultado = db.execute(sql_saldo_inicial, (produto_id, data_inicio)).fetchone()
-        saldo_inicial = float(resultado['saldo'])
+        inicial = saldo_em(db, data_inicio, produto_id=produto_id)
+        saldo_inicial = inicial['saldo']
+        valor_saldo_inicial = inicial['valor_total']
     
     # Construir filtros WHERE para as movimentações
     where_clauses = ['m.id_produto = ?']
     params = [produto_id]
     
-    if data_inicio:
-        where_clauses.append("DATE(m.data_movimento) >= ?")
-        params.append(data_inicio)
-    
-    if data_fim:
-        where_clauses.append("DATE(m.data_movimento) <= ?")
-        params.append(data_fim)
+    clausulas_periodo, params_periodo = filtro_periodo('m.data_movimento', data_inicio, data_fim)
+    where_clauses.extend(clausulas_periodo)
+    params.extend(params_periodo)
     
     where_sql = ' AND '.join(where_clauses)
     
-    # Buscar movimentações do período filtrado
+    # Paginação por cursor: a próxima página começa antes da última movimentação exibida
+    antes_de = request.args.get('antes_de', type=int)
+    where_pagina = where_sql
+    params_pagina = list(params)
+    if antes_de:
+        where_pagina += ' AND (m.data_movimento, m.id) < (SELECT data_movimento, id FROM movimentacoes WHERE id = ?)'
+        params_pagina.append(antes_de)
+    
+    # Página do período (mais recentes primeiro); o saldo já vem gravado em saldo_apos
     sql_movimentacoes = f'''
-        SELECT 
+        SELECT
             m.*,
             u.nome as usuario_nome
         FROM movimentacoes m
         LEFT JOIN usuarios u ON m.id_usuario = u.id
-        WHERE {where_sql}
+        WHERE {where_pagina}
         ORDER BY m.data_movimento DESC, m.id DESC
+        LIMIT ?
     '''
     
-    movimentacoes_raw = db.execute(sql_movimentacoes, params).fetchall()
+    movimentacoes_raw = db.execute(sql_movimentacoes, params_pagina + [KARDEX_POR_PAGINA + 1]).fetchall()
     
-    # Calcular saldo após cada movimentação (do mais antigo para o mais novo)
     movimentacoes_lista = []
-    saldo_calculado = saldo_inicial  # Começar do saldo inicial (0 se sem filtro)
-    
-    # Inverter para calcular do mais antigo para o mais novo
-    for mov in reversed(list(movimentacoes_raw)):
+    for mov in movimentacoes_raw[:KARDEX_POR_PAGINA]:
         mov_dict = dict(mov)
-        
-        # A quantidade já está convertida no banco
-        if mov_dict['tipo'] == 'ENTRADA':
-            saldo_calculado += mov_dict['quantidade']
-        else:  # SAIDA
-            saldo_calculado -= mov_dict['quantidade']
-        
-        mov_dict['saldo'] = round(saldo_calculado, 2)
-        movimentacoes_lista.insert(0, mov_dict)  # Reinserir na ordem original
+        mov_dict['saldo'] = round(float(mov_dict['saldo_apos'] or 0), 2)
+        movimentacoes_lista.append(mov_dict)
+    
+    proximo_cursor = None
+    if len(movimentacoes_raw) > KARDEX_POR_PAGINA:
+        proximo_cursor = movimentacoes_lista[-1]['id']
     
     # Estatísticas do período filtrado
     sql_stats = f'''
-        SELECT 
+        SELECT
             SUM(CASE WHEN m.tipo = 'ENTRADA' THEN m.quantidade ELSE 0 END) as total_entradas,
             SUM(CASE WHEN m.tipo = 'SAIDA' THEN m.quantidade ELSE 0 END) as total_saidas,
             COUNT(*) as total_movimentacoes,
@@ -3133,9 +2712,20 @@ def produto_kardex(produto_id):
     '''
     stats = dict(db.execute(sql_stats, params).fetchone())
     
+    # SALDO FINAL = saldo gravado na última movimentação do período
+    ultima = db.execute(f'''
+        SELECT m.saldo_apos
+        FROM movimentacoes m
+        WHERE {where_sql}
+        ORDER BY m.data_movimento DESC, m.id DESC
+        LIMIT 1
+    ''', params).fetchone()
+    saldo_final = float(ultima['saldo_apos'] or 0) if ultima else saldo_inicial
+    
     # Adicionar saldo inicial e final às estatísticas
     stats['saldo_inicial'] = round(saldo_inicial, 2)
-    stats['saldo_final'] = round(saldo_calculado, 2)
+    stats['valor_saldo_inicial'] = round(valor_saldo_inicial, 2)
+    stats['saldo_final'] = round(saldo_final, 2)
     
     return render_template(
         'admin/produto_kardex.html',
@@ -3146,6 +2736,8 @@ def produto_kardex(produto_id):
             'data_inicio': data_inicio,
             'data_fim': data_fim
         },
+        antes_de=antes_de,
+        proximo_cursor=proximo_cursor,
         is_gerente=True
     )
 
@@ -3160,7 +2752,6 @@ def admin_fornecedores():
     if not gerente_required():
         return redirect(url_for('auth.login_admin'))
     db = get_db()
-    ensure_finance_schema(db)
     fornecedores = [dict(r) for r in db.execute('SELECT * FROM fornecedores ORDER BY nome').fetchall()]
     return render_template('admin/fornecedores.html', fornecedores=fornecedores, is_gerente=True)
 
@@ -3170,7 +2761,6 @@ def salvar_fornecedor():
     if not gerente_required():
         return redirect(url_for('auth.login_admin'))
     db = get_db()
-    ensure_finance_schema(db)
     fid = request.form.get('id')
     nome = (request.form.get('nome') or '').strip()
     cnpj = (request.form.get('cnpj') or '').strip()
@@ -3199,6 +2789,7 @@ def salvar_fornecedor():
 def importar_fornecedores():
     if not gerente_required():
         return redirect(url_for('auth.login_admin'))
+    import pandas as pd
     file = request.files.get('arquivo')
     if not file or not file.filename.endswith(('.xlsx', '.xls')):
         flash('Envie um arquivo .xlsx', 'error')
@@ -3209,7 +2800,6 @@ def importar_fornecedores():
         flash(f'Erro ao ler arquivo: {exc}', 'error')
         return redirect(url_for('admin.admin_fornecedores'))
     db = get_db()
-    ensure_finance_schema(db)
     criados = 0
     atualizados = 0
     for _, row in df.iterrows():
@@ -3240,6 +2830,8 @@ def modelo_fornecedores():
     if not gerente_required():
         return redirect(url_for('auth.login_admin'))
 
+    import pandas as pd
+
     df = pd.DataFrame([
         {'NOME': 'Padaria Exemplo', 'CNPJ': '00.000.000/0000-00', 'IE': 'ISENTO', 'CONTATO': '(11) 99999-9999', 'ATIVO': 1},
         {'NOME': 'Fornecedor B', 'CNPJ': '', 'IE': '', 'CONTATO': 'fornecedor@exemplo.com', 'ATIVO': 1},
@@ -3263,7 +2855,6 @@ def admin_planos_contas():
     if not gerente_required():
         return redirect(url_for('auth.login_admin'))
     db = get_db()
-    ensure_finance_schema(db)
     planos = [dict(r) for r in db.execute('SELECT * FROM planos_contas ORDER BY descricao').fetchall()]
     return render_template('admin/planos_contas.html', planos=planos, is_gerente=True)
 
@@ -3273,7 +2864,6 @@ def salvar_plano_contas():
     if not gerente_required():
         return redirect(url_for('auth.login_admin'))
     db = get_db()
-    ensure_finance_schema(db)
     pid = request.form.get('id')
     codigo = (request.form.get('codigo') or '').strip()
     descricao = (request.form.get('descricao') or '').strip()
@@ -3301,6 +2891,7 @@ def salvar_plano_contas():
 def importar_planos_contas():
     if not gerente_required():
         return redirect(url_for('auth.login_admin'))
+    import pandas as pd
     file = request.files.get('arquivo')
     if not file or not file.filename.endswith(('.xlsx', '.xls')):
         flash('Envie um arquivo .xlsx', 'error')
@@ -3311,7 +2902,6 @@ def importar_planos_contas():
         flash(f'Erro ao ler arquivo: {exc}', 'error')
         return redirect(url_for('admin.admin_planos_contas'))
     db = get_db()
-    ensure_finance_schema(db)
     criados, atualizados = 0, 0
     for _, row in df.iterrows():
         descricao = str(row.get('DESCRICAO', '')).strip() or str(row.get('DESCRIÇÃO', '')).strip()
@@ -3340,6 +2930,8 @@ def modelo_planos_contas():
     if not gerente_required():
         return redirect(url_for('auth.login_admin'))
 
+    import pandas as pd
+
     df = pd.DataFrame([
         {'CODIGO': '1.1.1', 'DESCRICAO': 'Matéria-prima', 'TIPO': 'Despesa', 'ATIVO': 1},
         {'CODIGO': '1.1.2', 'DESCRICAO': 'Energia elétrica', 'TIPO': 'Despesa', 'ATIVO': 1},
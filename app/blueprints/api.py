@@ -1,39 +1,15 @@
 import io
+import json
 import os
 import uuid
-from flask import Blueprint, jsonify, request, session, send_file
+from flask import Blueprint, Response, current_app, jsonify, request, session, send_file
+from ..busca_produtos import sql_busca
 from ..db import get_db
+from ..eventos import ler_versao, obter_monitor
 
 bp = Blueprint('api', __name__, url_prefix='/api')
 
 
-def _ensure_finance_schema(db):
-    # Reutiliza lógica mínima para garantir tabelas catálogos.
-    db.execute('''
-        CREATE TABLE IF NOT EXISTS fornecedores (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nome TEXT NOT NULL,
-            cnpj TEXT,
-            ie TEXT,
-            contato TEXT,
-            ativo INTEGER NOT NULL DEFAULT 1,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            updated_at TEXT
-        )
-    ''')
-    db.execute('''
-        CREATE TABLE IF NOT EXISTS planos_contas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            codigo TEXT,
-            descricao TEXT NOT NULL,
-            tipo TEXT,
-            ativo INTEGER NOT NULL DEFAULT 1,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            updated_at TEXT
-        )
-    ''')
-
-
 @bp.route('/detalhes_local/<int:local_id>')
 def api_detalhes_local(local_id):
     if not session.get('is_gerente'):
@@ -66,7 +42,6 @@ def api_detalhes_local(local_id):
 @bp.route('/fornecedores')
 def api_listar_fornecedores():
     db = get_db()
-    _ensure_finance_schema(db)
     ativos = request.args.get('ativos')
     if ativos is not None:
         rows = db.execute('SELECT id, nome, cnpj, ativo FROM fornecedores WHERE ativo = 1 ORDER BY nome').fetchall()
@@ -78,7 +53,6 @@ def api_listar_fornecedores():
 @bp.route('/planos_contas')
 def api_listar_planos_contas():
     db = get_db()
-    _ensure_finance_schema(db)
     ativos = request.args.get('ativos')
     if ativos is not None:
         rows = db.execute('SELECT id, codigo, descricao, ativo FROM planos_contas WHERE ativo = 1 ORDER BY descricao').fetchall()
@@ -327,20 +301,117 @@ def api_rejeitar_ocorrencia(id_ocorrencia):
 def heartbeat():
     try:
         db = get_db()
-        inv = db.execute("SELECT id FROM inventarios WHERE status='Aberto' LIMIT 1").fetchone()
-        if not inv:
+        versao, inventario_id = ler_versao(db)
+        if not inventario_id:
             return jsonify({'ativo': False})
-
-        qtd_contagens = db.execute("SELECT COUNT(*) FROM contagens WHERE id_inventario = ?", (inv['id'],)).fetchone()[0]
-        qtd_ocorrencias = db.execute("SELECT COUNT(*) FROM ocorrencias WHERE id_inventario = ?", (inv['id'],)).fetchone()[0]
-        qtd_locais_finalizados = db.execute("SELECT COUNT(*) FROM locais WHERE status = 2").fetchone()[0]
-        versao_dados = qtd_contagens + qtd_ocorrencias + qtd_locais_finalizados
-        return jsonify({'ativo': True, 'versao': versao_dados})
+        return jsonify({'ativo': True, 'versao': versao})
     except Exception as exc:
         print(f"Erro no heartbeat: {exc}")
         return jsonify({'ativo': False})
 
 
+@bp.route('/eventos')
+def api_eventos():
+    """
+    Server-Sent Events para as telas do gerente: um evento 'versao' com
+    {versao, ativo, progresso} na conexão e a cada mudança dos dados.
+    """
+    if not session.get('is_gerente'):
+        return jsonify({'erro': 'Acesso negado'}), 403
+
+    monitor = obter_monitor(current_app._get_current_object())
+
+    def gerar():
+        yield 'retry: 5000\n\n'
+        for evento in monitor.assinar():
+            if evento is None:
+                yield ': keepalive\n\n'
+                continue
+            yield f"id: {evento['versao']}\nevent: versao\ndata: {json.dumps(evento)}\n\n"
+
+    return Response(gerar(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+@bp.route('/catalogo')
+def api_catalogo():
+    """
+    Catálogo de produtos para a tela de contagem, versionado.
+
+    Sem parâmetros, devolve o catálogo completo (produtos ativos). Com
+    ?desde=N, devolve só os produtos alterados depois da versão N (inclusive
+    os desativados, com ativo = 0) e os ids excluídos. Responde 304 se o
+    If-None-Match do tablet já corresponder à versão atual.
+    """
+    db = get_db()
+    versao = db.execute('SELECT versao FROM catalogo_versao WHERE id = 1').fetchone()['versao']
+    desde = request.args.get('desde', type=int)
+    completo = not desde or desde > versao
+
+    etag = f'catalogo-{versao}' if completo else f'catalogo-{desde}-{versao}'
+    if request.if_none_match.contains(etag):
+        resposta = Response(status=304)
+        resposta.set_etag(etag)
+        resposta.headers['Cache-Control'] = 'no-cache'
+        return resposta
+
+    if completo:
+        filtro_produtos, params = 'p.ativo = 1', []
+    else:
+        filtro_produtos, params = 'p.versao_catalogo > ?', [desde]
+
+    produtos = [dict(r) for r in db.execute(f'''
+        SELECT p.id, p.nome, p.id_erp, p.gtin, p.id_unidade_padrao, p.ativo
+        FROM produtos p
+        WHERE {filtro_produtos}
+        ORDER BY p.nome
+    ''', params).fetchall()]
+
+    mapa_unidades = {}
+    for row in db.execute(f'''
+        SELECT pu.*, u.sigla, u.nome, u.permite_decimal
+        FROM produtos_unidades pu
+        JOIN unidades_medida u ON pu.id_unidade = u.id
+        JOIN produtos p ON p.id = pu.id_produto
+        WHERE {filtro_produtos}
+    ''', params).fetchall():
+        mapa_unidades.setdefault(row['id_produto'], []).append(dict(row))
+
+    mapa_categorias = {}
+    for row in db.execute(f'''
+        SELECT pci.id_produto, pci.id_categoria
+        FROM produto_categoria_inventario pci
+        JOIN produtos p ON p.id = pci.id_produto
+        WHERE {filtro_produtos}
+    ''', params).fetchall():
+        mapa_categorias.setdefault(row['id_produto'], []).append(row['id_categoria'])
+
+    for prod in produtos:
+        prod['unidades_permitidas'] = mapa_unidades.get(prod['id'], [])
+        prod['categorias'] = mapa_categorias.get(prod['id'], [])
+
+    removidos = []
+    if not completo:
+        removidos = [r['produto_id'] for r in db.execute(
+            'SELECT produto_id FROM catalogo_removidos WHERE versao > ?', (desde,)
+        ).fetchall()]
+
+    unidades = [dict(r) for r in db.execute('SELECT * FROM unidades_medida ORDER BY sigla').fetchall()]
+
+    resposta = jsonify({
+        'versao': versao,
+        'completo': completo,
+        'produtos': produtos,
+        'removidos': removidos,
+        'unidades': unidades
+    })
+    resposta.set_etag(etag)
+    resposta.headers['Cache-Control'] = 'no-cache'
+    return resposta
+
+
 @bp.route('/produto/<int:produto_id>/unidades')
 def api_produto_unidades(produto_id):
     """
@@ -485,8 +556,12 @@ def api_produtos_buscar():
     
     db = get_db()
     
-    # Busca por nome, ID ERP ou GTIN (case-insensitive)
-    produtos = db.execute('''
+    # Código exato (ERP/GTIN) primeiro, depois índice FTS por relevância
+    sql_filtro, params_filtro = sql_busca(termo)
+    if sql_filtro is None:
+        return jsonify([])
+
+    produtos = db.execute(f'''
         SELECT 
             p.id,
             p.nome,
@@ -496,17 +571,13 @@ def api_produtos_buscar():
             p.preco_custo,
             u.sigla as unidade_simbolo,
             u.nome as unidade_nome
-        FROM produtos p
+        FROM ({sql_filtro}) busca
+        JOIN produtos p ON p.id = busca.produto_id
         LEFT JOIN unidades_medida u ON p.id_unidade_padrao = u.id
         WHERE p.ativo = 1
-          AND (
-              p.nome LIKE ? OR
-              p.id_erp LIKE ? OR
-              p.gtin LIKE ?
-          )
-        ORDER BY p.nome
+        ORDER BY busca.relevancia, p.nome
         LIMIT 20
-    ''', (f'%{termo}%', f'%{termo}%', f'%{termo}%')).fetchall()
+    ''', params_filtro).fetchall()
     
     return jsonify([
         {
@@ -521,3 +592,42 @@ def api_produtos_buscar():
         }
         for prod in produtos
     ])
+
+
+@bp.route('/estoque/em')
+def api_estoque_em():
+    """
+    Posição do estoque (quantidade e valor a custo médio) em uma data ou instante.
+    Parâmetros: ?data=YYYY-MM-DD (fim do dia) ou YYYY-MM-DDTHH:MM[:SS],
+    e opcionalmente ?produto_id=X ou ?categoria_id=X.
+    """
+    if not session.get('is_gerente'):
+        return jsonify({'erro': 'Acesso negado'}), 403
+
+    from datetime import datetime
+    from ..fechamento_mensal import posicoes_em
+
+    data = request.args.get('data', '').strip()
+    produto_id = request.args.get('produto_id', type=int)
+    categoria_id = request.args.get('categoria_id', type=int)
+
+    if produto_id and categoria_id:
+        return jsonify({'erro': 'Informe produto_id ou categoria_id, não ambos'}), 400
+    try:
+        instante = datetime.fromisoformat(data)
+    except ValueError:
+        return jsonify({'erro': 'Parâmetro data inválido (use YYYY-MM-DD ou YYYY-MM-DDTHH:MM:SS)'}), 400
+    if len(data) == 10:
+        instante = instante.date()
+
+    db = get_db()
+    itens = posicoes_em(db, instante, produto_id=produto_id, categoria_id=categoria_id)
+    
+    return jsonify({
+        'data': instante.isoformat(),
+        'produto_id': produto_id,
+        'categoria_id': categoria_id,
+        'total_saldo': round(sum(i['saldo'] for i in itens), 4),
+        'total_valor': round(sum(i['valor_total'] for i in itens), 2),
+        'itens': itens
+    })
@@ -1,6 +1,9 @@
+import json
 from datetime import datetime
+from uuid import uuid4
 from flask import Blueprint, render_template, redirect, url_for, session, jsonify, request
-from ..db import get_db
+from ..db import get_db, iniciar_transacao_imediata
+from ..fechamento_inventario import job_ativo
 
 bp = Blueprint('estoque', __name__)
 
@@ -45,60 +48,179 @@ def contagem(local_id):
 
     local = db.execute("SELECT * FROM locais WHERE id = ?", (local_id,)).fetchone()
 
-    # Filtra produtos conforme tipo de inventário
+    # Catálogo (produtos e unidades) vem de /api/catalogo e fica em cache no tablet;
+    # inventário PARCIAL filtra pela categoria do escopo no cliente
+    categoria_escopo = None
     if inv['tipo_inventario'] == 'PARCIAL' and inv['id_categoria_escopo']:
-        # Inventário PARCIAL: busca apenas produtos da categoria selecionada
-        produtos = [dict(r) for r in db.execute('''
-            SELECT DISTINCT p.* 
-            FROM produtos p
-            INNER JOIN produto_categoria_inventario pci ON p.id = pci.id_produto
-            WHERE p.ativo = 1 
-              AND pci.id_categoria = ?
-            ORDER BY p.nome
-        ''', (inv['id_categoria_escopo'],)).fetchall()]
-        # AND (p.categoria IS NULL OR (UPPER(p.categoria) != 'NAO CONTA' AND UPPER(p.categoria) != 'NÃO CONTA'))
-    else:
-        # Inventário COMPLETO: busca todos os produtos ativos
-        produtos = [dict(r) for r in db.execute(
-            "SELECT * FROM produtos WHERE ativo=1 ORDER BY nome"
-            # (categoria IS NULL OR (UPPER(categoria) != 'NAO CONTA' AND UPPER(categoria) != 'NÃO CONTA'))
-        ).fetchall()]
-
-    unidades_rows = db.execute('''
-        SELECT pu.*, u.sigla, u.nome, u.permite_decimal 
-        FROM produtos_unidades pu JOIN unidades_medida u ON pu.id_unidade = u.id
-    ''').fetchall()
-
-    mapa_unidades = {}
-    for row in unidades_rows:
-        pid = row['id_produto']
-        if pid not in mapa_unidades:
-            mapa_unidades[pid] = []
-        mapa_unidades[pid].append(dict(row))
-
-    for prod in produtos:
-        prod['unidades_permitidas'] = mapa_unidades.get(prod['id'], [])
-
-    unidades = [dict(r) for r in db.execute("SELECT * FROM unidades_medida ORDER BY sigla").fetchall()]
-
-    historico = db.execute('''
-        SELECT c.*, p.nome as produto_nome, u.sigla as unidade_sigla 
-        FROM contagens c 
-        JOIN produtos p ON c.id_produto = p.id
-        JOIN unidades_medida u ON c.id_unidade_usada = u.id
-        WHERE c.id_local = ? AND c.id_inventario = ? ORDER BY c.id DESC
-    ''', (local_id, inv['id'])).fetchall()
+        categoria_escopo = inv['id_categoria_escopo']
 
     return render_template(
         'estoque/contagem.html',
         local=dict(local),
-        produtos=produtos,
-        unidades=unidades,
-        historico=[dict(h) for h in historico],
+        categoria_escopo=categoria_escopo,
+        historico=_historico_local(db, inv['id'], local_id),
         inventario_id=inv['id']
     )
 
 
+def _historico_local(db, inventario_id, local_id, desde_id=0, uuid=None):
+    """Contagens do local no inventário (mais recentes primeiro), só as de id > desde_id ou a de um uuid."""
+    filtros = ['c.id_inventario = ?', 'c.id_local = ?', 'c.id > ?']
+    params = [inventario_id, local_id, desde_id]
+    if uuid:
+        filtros.append('c.uuid = ?')
+        params.append(uuid)
+
+    historico = db.execute(f'''
+        SELECT c.*, p.nome as produto_nome, u.sigla as unidade_sigla 
+        FROM contagens c 
+        JOIN produtos p ON c.id_produto = p.id
+        JOIN unidades_medida u ON c.id_unidade_usada = u.id
+        WHERE {' AND '.join(filtros)}
+        ORDER BY c.id DESC
+    ''', params).fetchall()
+    return [dict(h) for h in historico]
+
+
+@bp.route('/contagem/<int:local_id>/historico')
+def historico_contagem(local_id):
+    """Contagens do local gravadas depois de ?desde=<id> (atualização incremental da tela)."""
+    db = get_db()
+    inv = db.execute("SELECT id FROM inventarios WHERE status='Aberto' LIMIT 1").fetchone()
+    if not inv:
+        return jsonify({'erro': 'Nenhum inventário aberto no momento'}), 400
+
+    desde_id = request.args.get('desde', 0, type=int)
+    itens = _historico_local(db, inv['id'], local_id, desde_id)
+    return jsonify({
+        'itens': itens,
+        'ultimo_id': itens[0]['id'] if itens else desde_id
+    })
+
+
+def _gravar_contagens(db, inventario_id, usuario_id, itens):
+    """
+    Grava contagens em lote, sem commit. Fatores de conversão, custo e sigla
+    padrão de todos os produtos vêm de uma única consulta e a inserção é um
+    executemany. Itens cujo uuid já foi gravado são ignorados (reenvio da
+    fila offline após resposta perdida).
+
+    Returns:
+        tuple: (gravados, duplicados, rejeitados); rejeitados é uma lista
+        de {'uuid', 'erro'}
+    """
+    ids_produtos = set()
+    for item in itens:
+        try:
+            ids_produtos.add(int(item['produto_id']))
+        except (KeyError, TypeError, ValueError):
+            pass
+    uuids = [item['uuid'] for item in itens if item.get('uuid')]
+
+    produtos = {}
+    for row in db.execute('''
+        SELECT p.id, p.preco_custo, p.id_unidade_padrao, u.sigla as sigla_padrao,
+               pu.id_unidade, pu.fator_conversao
+        FROM produtos p
+        JOIN unidades_medida u ON p.id_unidade_padrao = u.id
+        LEFT JOIN produtos_unidades pu ON pu.id_produto = p.id
+        WHERE p.id IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(sorted(ids_produtos)),)).fetchall():
+        produto = produtos.setdefault(row['id'], {
+            'preco_custo': float(row['preco_custo'] or 0),
+            'id_unidade_padrao': int(row['id_unidade_padrao']),
+            'sigla_padrao': row['sigla_padrao'],
+            'fatores': {}
+        })
+        if row['id_unidade'] is not None:
+            produto['fatores'][int(row['id_unidade'])] = float(row['fator_conversao'])
+
+    ja_gravados = {row['uuid'] for row in db.execute(
+        'SELECT uuid FROM contagens WHERE uuid IN (SELECT value FROM json_each(?))',
+        (json.dumps(uuids),)
+    ).fetchall()}
+
+    agora = datetime.now().isoformat()
+    gravados, duplicados, rejeitados = [], [], []
+    linhas, locais = [], set()
+    for item in itens:
+        uuid = item.get('uuid')
+        if uuid and uuid in ja_gravados:
+            duplicados.append(uuid)
+            continue
+        try:
+            produto_id = int(item['produto_id'])
+            local_id = int(item['local_id'])
+            id_unidade_usada = int(item['unidade_id'])
+            qtd_informada = float(item['quantidade'])
+        except (KeyError, TypeError, ValueError):
+            rejeitados.append({'uuid': uuid, 'erro': 'Dados inválidos'})
+            continue
+
+        produto = produtos.get(produto_id)
+        if not produto:
+            rejeitados.append({'uuid': uuid, 'erro': 'Produto não encontrado'})
+            continue
+
+        fator_conversao = 1.0
+        if id_unidade_usada != produto['id_unidade_padrao']:
+            fator_conversao = produto['fatores'].get(id_unidade_usada, 1.0)
+
+        linhas.append((
+            inventario_id,
+            produto_id,
+            local_id,
+            usuario_id,
+            qtd_informada,
+            id_unidade_usada,
+            agora,
+            fator_conversao,
+            qtd_informada * fator_conversao,
+            produto['preco_custo'],
+            produto['sigla_padrao'],
+            uuid
+        ))
+        locais.add(local_id)
+        if uuid:
+            ja_gravados.add(uuid)
+            gravados.append(uuid)
+
+    db.executemany('''
+        INSERT INTO contagens (
+            id_inventario, id_produto, id_local, id_usuario,
+            quantidade, id_unidade_usada, data_hora,
+            fator_conversao, quantidade_padrao, preco_custo_snapshot, unidade_padrao_sigla,
+            uuid
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', linhas)
+    db.executemany(
+        "UPDATE locais SET status = 1 WHERE id = ? AND status = 0",
+        [(local_id,) for local_id in sorted(locais)]
+    )
+    return gravados, duplicados, rejeitados
+
+
+def _recusar_fila(db, itens, erro):
+    """
+    Resposta 409 para a fila de um inventário que não aceita mais contagens
+    (fechado ou em fechamento): recusa definitiva, para o tablet não reenviar.
+    Uuids que já tinham sido gravados voltam como duplicados.
+    """
+    uuids = [item['uuid'] for item in itens]
+    ja_gravados = {row['uuid'] for row in db.execute(
+        'SELECT uuid FROM contagens WHERE uuid IN (SELECT value FROM json_each(?))',
+        (json.dumps(uuids),)
+    ).fetchall()}
+    return jsonify({
+        'sucesso': False,
+        'erro': erro,
+        'gravados': [],
+        'duplicados': [uuid for uuid in uuids if uuid in ja_gravados],
+        'rejeitados': [{'uuid': uuid, 'erro': erro} for uuid in uuids if uuid not in ja_gravados]
+    }), 409
+
+
 @bp.route('/salvar_contagem', methods=['POST'])
 def salvar_contagem():
     if 'user_id' not in session:
@@ -111,57 +233,22 @@ def salvar_contagem():
         if not inv:
             return jsonify({'erro': 'Nenhum inventário aberto no momento'}), 400
 
-        produto = db.execute('''
-            SELECT p.preco_custo, p.id_unidade_padrao, u.sigla as sigla_padrao
-            FROM produtos p
-            JOIN unidades_medida u ON p.id_unidade_padrao = u.id
-            WHERE p.id = ?
-        ''', (data['produto_id'],)).fetchone()
-
-        if not produto:
-            return jsonify({'erro': 'Produto não encontrado'}), 404
+        # Sem uuid do tablet, gera um para devolver a linha gravada
+        data['uuid'] = data.get('uuid') or str(uuid4())
 
-        fator_conversao = 1.0
-        id_unidade_usada = int(data['unidade_id'])
-        id_unidade_padrao = int(produto['id_unidade_padrao'])
-
-        if id_unidade_usada != id_unidade_padrao:
-            fator_row = db.execute('''
-                SELECT fator_conversao FROM produtos_unidades 
-                WHERE id_produto = ? AND id_unidade = ?
-            ''', (data['produto_id'], id_unidade_usada)).fetchone()
-            if fator_row:
-                fator_conversao = float(fator_row['fator_conversao'])
-
-        qtd_informada = float(data['quantidade'])
-        qtd_padrao_calculada = qtd_informada * fator_conversao
-        preco_snapshot = float(produto['preco_custo'] or 0)
-        sigla_snapshot = produto['sigla_padrao']
-
-        db.execute('''
-            INSERT INTO contagens (
-                id_inventario, id_produto, id_local, id_usuario, 
-                quantidade, id_unidade_usada, data_hora,
-                fator_conversao, quantidade_padrao, preco_custo_snapshot, unidade_padrao_sigla
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            inv['id'],
-            data['produto_id'],
-            data['local_id'],
-            session['user_id'],
-            qtd_informada,
-            id_unidade_usada,
-            datetime.now().isoformat(),
-            fator_conversao,
-            qtd_padrao_calculada,
-            preco_snapshot,
-            sigla_snapshot
-        ))
+        iniciar_transacao_imediata(db)
+        if job_ativo(db, inv['id']):
+            db.rollback()
+            return jsonify({'erro': 'Inventário em fechamento: contagens bloqueadas'}), 409
+        _, _, rejeitados = _gravar_contagens(db, inv['id'], session['user_id'], [data])
+        if rejeitados:
+            db.rollback()
+            erro = rejeitados[0]['erro']
+            return jsonify({'erro': erro}), 404 if erro == 'Produto não encontrado' else 400
 
-        db.execute("UPDATE locais SET status = 1 WHERE id = ? AND status = 0", (data['local_id'],))
         db.commit()
-        return jsonify({'sucesso': True})
+        gravada = _historico_local(db, inv['id'], int(data['local_id']), uuid=data['uuid'])
+        return jsonify({'sucesso': True, 'contagem': gravada[0] if gravada else None})
 
     except Exception as exc:
         db.rollback()
@@ -169,6 +256,50 @@ def salvar_contagem():
         return jsonify({'erro': str(exc)}), 500
 
 
+@bp.route('/salvar_contagens', methods=['POST'])
+def salvar_contagens():
+    """
+    Recebe a fila offline do tablet de uma vez: {'contagens': [{uuid, produto_id,
+    local_id, quantidade, unidade_id}, ...]}, gravada numa única
+    transação. Responde os uuids gravados, os já existentes (reenvio) e os
+    rejeitados, para que o tablet tire da fila os dois primeiros. Sem
+    inventário aberto, ou com o fechamento em andamento, responde 409 com
+    todos os pendentes em 'rejeitados' (não adianta reenviar).
+    """
+    if 'user_id' not in session:
+        return jsonify({'erro': 'Login necessário'}), 401
+    data = request.get_json(silent=True) or {}
+    itens = data.get('contagens') if isinstance(data, dict) else data
+    if not isinstance(itens, list) or not itens:
+        return jsonify({'erro': 'Nenhuma contagem enviada'}), 400
+    if not all(isinstance(item, dict) and item.get('uuid') for item in itens):
+        return jsonify({'erro': 'Toda contagem precisa de uuid'}), 400
+
+    db = get_db()
+    try:
+        inv = db.execute("SELECT id FROM inventarios WHERE status='Aberto' LIMIT 1").fetchone()
+        if not inv:
+            return _recusar_fila(db, itens, 'Nenhum inventário aberto no momento')
+
+        iniciar_transacao_imediata(db)
+        if job_ativo(db, inv['id']):
+            db.rollback()
+            return _recusar_fila(db, itens, 'Inventário em fechamento: contagens bloqueadas')
+        gravados, duplicados, rejeitados = _gravar_contagens(db, inv['id'], session['user_id'], itens)
+        db.commit()
+        return jsonify({
+            'sucesso': True,
+            'gravados': gravados,
+            'duplicados': duplicados,
+            'rejeitados': rejeitados
+        })
+
+    except Exception as exc:
+        db.rollback()
+        print(f"Erro ao salvar contagens: {exc}")
+        return jsonify({'erro': str(exc)}), 500
+
+
 @bp.route('/finalizar_local/<int:local_id>', methods=['POST'])
 def finalizar_local(local_id):
     db = get_db()
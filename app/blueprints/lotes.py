@@ -2,85 +2,20 @@
 Blueprint para Lotes de Movimentação em massa.
 Suporta ENTRADA, SAÍDA e TRANSFERÊNCIA com controle multi-nível (CENTRAL/SETOR/LOCAL).
 """
+import json
 from datetime import datetime
 from flask import Blueprint, request, jsonify, session
-from ..db import get_db
+from ..db import get_db, iniciar_transacao_imediata
+from ..configuracoes import configuracoes
 from ..utils import (
-    obter_nivel_controle, validar_localizacao, obter_saldo, 
-    ajustar_saldo, obter_requer_aprovacao, obter_custo_medio
+    obter_nivel_controle, validar_localizacao, validar_saldos_lote,
+    obter_saldos_posicoes, faltas_na_posicao, obter_requer_aprovacao, registrar_movimentos
 )
 
 bp = Blueprint('lotes', __name__, url_prefix='/lotes')
 
-
-def ensure_finance_schema(db):
-    """Garante tabelas/colunas usadas pelo módulo financeiro."""
-    # Coluna de flag de exportação
-    cols = [row['name'] for row in db.execute('PRAGMA table_info(lotes_movimentacao)').fetchall()]
-    if 'exportado_financeiro' not in cols:
-        db.execute("ALTER TABLE lotes_movimentacao ADD COLUMN exportado_financeiro INTEGER NOT NULL DEFAULT 0")
-
-    # Tabelas de referência
-    db.execute('''
-        CREATE TABLE IF NOT EXISTS fornecedores (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nome TEXT NOT NULL,
-            cnpj TEXT,
-            ie TEXT,
-            contato TEXT,
-            ativo INTEGER NOT NULL DEFAULT 1,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            updated_at TEXT
-        )
-    ''')
-
-    db.execute('''
-        CREATE TABLE IF NOT EXISTS planos_contas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            codigo TEXT,
-            descricao TEXT NOT NULL,
-            tipo TEXT,
-            ativo INTEGER NOT NULL DEFAULT 1,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            updated_at TEXT
-        )
-    ''')
-
-    # Tabela de dados financeiros do lote
-    db.execute('''
-        CREATE TABLE IF NOT EXISTS compras_lote (
-            id_lote INTEGER PRIMARY KEY,
-            id_fornecedor INTEGER NOT NULL,
-            id_plano_contas INTEGER NOT NULL,
-            num_doc TEXT,
-            observacao TEXT,
-            valor_total REAL NOT NULL,
-            data_emissao TEXT,
-            data_vencimento TEXT,
-            data_pagamento TEXT,
-            valor_pago REAL,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            updated_at TEXT,
-            FOREIGN KEY (id_lote) REFERENCES lotes_movimentacao(id),
-            FOREIGN KEY (id_fornecedor) REFERENCES fornecedores(id),
-            FOREIGN KEY (id_plano_contas) REFERENCES planos_contas(id)
-        )
-    ''')
-
-    # Parcelas
-    db.execute('''
-        CREATE TABLE IF NOT EXISTS compras_parcelas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            id_lote INTEGER NOT NULL,
-            parcela_num INTEGER NOT NULL,
-            valor REAL NOT NULL,
-            data_vencimento TEXT NOT NULL,
-            data_pagamento TEXT,
-            valor_pago REAL,
-            FOREIGN KEY (id_lote) REFERENCES lotes_movimentacao(id)
-        )
-    ''')
-    db.execute('CREATE INDEX IF NOT EXISTS idx_compras_parcelas_lote ON compras_parcelas(id_lote)')
+# Aprovação em lote: ENTRADA fica fora, pois passa pelos dados financeiros na tela do lote
+TIPOS_APROVACAO_EM_LOTE = ('SAIDA', 'TRANSFERENCIA')
 
 
 def gerente_required():
@@ -96,21 +31,143 @@ def obter_permite_estoque_negativo(db):
     Returns:
         bool: True se permite estoque negativo, False caso contrário
     """
-    from dotenv import load_dotenv
-    import os
-    
-    load_dotenv()
-    permite_env = os.getenv('PERMITIR_ESTOQUE_NEGATIVO', '').strip()
+    permite_env = configuracoes.env('PERMITIR_ESTOQUE_NEGATIVO')
     
     if permite_env in ['0', '1']:
         return bool(int(permite_env))
     
     # Fallback: consultar banco de dados
-    config = db.execute(
-        "SELECT valor FROM configs WHERE chave = 'PERMITIR_ESTOQUE_NEGATIVO'"
-    ).fetchone()
-    
-    return bool(int(config['valor'])) if config else False
+    config = configuracoes.config_db(db, 'PERMITIR_ESTOQUE_NEGATIVO')
+    
+    return bool(int(config)) if config else False
+
+
+def _itens_para_movimento(lote, itens):
+    """Converte os itens de um lote no formato de registrar_movimentos()."""
+    id_lote = lote['id']
+    if lote['tipo'] == 'TRANSFERENCIA':
+        origem = f"Transferência Lote #{id_lote}"
+    else:
+        origem = lote['origem'] or f"Lote #{id_lote}"
+
+    return [
+        {
+            'produto_id': item['id_produto'],
+            'tipo': lote['tipo'],
+            'quantidade_original': item['quantidade_original'],
+            'motivo': lote['motivo'],
+            'unidade_movimentacao': item['unidade_movimentacao'],
+            'fator_conversao': item['fator_conversao'],
+            # ENTRADA: custo informado no item ou custo cadastrado do produto
+            'custo_unitario': item['preco_custo_unitario'] or item['preco_custo'] or 0.0,
+            'setor_origem_id': lote['setor_origem_id'],
+            'local_origem_id': lote['local_origem_id'],
+            'setor_destino_id': lote['setor_destino_id'],
+            'local_destino_id': lote['local_destino_id'],
+            'origem': origem,
+            'usuario_id': session.get('user_id'),
+            'observacao': f"Lote #{id_lote}"
+        }
+        for item in itens
+    ]
+
+
+def _faltas_estoque_lote(db, lote, itens, nivel):
+    """
+    Produtos sem saldo suficiente na origem de um lote de SAIDA ou TRANSFERENCIA.
+    Linhas repetidas do mesmo produto são somadas antes da comparação e todas
+    as posições vêm de uma única leitura (validar_saldos_lote).
+
+    Returns:
+        list: faltas (ver validar_saldos_lote); vazia se não há o que validar
+    """
+    if lote['tipo'] not in ('SAIDA', 'TRANSFERENCIA'):
+        return []
+    if lote['tipo'] == 'TRANSFERENCIA' and nivel == 'CENTRAL':
+        return []  # TRANSFERENCIA não se aplica a CENTRAL
+    if obter_permite_estoque_negativo(db):
+        return []
+
+    quantidades = {}
+    for item in itens:
+        if not item['controla_estoque']:
+            continue
+        qtd_convertida = item['quantidade_original'] * item['fator_conversao']
+        quantidades[item['id_produto']] = quantidades.get(item['id_produto'], 0.0) + qtd_convertida
+
+    return validar_saldos_lote(db, quantidades, lote['setor_origem_id'], lote['local_origem_id'], nivel)
+
+
+def _texto_faltas(faltas, titulo):
+    """Texto das faltas para o alerta: uma linha por produto."""
+    linhas = [
+        f"- {f['produto_nome']}: Disponível: {f['disponivel']:.2f}, Solicitado: {f['solicitado']:.2f}"
+        for f in faltas
+    ]
+    return f'{titulo} ({len(faltas)} produto(s)):\n' + '\n'.join(linhas)
+
+
+def _resposta_faltas(faltas, titulo):
+    """Resposta 400 com todas as faltas: texto para o alerta e a lista estruturada em 'faltas'."""
+    return jsonify({
+        'erro': _texto_faltas(faltas, titulo),
+        'faltas': faltas
+    }), 400
+
+
+def _simular_aprovacao_lote(saldos, lote, itens, nivel, permite_negativo):
+    """
+    Aplica um lote aos saldos simulados em memória, se houver estoque na origem.
+
+    Mesma regra de _faltas_estoque_lote (faltas_na_posicao), mas contra
+    'saldos', que já inclui o efeito dos lotes aprovados antes no mesmo
+    pedido. Com faltas, 'saldos' fica inalterado.
+
+    Args:
+        saldos: {(produto_id, setor_id, local_id): saldo} (ver obter_saldos_posicoes)
+
+    Returns:
+        list: faltas (ver faltas_na_posicao); vazia se o lote foi aplicado
+    """
+    def chave(produto_id, setor_id, local_id):
+        # Linha onde registrar_movimentos grava o movimento (mesma normalização de simular_movimentos)
+        if nivel == 'CENTRAL':
+            return (produto_id, None, None)
+        if nivel == 'SETOR':
+            return (produto_id, setor_id, None)
+        return (produto_id, setor_id, local_id)
+
+    tipo = lote['tipo']
+    origem = (lote['setor_origem_id'], lote['local_origem_id'])
+    destino = (lote['setor_destino_id'], lote['local_destino_id'])
+
+    quantidades = {}
+    nomes = {}
+    for item in itens:
+        if not item['controla_estoque']:
+            continue
+        qtd_convertida = item['quantidade_original'] * item['fator_conversao']
+        quantidades[item['id_produto']] = quantidades.get(item['id_produto'], 0.0) + qtd_convertida
+        nomes[item['id_produto']] = item['produto_nome']
+
+    valida_origem = (
+        tipo in ('SAIDA', 'TRANSFERENCIA')
+        and not (tipo == 'TRANSFERENCIA' and nivel == 'CENTRAL')
+        and not permite_negativo
+    )
+    if valida_origem:
+        faltas = faltas_na_posicao(saldos, nivel, quantidades, nomes, *origem)
+        if faltas:
+            return faltas
+
+    for produto_id, qtd in quantidades.items():
+        if tipo in ('SAIDA', 'TRANSFERENCIA'):
+            k = chave(produto_id, *origem)
+            saldos[k] = round(saldos.get(k, 0.0) - qtd, 2)
+        if tipo in ('ENTRADA', 'TRANSFERENCIA'):
+            k = chave(produto_id, *destino)
+            saldos[k] = round(saldos.get(k, 0.0) + qtd, 2)
+    return []
 
 
 @bp.route('/iniciar', methods=['POST'])
@@ -441,54 +498,14 @@ def finalizar_lote(id_lote):
     nivel = obter_nivel_controle(db)
     
     try:
-        # Validações por tipo
-        if tipo == 'SAIDA':
-            # Validar estoque suficiente para cada item
-            for item in itens:
-                if not item['controla_estoque']:
-                    continue
-                
-                qtd_convertida = item['quantidade_original'] * item['fator_conversao']
-                
-                if nivel == 'CENTRAL':
-                    saldo_atual = obter_saldo(db, item['id_produto'])
-                elif nivel == 'SETOR':
-                    saldo_atual = obter_saldo(db, item['id_produto'], lote['setor_origem_id'])
-                elif nivel == 'LOCAL':
-                    saldo_atual = obter_saldo(db, item['id_produto'], 
-                                             lote['setor_origem_id'], lote['local_origem_id'])
-                
-                permite_negativo = obter_permite_estoque_negativo(db)
-                
-                if not permite_negativo and saldo_atual < qtd_convertida:
-                    return jsonify({
-                        'erro': f'Estoque insuficiente para {item["produto_nome"]}. '
-                               f'Disponível: {saldo_atual:.2f}, Solicitado: {qtd_convertida:.2f}'
-                    }), 400
+        # Lock de escrita desde a validação: saldos não mudam até o commit
+        iniciar_transacao_imediata(db)
         
-        elif tipo == 'TRANSFERENCIA':
-            # Validar estoque origem para cada item
-            for item in itens:
-                if not item['controla_estoque']:
-                    continue
-                
-                qtd_convertida = item['quantidade_original'] * item['fator_conversao']
-                
-                if nivel == 'SETOR':
-                    saldo_origem = obter_saldo(db, item['id_produto'], lote['setor_origem_id'])
-                elif nivel == 'LOCAL':
-                    saldo_origem = obter_saldo(db, item['id_produto'], 
-                                              lote['setor_origem_id'], lote['local_origem_id'])
-                else:
-                    continue  # TRANSFERENCIA não se aplica a CENTRAL
-                
-                permite_negativo = obter_permite_estoque_negativo(db)
-                
-                if not permite_negativo and saldo_origem < qtd_convertida:
-                    return jsonify({
-                        'erro': f'Estoque insuficiente na origem para {item["produto_nome"]}. '
-                               f'Disponível: {saldo_origem:.2f}, Solicitado: {qtd_convertida:.2f}'
-                    }), 400
+        # Saldo na origem para SAIDA e TRANSFERENCIA (todas as faltas de uma vez)
+        faltas = _faltas_estoque_lote(db, lote, itens, nivel)
+        if faltas:
+            titulo = 'Estoque insuficiente na origem' if tipo == 'TRANSFERENCIA' else 'Estoque insuficiente'
+            return _resposta_faltas(faltas, titulo)
         
         # Verificar se requer aprovação ou vai direto
         requer_aprovacao = obter_requer_aprovacao(db)
@@ -525,86 +542,8 @@ def finalizar_lote(id_lote):
         # ==================================================
         # MODO DIRETO: FINALIZADO (SEM APROVAÇÃO)
         # ==================================================
-        # Gerar movimentações e ajustar saldos imediatamente
-        for item in itens:
-            qtd_convertida = item['quantidade_original'] * item['fator_conversao']
-
-            if tipo == 'TRANSFERENCIA':
-                custo_origem = obter_custo_medio(db, item['id_produto'], lote['setor_origem_id'], lote['local_origem_id'])
-                custo_unit = custo_origem
-
-                # SAIDA origem
-                db.execute('''
-                    INSERT INTO movimentacoes (
-                        id_produto, tipo, motivo, quantidade,
-                        unidade_movimentacao, fator_conversao_usado, quantidade_original,
-                        preco_custo_unitario, valor_total,
-                        data_movimento, origem, id_usuario, observacao
-                    ) VALUES (?, 'SAIDA', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    item['id_produto'], lote['motivo'], qtd_convertida,
-                    item['unidade_movimentacao'], item['fator_conversao'], item['quantidade_original'],
-                    custo_unit, -qtd_convertida * custo_unit,
-                    datetime.now().isoformat(), f"Transferência Lote #{id_lote}",
-                    session.get('user_id'), f"Lote #{id_lote}"
-                ))
-
-                # ENTRADA destino (mantém custo da origem)
-                db.execute('''
-                    INSERT INTO movimentacoes (
-                        id_produto, tipo, motivo, quantidade,
-                        unidade_movimentacao, fator_conversao_usado, quantidade_original,
-                        preco_custo_unitario, valor_total,
-                        data_movimento, origem, id_usuario, observacao
-                    ) VALUES (?, 'ENTRADA', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    item['id_produto'], lote['motivo'], qtd_convertida,
-                    item['unidade_movimentacao'], item['fator_conversao'], item['quantidade_original'],
-                    custo_unit, qtd_convertida * custo_unit,
-                    datetime.now().isoformat(), f"Transferência Lote #{id_lote}",
-                    session.get('user_id'), f"Lote #{id_lote}"
-                ))
-
-                if item['controla_estoque']:
-                    ajustar_saldo(db, item['id_produto'], qtd_convertida, 'SAIDA',
-                                 lote['setor_origem_id'], lote['local_origem_id'])
-                    ajustar_saldo(db, item['id_produto'], qtd_convertida, 'ENTRADA',
-                                 lote['setor_destino_id'], lote['local_destino_id'], custo_unitario=custo_unit)
-
-            else:
-                if tipo == 'SAIDA':
-                    preco_custo_unitario = obter_custo_medio(db, item['id_produto'], lote['setor_origem_id'], lote['local_origem_id'])
-                    valor_total = -qtd_convertida * preco_custo_unitario
-                else:
-                    preco_custo_unitario = item['preco_custo_unitario'] or item['preco_custo'] or 0.0
-                    valor_total = qtd_convertida * preco_custo_unitario
-
-                db.execute('''
-                    INSERT INTO movimentacoes (
-                        id_produto, tipo, motivo, quantidade,
-                        unidade_movimentacao, fator_conversao_usado, quantidade_original,
-                        preco_custo_unitario, valor_total,
-                        setor_origem_id, local_origem_id,
-                        setor_destino_id, local_destino_id,
-                        data_movimento, origem, id_usuario, observacao
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    item['id_produto'], tipo, lote['motivo'], qtd_convertida,
-                    item['unidade_movimentacao'], item['fator_conversao'], item['quantidade_original'],
-                    preco_custo_unitario, valor_total,
-                    lote['setor_origem_id'], lote['local_origem_id'],
-                    lote['setor_destino_id'], lote['local_destino_id'],
-                    datetime.now().isoformat(), lote['origem'] or f"Lote #{id_lote}",
-                    session.get('user_id'), f"Lote #{id_lote}"
-                ))
-
-                if item['controla_estoque']:
-                    if tipo == 'ENTRADA':
-                        ajustar_saldo(db, item['id_produto'], qtd_convertida, tipo,
-                                     lote['setor_destino_id'], lote['local_destino_id'], custo_unitario=preco_custo_unitario)
-                    else:  # SAIDA
-                        ajustar_saldo(db, item['id_produto'], qtd_convertida, tipo,
-                                     lote['setor_origem_id'], lote['local_origem_id'])
+        # Gerar movimentações e ajustar saldos imediatamente (em lote)
+        registrar_movimentos(db, _itens_para_movimento(lote, itens), validar_estoque=False, auditar=False)
         
         # Atualizar status do lote para FINALIZADO (modo direto, sem aprovação)
         db.execute('''
@@ -644,7 +583,6 @@ def finalizar_lote(id_lote):
 def salvar_financeiro(id_lote):
     """Salva dados financeiros de um lote de ENTRADA (fornecedor, plano, parcelas)."""
     db = get_db()
-    ensure_finance_schema(db)
 
     lote = db.execute('SELECT tipo, status FROM lotes_movimentacao WHERE id = ?', (id_lote,)).fetchone()
     if not lote:
@@ -766,141 +704,17 @@ def aprovar_lote(id_lote):
     nivel = obter_nivel_controle(db)
     
     try:
-        # Validar saldo para SAIDA e TRANSFERENCIA (igual ao finalizar)
-        if tipo == 'SAIDA':
-            for item in itens:
-                if not item['controla_estoque']:
-                    continue
-                
-                qtd_convertida = item['quantidade_original'] * item['fator_conversao']
-                
-                if nivel == 'CENTRAL':
-                    saldo_atual = obter_saldo(db, item['id_produto'])
-                elif nivel == 'SETOR':
-                    saldo_atual = obter_saldo(db, item['id_produto'], lote['setor_origem_id'])
-                elif nivel == 'LOCAL':
-                    saldo_atual = obter_saldo(db, item['id_produto'], 
-                                             lote['setor_origem_id'], lote['local_origem_id'])
-                
-                permite_negativo = obter_permite_estoque_negativo(db)
-                
-                if not permite_negativo and saldo_atual < qtd_convertida:
-                    return jsonify({
-                        'erro': f'Estoque insuficiente para aprovar. '
-                               f'Produto: {item["id_produto"]}, '
-                               f'Disponível: {saldo_atual:.2f}, Solicitado: {qtd_convertida:.2f}'
-                    }), 400
+        # Lock de escrita desde a validação: saldos não mudam até o commit
+        iniciar_transacao_imediata(db)
         
-        elif tipo == 'TRANSFERENCIA':
-            for item in itens:
-                if not item['controla_estoque']:
-                    continue
-                
-                qtd_convertida = item['quantidade_original'] * item['fator_conversao']
-                
-                if nivel == 'SETOR':
-                    saldo_origem = obter_saldo(db, item['id_produto'], lote['setor_origem_id'])
-                elif nivel == 'LOCAL':
-                    saldo_origem = obter_saldo(db, item['id_produto'], 
-                                              lote['setor_origem_id'], lote['local_origem_id'])
-                else:
-                    continue
-                
-                permite_negativo = obter_permite_estoque_negativo(db)
-                
-                if not permite_negativo and saldo_origem < qtd_convertida:
-                    return jsonify({
-                        'erro': f'Estoque insuficiente na origem para aprovar. '
-                               f'Produto: {item["id_produto"]}, '
-                               f'Disponível: {saldo_origem:.2f}, Solicitado: {qtd_convertida:.2f}'
-                    }), 400
+        # Validar saldo para SAIDA e TRANSFERENCIA (igual ao finalizar)
+        faltas = _faltas_estoque_lote(db, lote, itens, nivel)
+        if faltas:
+            titulo = 'Estoque insuficiente na origem para aprovar' if tipo == 'TRANSFERENCIA' else 'Estoque insuficiente para aprovar'
+            return _resposta_faltas(faltas, titulo)
         
         # Aplicar movimentações e ajustar saldos (mesmo código do finalizar direto)
-        for item in itens:
-            qtd_convertida = item['quantidade_original'] * item['fator_conversao']
-
-            if tipo == 'TRANSFERENCIA':
-                custo_origem = obter_custo_medio(db, item['id_produto'], lote['setor_origem_id'], lote['local_origem_id'])
-                custo_unit = custo_origem
-
-                # SAIDA origem
-                db.execute('''
-                    INSERT INTO movimentacoes (
-                        id_produto, tipo, motivo, quantidade,
-                        unidade_movimentacao, fator_conversao_usado, quantidade_original,
-                        preco_custo_unitario, valor_total,
-                        setor_origem_id, local_origem_id,
-                        data_movimento, origem, id_usuario, observacao
-                    ) VALUES (?, 'SAIDA', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    item['id_produto'], lote['motivo'], qtd_convertida,
-                    item['unidade_movimentacao'], item['fator_conversao'], item['quantidade_original'],
-                    custo_unit, -qtd_convertida * custo_unit,
-                    lote['setor_origem_id'], lote['local_origem_id'],
-                    datetime.now().isoformat(), f"Transferência Lote #{id_lote}", 
-                    session.get('user_id'), f"Lote #{id_lote}"
-                ))
-                
-                # ENTRADA destino
-                db.execute('''
-                    INSERT INTO movimentacoes (
-                        id_produto, tipo, motivo, quantidade,
-                        unidade_movimentacao, fator_conversao_usado, quantidade_original,
-                        preco_custo_unitario, valor_total,
-                        setor_destino_id, local_destino_id,
-                        data_movimento, origem, id_usuario, observacao
-                    ) VALUES (?, 'ENTRADA', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    item['id_produto'], lote['motivo'], qtd_convertida,
-                    item['unidade_movimentacao'], item['fator_conversao'], item['quantidade_original'],
-                    custo_unit, qtd_convertida * custo_unit,
-                    lote['setor_destino_id'], lote['local_destino_id'],
-                    datetime.now().isoformat(), f"Transferência Lote #{id_lote}", 
-                    session.get('user_id'), f"Lote #{id_lote}"
-                ))
-                
-                # Ajustar saldos
-                if item['controla_estoque']:
-                    ajustar_saldo(db, item['id_produto'], qtd_convertida, 'SAIDA',
-                                 lote['setor_origem_id'], lote['local_origem_id'])
-                    ajustar_saldo(db, item['id_produto'], qtd_convertida, 'ENTRADA',
-                                 lote['setor_destino_id'], lote['local_destino_id'], custo_unitario=custo_unit)
-            
-            else:
-                if tipo == 'SAIDA':
-                    preco_custo_unitario = obter_custo_medio(db, item['id_produto'], lote['setor_origem_id'], lote['local_origem_id'])
-                    valor_total = -qtd_convertida * preco_custo_unitario
-                else:
-                    preco_custo_unitario = item['preco_custo_unitario'] or item['preco_custo'] or 0.0
-                    valor_total = qtd_convertida * preco_custo_unitario
-                
-                db.execute('''
-                    INSERT INTO movimentacoes (
-                        id_produto, tipo, motivo, quantidade,
-                        unidade_movimentacao, fator_conversao_usado, quantidade_original,
-                        preco_custo_unitario, valor_total,
-                        setor_origem_id, local_origem_id,
-                        setor_destino_id, local_destino_id,
-                        data_movimento, origem, id_usuario, observacao
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    item['id_produto'], tipo, lote['motivo'], qtd_convertida,
-                    item['unidade_movimentacao'], item['fator_conversao'], item['quantidade_original'],
-                    preco_custo_unitario, valor_total,
-                    lote['setor_origem_id'], lote['local_origem_id'],
-                    lote['setor_destino_id'], lote['local_destino_id'],
-                    datetime.now().isoformat(), lote['origem'] or f"Lote #{id_lote}", 
-                    session.get('user_id'), f"Lote #{id_lote}"
-                ))
-                
-                # Ajustar saldo
-                if item['controla_estoque']:
-                    if tipo == 'ENTRADA':
-                        ajustar_saldo(db, item['id_produto'], qtd_convertida, tipo,
-                                     lote['setor_destino_id'], lote['local_destino_id'], custo_unitario=preco_custo_unitario)
-                    else:  # SAIDA
-                        ajustar_saldo(db, item['id_produto'], qtd_convertida, tipo,
-                                     lote['setor_origem_id'], lote['local_origem_id'])
+        registrar_movimentos(db, _itens_para_movimento(lote, itens), validar_estoque=False, auditar=False)
         
         # Atualizar status do lote para APROVADO
         db.execute('''
@@ -938,6 +752,148 @@ def aprovar_lote(id_lote):
         return jsonify({'erro': str(e)}), 500
 
 
+@bp.route('/aprovar', methods=['POST'])
+def aprovar_lotes():
+    """
+    Aprova vários lotes PENDENTE_APROVACAO de SAIDA ou TRANSFERENCIA de uma vez.
+
+    Os lotes são processados em ordem de criação (data_criacao), a mesma do aviso
+    de "lotes anteriores pendentes": cada um é validado contra os saldos já
+    ajustados pelos anteriores aprovados neste pedido (simulação em memória,
+    uma leitura de posições). Os que passam são aplicados juntos numa única
+    transação; os demais continuam pendentes e voltam no relatório.
+
+    Body JSON:
+    {
+        "ids": [int, ...]
+    }
+
+    Returns:
+        {"sucesso": true, "aprovados": int, "recusados": int,
+         "resultados": [{"id_lote", "aprovado", "erro", "faltas", "total_itens"}, ...]}
+    """
+    if not gerente_required():
+        return jsonify({'erro': 'Apenas gerentes podem aprovar lotes'}), 403
+
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    if not isinstance(ids, list) or not ids:
+        return jsonify({'erro': 'Informe a lista de lotes em "ids"'}), 400
+    try:
+        ids = list(dict.fromkeys(int(i) for i in ids))
+    except (TypeError, ValueError):
+        return jsonify({'erro': 'IDs de lote inválidos'}), 400
+
+    db = get_db()
+    nivel = obter_nivel_controle(db)
+    ids_json = json.dumps(ids)
+
+    try:
+        # Lock de escrita desde a leitura dos saldos: a simulação vale até o commit
+        iniciar_transacao_imediata(db)
+
+        lotes = db.execute('''
+            SELECT * FROM lotes_movimentacao
+            WHERE id IN (SELECT value FROM json_each(?))
+            ORDER BY data_criacao ASC, id ASC
+        ''', (ids_json,)).fetchall()
+
+        itens_por_lote = {}
+        for item in db.execute('''
+            SELECT i.*, p.nome AS produto_nome, p.controla_estoque, p.preco_custo
+            FROM lotes_movimentacao_itens i
+            JOIN produtos p ON i.id_produto = p.id
+            WHERE i.id_lote IN (SELECT value FROM json_each(?))
+            ORDER BY i.id_lote, i.id
+        ''', (ids_json,)).fetchall():
+            itens_por_lote.setdefault(item['id_lote'], []).append(item)
+
+        permite_negativo = obter_permite_estoque_negativo(db)
+        saldos = obter_saldos_posicoes(
+            db, {item['id_produto'] for itens in itens_por_lote.values() for item in itens}, nivel
+        )
+
+        resultados = []
+        aprovados = []
+        for lote in lotes:
+            itens = itens_por_lote.get(lote['id'], [])
+            resultado = {'id_lote': lote['id'], 'aprovado': False, 'erro': None,
+                         'faltas': [], 'total_itens': len(itens)}
+            resultados.append(resultado)
+
+            if lote['status'] != 'PENDENTE_APROVACAO':
+                resultado['erro'] = f'Lote com status {lote["status"]} não pode ser aprovado'
+                continue
+            if lote['tipo'] not in TIPOS_APROVACAO_EM_LOTE:
+                resultado['erro'] = f'Lote de {lote["tipo"]} deve ser aprovado pela tela do lote'
+                continue
+            if not itens:
+                resultado['erro'] = 'Lote sem itens'
+                continue
+
+            faltas = _simular_aprovacao_lote(saldos, lote, itens, nivel, permite_negativo)
+            if faltas:
+                titulo = ('Estoque insuficiente na origem para aprovar' if lote['tipo'] == 'TRANSFERENCIA'
+                          else 'Estoque insuficiente para aprovar')
+                resultado['erro'] = _texto_faltas(faltas, titulo)
+                resultado['faltas'] = faltas
+                continue
+
+            resultado['aprovado'] = True
+            aprovados.append(lote)
+
+        encontrados = {lote['id'] for lote in lotes}
+        resultados.extend(
+            {'id_lote': id_lote, 'aprovado': False, 'erro': 'Lote não encontrado',
+             'faltas': [], 'total_itens': 0}
+            for id_lote in ids if id_lote not in encontrados
+        )
+
+        if aprovados:
+            # Todos os movimentos num só plano, na ordem dos lotes (custo médio encadeado)
+            movimentos = []
+            for lote in aprovados:
+                movimentos.extend(_itens_para_movimento(lote, itens_por_lote[lote['id']]))
+            registrar_movimentos(db, movimentos, validar_estoque=False, auditar=False)
+
+            agora = datetime.now().isoformat()
+            db.executemany('''
+                UPDATE lotes_movimentacao
+                SET status = 'APROVADO',
+                    data_aprovacao = ?,
+                    id_usuario_aprovador = ?
+                WHERE id = ?
+            ''', [(agora, session.get('user_id'), lote['id']) for lote in aprovados])
+
+            db.executemany('''
+                INSERT INTO logs_auditoria (acao, descricao, data_hora)
+                VALUES (?, ?, ?)
+            ''', [
+                ('LOTE_APROVADO',
+                 f'Lote #{lote["id"]} aprovado pelo gerente (aprovação em lote): '
+                 f'{lote["tipo"]} com {len(itens_por_lote[lote["id"]])} itens',
+                 agora)
+                for lote in aprovados
+            ])
+
+        db.commit()
+
+        total_aprovados = len(aprovados)
+        return jsonify({
+            'sucesso': True,
+            'message': f'{total_aprovados} de {len(resultados)} lote(s) aprovado(s).',
+            'aprovados': total_aprovados,
+            'recusados': len(resultados) - total_aprovados,
+            'resultados': resultados
+        })
+
+    except Exception as e:
+        db.rollback()
+        import traceback
+        traceback.print_exc()
+        return jsonify({'erro': str(e)}), 500
+
+
 @bp.route('/<int:id_lote>/rejeitar', methods=['POST'])
 def rejeitar_lote(id_lote):
     """
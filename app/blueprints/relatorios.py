@@ -1,6 +1,9 @@
 from datetime import datetime, date, timedelta
 from flask import Blueprint, render_template, request, jsonify
 from ..db import get_db
+from ..fechamento_mensal import saldo_em
+from ..snapshots import dia_gerado, ultimo_dia_gerado, valor_em
+from ..utils import filtro_periodo
 
 bp = Blueprint('relatorios', __name__)
 
@@ -16,59 +19,26 @@ def _parse_date(value, default=None):
 
 def _ultimo_snapshot_por_periodo(db, inicio, fim, categoria_id=None):
 	"""Retorna snapshot (valor_total) do último dia disponível no intervalo, filtrando categoria se fornecida."""
-	filtros = ['data_ref BETWEEN ? AND ?']
-	params = [inicio.isoformat(), fim.isoformat()]
-	join_categoria = ''
-
-	if categoria_id:
-		join_categoria = 'JOIN produto_categoria_inventario pci ON pci.id_produto = sh.produto_id'
-		filtros.append('pci.id_categoria = ?')
-		params.append(categoria_id)
-
-	where_sql = ' AND '.join(filtros)
-
-	row = db.execute(
-		f'''
-		SELECT sh.data_ref, SUM(sh.valor_total) as valor
-		FROM saldos_historico sh
-		{join_categoria}
-		WHERE {where_sql}
-		GROUP BY sh.data_ref
-		ORDER BY sh.data_ref DESC
-		LIMIT 1
-		''',
-		params
-	).fetchone()
-	return (row['data_ref'], float(row['valor'])) if row else (None, 0.0)
+	data_ref = ultimo_dia_gerado(db, inicio, fim)
+	if not data_ref:
+		return (None, 0.0)
+	return (data_ref, valor_em(db, data_ref, categoria_id))
 
 
 def _snapshot_em(db, data_ref, categoria_id=None):
-	filtros = ['data_ref = ?']
-	params = [data_ref.isoformat()]
-	join_categoria = ''
+	return valor_em(db, data_ref, categoria_id)
 
-	if categoria_id:
-		join_categoria = 'JOIN produto_categoria_inventario pci ON pci.id_produto = sh.produto_id'
-		filtros.append('pci.id_categoria = ?')
-		params.append(categoria_id)
-
-	where_sql = ' AND '.join(filtros)
 
-	row = db.execute(
-		f'''
-		SELECT SUM(sh.valor_total) as valor
-		FROM saldos_historico sh
-		{join_categoria}
-		WHERE {where_sql}
-		''',
-		params
-	).fetchone()
-	return float(row['valor'] or 0.0)
+def _estoque_inicial(db, data_inicio, categoria_id=None):
+	"""Valor do estoque no início de data_inicio: snapshot do dia anterior ou, sem snapshot, checkpoint mensal + movimentações."""
+	dia_anterior = data_inicio - timedelta(days=1)
+	if dia_gerado(db, dia_anterior):
+		return _snapshot_em(db, dia_anterior, categoria_id)
+	return saldo_em(db, data_inicio, categoria_id=categoria_id)['valor_total']
 
 
 def _cmv_movtos(db, data_inicio, data_fim, categoria_id=None):
-	filtros = ['DATE(m.data_movimento) BETWEEN ? AND ?']
-	params = [data_inicio.isoformat(), data_fim.isoformat()]
+	filtros, params = filtro_periodo('m.data_movimento', data_inicio, data_fim)
 
 	if categoria_id:
 		filtros.append('pci.id_categoria = ?')
@@ -185,7 +155,7 @@ def relatorio_cmv():
 	if inventario_inicio_id:
 		_, estoque_inicial = _estoque_por_inventario(db, inventario_inicio_id, categoria_id)
 	else:
-		estoque_inicial = _snapshot_em(db, data_inicio - timedelta(days=1), categoria_id)
+		estoque_inicial = _estoque_inicial(db, data_inicio, categoria_id)
 
 	# Estoque final: último snapshot até data_fim ou inventário selecionado
 	if inventario_fim_id:
@@ -211,10 +181,10 @@ def relatorio_cmv():
 			"""
 			SELECT id, descricao, data_criacao, data_fechamento, status
 			FROM inventarios
-			WHERE DATE(data_criacao) BETWEEN ? AND ?
-			ORDER BY DATE(data_criacao) DESC
+			WHERE data_criacao >= ? AND data_criacao < ?
+			ORDER BY data_criacao DESC
 			""",
-			(data_inicio.isoformat(), data_fim.isoformat())
+			(data_inicio.isoformat(), (data_fim + timedelta(days=1)).isoformat())
 		).fetchall()
 	]
 
@@ -254,7 +224,7 @@ def relatorio_cmv_json():
 	if inventario_inicio_id:
 		_, estoque_inicial = _estoque_por_inventario(db, inventario_inicio_id, categoria_id)
 	else:
-		estoque_inicial = _snapshot_em(db, data_inicio - timedelta(days=1), categoria_id)
+		estoque_inicial = _estoque_inicial(db, data_inicio, categoria_id)
 
 	if inventario_fim_id:
 		_, estoque_final = _estoque_por_inventario(db, inventario_fim_id, categoria_id)
@@ -0,0 +1,55 @@
+"""
+Busca de produtos por nome, código ERP, GTIN ou categoria.
+
+Usa o índice FTS5 produtos_busca (migração 13), mantido por triggers em
+produtos: sem acentos e sem diferença de maiúsculas ("pao" encontra "Pão"),
+cada palavra digitada vale como prefixo ("pao fra" encontra "Pão Francês").
+Antes do FTS, o termo é comparado exatamente com id_erp e gtin pelos
+índices dessas colunas; um código lido no leitor vem sempre em primeiro.
+
+As telas fazem JOIN com o resultado de sql_busca() e ordenam por
+busca.relevancia (menor = mais relevante).
+"""
+import re
+
+# Peso de cada coluna no bm25: nome, id_erp, gtin, categoria
+PESOS_BM25 = (10.0, 5.0, 5.0, 1.0)
+
+# Relevância das correspondências exatas de código (bm25 é sempre > -1e9)
+RELEVANCIA_CODIGO = -1e9
+
+RE_PALAVRA = re.compile(r'\w+')
+
+
+def consulta_fts(termo):
+    """Converte o texto digitado em consulta FTS5 (cada palavra como prefixo) ou None."""
+    palavras = RE_PALAVRA.findall(termo or '')
+    if not palavras:
+        return None
+    return ' '.join(f'"{palavra}"*' for palavra in palavras)
+
+
+def sql_busca(termo):
+    """
+    SELECT (produto_id, relevancia) dos produtos que casam com o termo.
+
+    Returns:
+        tuple: (sql, params), ou (None, None) se o termo não tiver palavras
+    """
+    consulta = consulta_fts(termo)
+    if consulta is None:
+        return None, None
+    termo = termo.strip()
+    pesos = ', '.join(str(peso) for peso in PESOS_BM25)
+    sql = f'''
+        SELECT produto_id, MIN(relevancia) AS relevancia
+        FROM (
+            SELECT id AS produto_id, {RELEVANCIA_CODIGO} AS relevancia FROM produtos WHERE id_erp = ?
+            UNION ALL
+            SELECT id, {RELEVANCIA_CODIGO} FROM produtos WHERE gtin = ?
+            UNION ALL
+            SELECT rowid, bm25(produtos_busca, {pesos}) FROM produtos_busca WHERE produtos_busca MATCH ?
+        )
+        GROUP BY produto_id
+    '''
+    return sql, [termo, termo, consulta]
@@ -0,0 +1,89 @@
+"""
+Serviço de configurações em memória.
+
+Centraliza as duas fontes de parâmetros do sistema:
+- .env (por instalação: PERFIL_MAQUINA, CAMINHO_GOOGLE_DRIVE, NIVEL_CONTROLE_ESTOQUE...)
+- tabela configs (parametrização global gravada no banco)
+
+Ambas são lidas uma única vez e mantidas em cache. A tabela configs não é
+gravada pela aplicação (só por edição manual ou pelo banco baixado na
+sincronização): o cache é invalidado após a sincronização e pela rota
+/admin/configuracoes/recarregar (que também relê o .env).
+"""
+import os
+import threading
+
+from dotenv import dotenv_values
+
+
+class Configuracoes:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._env = None
+        # Ambiente do processo sem os valores vindos do .env (base das releituras)
+        self._env_processo = None
+        self._configs = None
+        # Incrementada a cada invalidação: leitura iniciada antes dela não vai para o cache
+        self._geracao = 0
+
+    def _carregar_env(self, override=False):
+        """
+        Lê o .env sem alterar os.environ e o combina com o ambiente do processo:
+        o processo prevalece na primeira leitura; o arquivo, com override (recarga).
+        Chave removida do .env some na recarga, em vez de ficar o valor antigo.
+        """
+        arquivo = {chave: valor for chave, valor in dotenv_values().items() if valor is not None}
+        if self._env_processo is None:
+            # launcher.py já carregou o .env em os.environ: o que veio dele não é do processo
+            self._env_processo = {
+                chave: valor for chave, valor in os.environ.items() if arquivo.get(chave) != valor
+            }
+        if override:
+            self._env = {**self._env_processo, **arquivo}
+        else:
+            self._env = {**arquivo, **self._env_processo}
+
+    def env(self, chave, padrao=''):
+        """Valor de uma variável do .env/ambiente (sem espaços nas pontas)."""
+        if self._env is None:
+            with self._lock:
+                if self._env is None:
+                    self._carregar_env()
+        valor = self._env.get(chave)
+        if valor is None:
+            return padrao
+        return valor.strip()
+
+    def config_db(self, db, chave, padrao=None):
+        """Valor de uma chave da tabela configs (carregada inteira na primeira leitura)."""
+        configs = self._configs
+        if configs is None:
+            geracao = self._geracao
+            rows = db.execute('SELECT chave, valor FROM configs').fetchall()
+            configs = {row['chave']: row['valor'] for row in rows}
+            with self._lock:
+                if self._geracao == geracao:
+                    self._configs = configs
+        return configs.get(chave, padrao)
+
+    def invalidar(self):
+        """Descarta o cache da tabela configs (relida na próxima consulta)."""
+        with self._lock:
+            self._configs = None
+            self._geracao += 1
+
+    def recarregar(self):
+        """Relê o .env (sobrescrevendo valores já carregados) e descarta o cache de configs."""
+        with self._lock:
+            self._carregar_env(override=True)
+            self._configs = None
+            self._geracao += 1
+
+
+configuracoes = Configuracoes()
+
+
+def obter_perfil_maquina(padrao='LOJA'):
+    """Perfil da máquina (LOJA, GERENTE ou CADASTRO) definido no .env."""
+    return configuracoes.env('PERFIL_MAQUINA', padrao).upper()
@@ -1,18 +1,151 @@
+import queue
 import sqlite3
+import threading
+from contextlib import contextmanager
 from flask import current_app, g
 
 
+# Valores padrão caso o objeto de configuração não defina os parâmetros SQLITE_*
+PADROES_SQLITE = {
+    'SQLITE_POOL_SIZE': 8,
+    'SQLITE_JOURNAL_MODE': 'WAL',
+    'SQLITE_SYNCHRONOUS': 'NORMAL',
+    'SQLITE_BUSY_TIMEOUT_MS': 5000,
+    'SQLITE_CACHE_SIZE_KB': 20000,
+    'SQLITE_MMAP_SIZE': 256 * 1024 * 1024,
+    'SQLITE_FOREIGN_KEYS': True,
+    'SQLITE_CACHED_STATEMENTS': 256,
+}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class PoolConexoes:
+    """
+    Pool pequeno de conexões SQLite de longa duração.
+
+    Cada conexão é entregue a uma única requisição/thread por vez (get_db) e
+    devolvida ao final dela (close_db), já com os PRAGMAs aplicados.
+    """
+
+    def __init__(self, database, config):
+        self.database = database
+        self.tamanho = int(config['SQLITE_POOL_SIZE'])
+        self.config = config
+        self._livres = queue.LifoQueue()
+        self._fechado = False
+
+    def _conectar(self):
+        cfg = self.config
+        timeout_s = int(cfg['SQLITE_BUSY_TIMEOUT_MS']) / 1000.0
+        conn = sqlite3.connect(
+            self.database,
+            timeout=timeout_s,
+            check_same_thread=False,
+            cached_statements=int(cfg['SQLITE_CACHED_STATEMENTS'])
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA journal_mode = {cfg['SQLITE_JOURNAL_MODE']}")
+        conn.execute(f"PRAGMA synchronous = {cfg['SQLITE_SYNCHRONOUS']}")
+        conn.execute(f"PRAGMA busy_timeout = {int(cfg['SQLITE_BUSY_TIMEOUT_MS'])}")
+        # cache_size negativo = tamanho em KiB (e não em páginas)
+        conn.execute(f"PRAGMA cache_size = -{int(cfg['SQLITE_CACHE_SIZE_KB'])}")
+        conn.execute(f"PRAGMA mmap_size = {int(cfg['SQLITE_MMAP_SIZE'])}")
+        conn.execute(f"PRAGMA foreign_keys = {'ON' if cfg['SQLITE_FOREIGN_KEYS'] else 'OFF'}")
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return conn
+
+    def obter(self):
+        try:
+            return self._livres.get_nowait()
+        except queue.Empty:
+            return self._conectar()
+
+    def devolver(self, conn):
+        # Nunca devolver ao pool uma transação pendente (equivale ao close() antigo)
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+
+        if self._fechado or self._livres.qsize() >= self.tamanho:
+            conn.close()
+            return
+        self._livres.put_nowait(conn)
+
+    def fechar(self):
+        self._fechado = True
+        while True:
+            try:
+                self._livres.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def _config_sqlite(app):
+    return {chave: app.config.get(chave, padrao) for chave, padrao in PADROES_SQLITE.items()}
+
+
+def _obter_pool(app):
+    database = app.config['DATABASE']
+    pool = _pools.get(database)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(database)
+            if pool is None:
+                pool = PoolConexoes(database, _config_sqlite(app))
+                _pools[database] = pool
+    return pool
+
+
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(current_app.config['DATABASE'])
-        g.db.row_factory = sqlite3.Row
+        pool = _obter_pool(current_app)
+        g.db_pool = pool
+        g.db = pool.obter()
     return g.db
 
 
 def close_db(e=None):
     db = g.pop('db', None)
+    pool = g.pop('db_pool', None)
     if db is not None:
-        db.close()
+        if pool is not None:
+            pool.devolver(db)
+        else:
+            db.close()
+
+
+@contextmanager
+def conexao(app):
+    """Empresta uma conexão do pool fora do ciclo de requisição (jobs, threads)."""
+    pool = _obter_pool(app)
+    conn = pool.obter()
+    try:
+        yield conn
+    finally:
+        pool.devolver(conn)
+
+
+def fechar_conexoes(app):
+    """
+    Fecha todas as conexões ociosas do pool do banco configurado.
+    Necessário antes de substituir o arquivo .db (ex.: sincronização do Google Drive).
+    Conexões em uso são fechadas quando devolvidas.
+    """
+    with _pools_lock:
+        pool = _pools.pop(app.config['DATABASE'], None)
+    if pool is not None:
+        pool.fechar()
+
+
+def iniciar_transacao_imediata(db):
+    """Abre transação com lock de escrita (BEGIN IMMEDIATE) caso ainda não exista uma."""
+    if not db.in_transaction:
+        db.execute('BEGIN IMMEDIATE')
 
 
 def init_db(app):
@@ -0,0 +1,173 @@
+"""
+Eventos de atualização do inventário para as telas do gerente (/api/eventos).
+
+Um único monitor por banco lê o contador versao_dados (mantido por triggers,
+ver migração 11) a cada INTERVALO_S segundos, enquanto houver alguma tela
+conectada. Quando a versão muda, calcula o progresso uma vez e acorda todas
+as conexões SSE, que só então enviam o evento. Telas paradas não geram
+consultas: N dashboards abertos custam uma leitura de uma linha por intervalo.
+"""
+import threading
+
+from .db import conexao
+
+INTERVALO_S = 1.0
+KEEPALIVE_S = 15.0
+
+_monitores = {}
+_monitores_lock = threading.Lock()
+
+
+def ler_versao(db):
+    """Versão atual dos dados do inventário e se há inventário aberto."""
+    versao = db.execute('SELECT versao FROM versao_dados WHERE id = 1').fetchone()['versao']
+    inv = db.execute("SELECT id FROM inventarios WHERE status='Aberto' LIMIT 1").fetchone()
+    return versao, inv['id'] if inv else None
+
+
+def contar_pendencias(db, inventario_id):
+    """Produtos ativos ainda sem contagem (só a categoria do escopo em inventário PARCIAL)."""
+    inv = db.execute(
+        'SELECT tipo_inventario, id_categoria_escopo FROM inventarios WHERE id = ?', (inventario_id,)
+    ).fetchone()
+    join_categoria, params = '', [inventario_id]
+    if inv and inv['tipo_inventario'] == 'PARCIAL' and inv['id_categoria_escopo']:
+        join_categoria = 'JOIN produto_categoria_inventario pc ON p.id = pc.id_produto AND pc.id_categoria = ?'
+        params = [inv['id_categoria_escopo'], inventario_id]
+    return db.execute(f'''
+        SELECT COUNT(*) FROM produtos p
+        {join_categoria}
+        WHERE NOT EXISTS (
+            SELECT 1 FROM contagens_totais_produto t
+            WHERE t.id_inventario = ? AND t.id_produto = p.id
+        )
+        AND p.ativo = 1
+    ''', params).fetchone()[0]
+
+
+def ler_progresso(db, inventario_id):
+    """
+    Totais enviados junto com a versão, os mesmos que o dashboard e as telas de
+    monitoramento exibem, para que elas se atualizem sem recarregar: contagens,
+    ocorrências, locais (geral, por setor e por local), valor contado e
+    produtos pendentes.
+    """
+    if not inventario_id:
+        return None
+    locais = [
+        {'id': row['id'], 'id_setor': row['id_setor'], 'status': row['status'], 'qtd_contagens': row['qtd_contagens']}
+        for row in db.execute('''
+            SELECT l.id, l.id_setor, l.status, COALESCE(SUM(t.qtd_contagens), 0) AS qtd_contagens
+            FROM locais l
+            LEFT JOIN contagens_totais_local t ON t.id_local = l.id AND t.id_inventario = ?
+            GROUP BY l.id
+        ''', (inventario_id,)).fetchall()
+    ]
+    setores = {}
+    for local in locais:
+        setor = setores.setdefault(local['id_setor'], {'id': local['id_setor'], 'total': 0, 'concluidos': 0})
+        setor['total'] += 1
+        setor['concluidos'] += 1 if local['status'] == 2 else 0
+
+    return {
+        'contagens': db.execute(
+            'SELECT COALESCE(SUM(qtd_contagens), 0) FROM contagens_totais_produto WHERE id_inventario = ?',
+            (inventario_id,)
+        ).fetchone()[0],
+        'ocorrencias': db.execute(
+            'SELECT COUNT(*) FROM ocorrencias WHERE id_inventario = ?', (inventario_id,)
+        ).fetchone()[0],
+        'ocorrencias_pendentes': db.execute(
+            'SELECT COUNT(*) FROM ocorrencias WHERE id_inventario = ? AND resolvido = 0', (inventario_id,)
+        ).fetchone()[0],
+        'locais_concluidos': sum(1 for local in locais if local['status'] == 2),
+        'total_locais': len(locais),
+        'valor_contado': db.execute('''
+            SELECT COALESCE(SUM(t.quantidade * COALESCE(pu.fator_conversao, 1.0) * COALESCE(p.preco_custo, 0)), 0)
+            FROM contagens_totais_produto t
+            JOIN produtos p ON t.id_produto = p.id
+            LEFT JOIN produtos_unidades pu ON p.id = pu.id_produto AND t.id_unidade = pu.id_unidade
+            WHERE t.id_inventario = ?
+        ''', (inventario_id,)).fetchone()[0],
+        'pendencias': contar_pendencias(db, inventario_id),
+        'setores': list(setores.values()),
+        'locais': locais,
+    }
+
+
+class MonitorVersao:
+    """Observa versao_dados e notifica os assinantes (conexões SSE) quando ela muda."""
+
+    def __init__(self, app):
+        self.app = app
+        self.evento = None
+        self._condicao = threading.Condition()
+        self._assinantes = 0
+        self._thread = None
+
+    def _atualizar(self):
+        with conexao(self.app) as db:
+            versao, inventario_id = ler_versao(db)
+            if self.evento and self.evento['versao'] == versao:
+                return
+            evento = {
+                'versao': versao,
+                'ativo': inventario_id is not None,
+                'progresso': ler_progresso(db, inventario_id)
+            }
+        with self._condicao:
+            self.evento = evento
+            self._condicao.notify_all()
+
+    def _executar(self):
+        while True:
+            with self._condicao:
+                if self._assinantes == 0:
+                    self._thread = None
+                    return
+            try:
+                self._atualizar()
+            except Exception:
+                self.app.logger.exception("Falha ao ler versão dos dados")
+            with self._condicao:
+                self._condicao.wait(INTERVALO_S)
+
+    def assinar(self):
+        """
+        Gera o evento atual e depois cada mudança de versão; None a cada
+        KEEPALIVE_S sem mudança (para o SSE manter a conexão viva).
+        """
+        with self._condicao:
+            self._assinantes += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._executar, name='monitor_versao_dados', daemon=True)
+                self._thread.start()
+        try:
+            if self.evento is None:
+                self._atualizar()
+            ultima = None
+            while True:
+                with self._condicao:
+                    if self.evento is ultima:
+                        self._condicao.wait(KEEPALIVE_S)
+                    evento = self.evento
+                if evento is ultima:
+                    yield None
+                    continue
+                ultima = evento
+                yield evento
+        finally:
+            with self._condicao:
+                self._assinantes -= 1
+
+
+def obter_monitor(app):
+    database = app.config['DATABASE']
+    monitor = _monitores.get(database)
+    if monitor is None:
+        with _monitores_lock:
+            monitor = _monitores.get(database)
+            if monitor is None:
+                monitor = MonitorVersao(app)
+                _monitores[database] = monitor
+    return monitor
@@ -0,0 +1,428 @@
+"""
+Fechamento do inventário: plano (fechamento_plano) e job em background (fechamento_jobs).
+
+A comparação contado x sistema de cada produto do escopo é calculada uma
+vez, num único INSERT ... SELECT, e gravada em fechamento_plano. O preview,
+a exportação para Excel e a confirmação leem o plano em vez de refazer a
+comparação.
+
+O plano vale enquanto nada que entra no cálculo mudar: contagens e status
+(versao_dados), saldos (última movimentação) e catálogo (catalogo_versao).
+A confirmação só aceita o plano revisado: se ele ficou desatualizado, o
+gerente precisa revisar de novo.
+
+Confirmado, o fechamento vira um job executado em thread de background,
+em fases (FASES). Cada passo de uma fase é uma transação curta que grava,
+junto com o trabalho, onde o job parou (fase e último produto ajustado):
+se o processo cair, o job é retomado na inicialização a partir do último
+passo gravado, sem repetir ajustes. Enquanto o job não termina, o índice
+único idx_fechamento_jobs_ativo impede um segundo fechamento do mesmo
+inventário e triggers bloqueiam alterações nas contagens dele.
+"""
+import threading
+from datetime import datetime
+
+from .db import conexao, iniciar_transacao_imediata
+from .utils import registrar_movimentos
+
+# Diferença (na unidade padrão) abaixo da qual o produto é considerado OK
+TOLERANCIA_AJUSTE = 0.001
+
+# Fases do job de fechamento, na ordem de execução
+FASES = (
+    ('SNAPSHOT_LOCAIS', 'Salvando status dos locais'),
+    ('AJUSTES', 'Gerando ajustes no Kardex'),
+    ('RESET_LOCAIS', 'Resetando locais'),
+    ('FECHAR', 'Fechando inventário'),
+)
+
+# Produtos do plano conferidos/ajustados por transação na fase AJUSTES
+LOTE_AJUSTES = 500
+
+_em_execucao = set()
+_em_execucao_lock = threading.Lock()
+
+
+def versao_atual(db):
+    """Versão dos dados que alimentam o plano: 'versao_dados-ultima_movimentacao-versao_catalogo'."""
+    row = db.execute('''
+        SELECT (SELECT versao FROM versao_dados WHERE id = 1) AS dados,
+               (SELECT COALESCE(MAX(id), 0) FROM movimentacoes) AS movimentacao,
+               (SELECT versao FROM catalogo_versao WHERE id = 1) AS catalogo
+    ''').fetchone()
+    return f"{row['dados']}-{row['movimentacao']}-{row['catalogo']}"
+
+
+def versao_plano(db, inventario_id):
+    """Versão com que o plano do inventário foi gerado (None se não houver plano)."""
+    row = db.execute(
+        'SELECT versao FROM fechamento_plano_estado WHERE id_inventario = ?', (inventario_id,)
+    ).fetchone()
+    return row['versao'] if row else None
+
+
+def gerar_plano(db, inventario):
+    """
+    (Re)calcula o plano do inventário (dict/Row de inventarios). O commit fica com o chamador.
+
+    Returns:
+        str: versão do plano gerado
+    """
+    inv_id = inventario['id']
+    versao = versao_atual(db)
+
+    join_escopo, filtro_escopo = '', ''
+    params = [inv_id, TOLERANCIA_AJUSTE, inv_id]
+    if inventario['tipo_inventario'] == 'PARCIAL' and inventario['id_categoria_escopo']:
+        join_escopo = 'JOIN produto_categoria_inventario pc ON p.id = pc.id_produto'
+        filtro_escopo = 'AND pc.id_categoria = ?'
+        params.append(inventario['id_categoria_escopo'])
+
+    db.execute('DELETE FROM fechamento_plano WHERE id_inventario = ?', (inv_id,))
+    db.execute(f'''
+        INSERT INTO fechamento_plano (
+            id_inventario, produto_id, produto_nome, id_erp, gtin, unidade_padrao,
+            estoque_sistema, valor_total_estoque, preco_custo, quantidade_contada,
+            total_contagens, diferenca, tipo_ajuste, custo_medio_atual, valor_ajuste
+        )
+        SELECT ?, produto_id, produto_nome, id_erp, gtin, unidade_padrao,
+               estoque_sistema, valor_total_estoque, preco_custo, quantidade_contada,
+               total_contagens, diferenca,
+               CASE WHEN ABS(diferenca) < ? THEN 'OK'
+                    WHEN diferenca > 0 THEN 'ENTRADA' ELSE 'SAIDA' END,
+               custo_medio_atual,
+               ABS(diferenca) * custo_medio_atual
+        FROM (
+            SELECT p.id AS produto_id, p.nome AS produto_nome, p.id_erp, p.gtin,
+                   u.sigla AS unidade_padrao,
+                   COALESCE(rs.saldo, 0) AS estoque_sistema,
+                   COALESCE(rs.valor_total, 0) AS valor_total_estoque,
+                   COALESCE(p.preco_custo, 0) AS preco_custo,
+                   COALESCE(c.quantidade, 0) AS quantidade_contada,
+                   COALESCE(c.total, 0) AS total_contagens,
+                   COALESCE(c.quantidade, 0) - COALESCE(rs.saldo, 0) AS diferenca,
+                   CASE WHEN COALESCE(rs.saldo, 0) > 0 THEN rs.valor_total / rs.saldo
+                        ELSE COALESCE(p.preco_custo, 0) END AS custo_medio_atual
+            FROM produtos p
+            {join_escopo}
+            LEFT JOIN (
+                SELECT id_produto, SUM(quantidade_padrao) AS quantidade, COUNT(*) AS total
+                FROM contagens
+                WHERE id_inventario = ?
+                GROUP BY id_produto
+            ) c ON c.id_produto = p.id
+            LEFT JOIN unidades_medida u ON p.id_unidade_padrao = u.id
+            LEFT JOIN estoque_saldos_produto rs ON rs.produto_id = p.id
+            WHERE p.ativo = 1 AND p.controla_estoque = 1 {filtro_escopo}
+        )
+    ''', params)
+    db.execute('''
+        INSERT OR REPLACE INTO fechamento_plano_estado (id_inventario, versao, gerado_em)
+        VALUES (?, ?, ?)
+    ''', (inv_id, versao, datetime.now().isoformat()))
+    return versao
+
+
+def obter_plano(db, inventario):
+    """
+    Versão do plano válido do inventário, gerando (e gravando) um novo se não
+    existir ou se os dados mudaram desde a geração.
+    """
+    inv_id = inventario['id']
+    versao = versao_plano(db, inv_id)
+    if versao is not None and versao == versao_atual(db):
+        return versao
+    # Durante o fechamento os ajustes mudam a versão, mas o plano em execução não pode ser trocado
+    if versao is not None and job_ativo(db, inv_id):
+        return versao
+
+    iniciar_transacao_imediata(db)
+    try:
+        versao = gerar_plano(db, inventario)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return versao
+
+
+def itens_plano(db, inventario_id):
+    return [
+        dict(r) for r in db.execute(
+            'SELECT * FROM fechamento_plano WHERE id_inventario = ? ORDER BY produto_nome',
+            (inventario_id,)
+        ).fetchall()
+    ]
+
+
+def resumo_plano(db, inventario_id):
+    """Totalizadores do plano (cards do preview e mensagem de confirmação)."""
+    row = db.execute('''
+        SELECT COUNT(*) AS total_produtos,
+               COALESCE(SUM(tipo_ajuste <> 'OK'), 0) AS total_divergencias,
+               COALESCE(SUM(tipo_ajuste = 'ENTRADA'), 0) AS total_entradas,
+               COALESCE(SUM(tipo_ajuste = 'SAIDA'), 0) AS total_saidas,
+               COALESCE(SUM(tipo_ajuste = 'OK'), 0) AS total_ok,
+               COALESCE(SUM(total_contagens = 0), 0) AS total_nao_contados,
+               COALESCE(SUM(CASE WHEN tipo_ajuste <> 'OK' THEN valor_ajuste ELSE 0 END), 0) AS valor_total_ajustes
+        FROM fechamento_plano
+        WHERE id_inventario = ?
+    ''', (inventario_id,)).fetchone()
+    return dict(row)
+
+
+# ----------------------------
+# Job de fechamento
+# ----------------------------
+
+def job_ativo(db, inventario_id=None):
+    """Job de fechamento ainda não concluído (do inventário, se informado) ou None."""
+    if inventario_id is None:
+        row = db.execute(
+            "SELECT * FROM fechamento_jobs WHERE status <> 'CONCLUIDO' ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+    else:
+        row = db.execute(
+            "SELECT * FROM fechamento_jobs WHERE id_inventario = ? AND status <> 'CONCLUIDO'",
+            (inventario_id,)
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def criar_job(db, inventario_id, versao_revisada, id_usuario=None):
+    """
+    Registra o fechamento do inventário com o plano revisado. O commit fica com o chamador.
+
+    Returns:
+        int: id do job
+
+    Raises:
+        ValueError: fechamento já em andamento, ou plano inexistente ou
+        desatualizado em relação à revisão
+    """
+    # Lock de escrita antes das conferências: nada muda entre elas e o registro do job
+    iniciar_transacao_imediata(db)
+    if job_ativo(db, inventario_id):
+        raise ValueError('O fechamento deste inventário já está em andamento.')
+
+    versao = versao_plano(db, inventario_id)
+    if versao is None or versao != versao_revisada or versao != versao_atual(db):
+        raise ValueError('As contagens ou o estoque mudaram desde a revisão. Revise o fechamento novamente.')
+
+    total_produtos = db.execute(
+        'SELECT COUNT(*) FROM fechamento_plano WHERE id_inventario = ?', (inventario_id,)
+    ).fetchone()[0]
+    cursor = db.execute('''
+        INSERT INTO fechamento_jobs
+            (id_inventario, id_usuario, versao_plano, status, fase, total_produtos, criado_em)
+        VALUES (?, ?, ?, 'PENDENTE', ?, ?, ?)
+    ''', (inventario_id, id_usuario, versao, FASES[0][0], total_produtos, datetime.now().isoformat()))
+    return cursor.lastrowid
+
+
+def _fase_snapshot_locais(db, job):
+    db.execute('DELETE FROM historico_status_locais WHERE id_inventario = ?', (job['id_inventario'],))
+    db.execute('''
+        INSERT INTO historico_status_locais (id_inventario, id_local, status_registrado)
+        SELECT ?, id, status FROM locais
+    ''', (job['id_inventario'],))
+    return {'fase': 'AJUSTES'}
+
+
+def _fase_ajustes(db, job):
+    """
+    Um lote de produtos do plano, a partir do último ajustado. A diferença é
+    recalculada contra o saldo do momento: com o plano ainda válido (conferido
+    na criação do job) é a mesma do preview, e o estoque termina igual ao contado
+    mesmo que entre alguma movimentação enquanto o job roda.
+    """
+    inv_id = job['id_inventario']
+    produtos = db.execute('''
+        SELECT fp.produto_id, fp.quantidade_contada, fp.unidade_padrao,
+               COALESCE(rs.saldo, 0) AS estoque_sistema
+        FROM fechamento_plano fp
+        LEFT JOIN estoque_saldos_produto rs ON rs.produto_id = fp.produto_id
+        WHERE fp.id_inventario = ? AND fp.produto_id > ?
+        ORDER BY fp.produto_id
+        LIMIT ?
+    ''', (inv_id, job['ultimo_produto_id'], LOTE_AJUSTES)).fetchall()
+    if not produtos:
+        return {'fase': 'RESET_LOCAIS'}
+
+    ajustes = []
+    entradas = 0
+    for p in produtos:
+        diferenca = p['quantidade_contada'] - p['estoque_sistema']
+        if abs(diferenca) < TOLERANCIA_AJUSTE:
+            continue
+        tipo = 'ENTRADA' if diferenca > 0 else 'SAIDA'
+        entradas += tipo == 'ENTRADA'
+        ajustes.append({
+            'produto_id': p['produto_id'],
+            'tipo': tipo,
+            'quantidade_original': abs(diferenca),
+            'motivo': 'AJUSTE_INVENTARIO',
+            'unidade_movimentacao': p['unidade_padrao'],
+            'fator_conversao': 1.0,
+            'origem': f'Fechamento Inventário #{inv_id} - Ajuste Automático',
+            'usuario_id': job['id_usuario'],
+            'observacao': (
+                f"Contado: {p['quantidade_contada']:.2f} | Sistema: {p['estoque_sistema']:.2f} | "
+                f"Diferença: {'+' if diferenca > 0 else ''}{diferenca:.2f}"
+            )
+        })
+    if ajustes:
+        registrar_movimentos(db, ajustes)
+
+    return {
+        'ultimo_produto_id': produtos[-1]['produto_id'],
+        'produtos_processados': job['produtos_processados'] + len(produtos),
+        'total_entradas': job['total_entradas'] + entradas,
+        'total_saidas': job['total_saidas'] + len(ajustes) - entradas,
+    }
+
+
+def _fase_reset_locais(db, job):
+    db.execute('UPDATE locais SET status = 0')
+    return {'fase': 'FECHAR'}
+
+
+def _fase_fechar(db, job):
+    db.execute(
+        "UPDATE inventarios SET status='Fechado', data_fechamento = CURRENT_TIMESTAMP WHERE id = ? AND status='Aberto'",
+        (job['id_inventario'],)
+    )
+    return {'status': 'CONCLUIDO', 'concluido_em': datetime.now().isoformat()}
+
+
+_EXECUTORES = {
+    'SNAPSHOT_LOCAIS': _fase_snapshot_locais,
+    'AJUSTES': _fase_ajustes,
+    'RESET_LOCAIS': _fase_reset_locais,
+    'FECHAR': _fase_fechar,
+}
+
+
+def executar_passo(db, job_id):
+    """
+    Executa o próximo passo do job numa transação, gravando o avanço junto.
+
+    Returns:
+        bool: True se ainda há passos pela frente
+    """
+    iniciar_transacao_imediata(db)
+    try:
+        # Relido sob o lock de escrita: dois executores do mesmo job nunca repetem um passo
+        job = db.execute('SELECT * FROM fechamento_jobs WHERE id = ?', (job_id,)).fetchone()
+        if job is None or job['status'] in ('CONCLUIDO', 'ERRO'):
+            db.rollback()
+            return False
+
+        alteracoes = _EXECUTORES[job['fase']](db, dict(job))
+        alteracoes.setdefault('status', 'EXECUTANDO')
+        alteracoes['atualizado_em'] = datetime.now().isoformat()
+        colunas = ', '.join(f'{coluna} = ?' for coluna in alteracoes)
+        db.execute(
+            f'UPDATE fechamento_jobs SET {colunas}, iniciado_em = COALESCE(iniciado_em, ?) WHERE id = ?',
+            [*alteracoes.values(), alteracoes['atualizado_em'], job_id]
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return alteracoes['status'] != 'CONCLUIDO'
+
+
+def executar_job(db, job_id):
+    """Executa (ou retoma) o job até o fim; em caso de falha grava status ERRO e relança."""
+    try:
+        while executar_passo(db, job_id):
+            pass
+    except Exception as exc:
+        db.execute(
+            "UPDATE fechamento_jobs SET status = 'ERRO', erro = ?, atualizado_em = ? WHERE id = ?",
+            (str(exc), datetime.now().isoformat(), job_id)
+        )
+        db.commit()
+        raise
+
+
+def iniciar_execucao(app, job_id):
+    """Executa o job em thread de background (uma por job neste processo)."""
+    with _em_execucao_lock:
+        if job_id in _em_execucao:
+            return None
+        _em_execucao.add(job_id)
+
+    def _executar():
+        try:
+            with conexao(app) as db:
+                executar_job(db, job_id)
+        except Exception:
+            app.logger.exception(f"Falha no fechamento do inventário (job {job_id})")
+        finally:
+            with _em_execucao_lock:
+                _em_execucao.discard(job_id)
+
+    thread = threading.Thread(target=_executar, name=f'fechamento_inventario_{job_id}', daemon=True)
+    thread.start()
+    return thread
+
+
+def retomar_job(db, job_id):
+    """Devolve um job com ERRO para a fila (o commit fica com o chamador). True se havia o que retomar."""
+    cursor = db.execute(
+        "UPDATE fechamento_jobs SET status = 'PENDENTE', erro = NULL WHERE id = ? AND status = 'ERRO'",
+        (job_id,)
+    )
+    return cursor.rowcount > 0
+
+
+def retomar_jobs_pendentes(app):
+    """Na inicialização, retoma em background os fechamentos interrompidos (queda ou reinício)."""
+    def _retomar():
+        try:
+            with conexao(app) as db:
+                pendentes = [
+                    row['id'] for row in db.execute(
+                        "SELECT id FROM fechamento_jobs WHERE status IN ('PENDENTE', 'EXECUTANDO') ORDER BY id"
+                    ).fetchall()
+                ]
+        except Exception:
+            app.logger.exception("Falha ao buscar fechamentos de inventário pendentes")
+            return
+        for job_id in pendentes:
+            app.logger.info(f"Retomando fechamento do inventário (job {job_id})")
+            iniciar_execucao(app, job_id)
+
+    thread = threading.Thread(target=_retomar, name='fechamento_inventario_retomar', daemon=True)
+    thread.start()
+    return thread
+
+
+def progresso_job(job):
+    """Situação do job para o dashboard: fase atual, andamento dos ajustes e percentual geral."""
+    nomes = [nome for nome, _ in FASES]
+    indice = nomes.index(job['fase'])
+    concluido = job['status'] == 'CONCLUIDO'
+
+    fracao_fase = 0.0
+    if job['fase'] == 'AJUSTES' and job['total_produtos']:
+        fracao_fase = job['produtos_processados'] / job['total_produtos']
+    percentual = 100.0 if concluido else (indice + fracao_fase) / len(FASES) * 100
+
+    return {
+        'id': job['id'],
+        'id_inventario': job['id_inventario'],
+        'status': job['status'],
+        'fase': job['fase'],
+        'fase_descricao': FASES[indice][1],
+        'fase_numero': indice + 1,
+        'total_fases': len(FASES),
+        'produtos_processados': job['produtos_processados'],
+        'total_produtos': job['total_produtos'],
+        'total_entradas': job['total_entradas'],
+        'total_saidas': job['total_saidas'],
+        'percentual': round(percentual, 1),
+        'erro': job['erro'],
+    }
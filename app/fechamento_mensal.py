@@ -0,0 +1,244 @@
+"""
+Checkpoints mensais de saldo (tabela saldos_fechamento_mensal).
+
+Cada mês fechado guarda, por produto, o saldo (quantidade e valor) após a
+última movimentação do mês (movimentacoes.saldo_apos/valor_apos). O saldo de
+qualquer data passa a ser o checkpoint do mês anterior + as movimentações
+do próprio mês, em vez da soma de todo o histórico. posicoes_em() dá a
+mesma posição por produto em qualquer instante (consulta /api/estoque/em).
+
+Os checkpoints pendentes (até o mês anterior ao atual) são gerados na
+inicialização e por um job mensal (iniciar_job_fechamento_mensal).
+"""
+from datetime import date, datetime, timedelta
+
+from .db import conexao, iniciar_transacao_imediata
+
+
+def _primeiro_dia(mes):
+    """'YYYY-MM' -> date do primeiro dia do mês."""
+    ano, numero = mes.split('-')
+    return date(int(ano), int(numero), 1)
+
+
+def _mes_seguinte(mes):
+    dia = _primeiro_dia(mes)
+    return (dia.replace(day=28) + timedelta(days=4)).replace(day=1).strftime('%Y-%m')
+
+
+def _mes_anterior(mes):
+    return (_primeiro_dia(mes) - timedelta(days=1)).strftime('%Y-%m')
+
+
+def _gerar_fechamento_mes(db, mes):
+    """Grava o checkpoint de um mês a partir do checkpoint anterior + movimentações do mês."""
+    inicio = _primeiro_dia(mes).isoformat()
+    fim = _primeiro_dia(_mes_seguinte(mes)).isoformat()
+
+    db.execute('''
+        INSERT OR REPLACE INTO saldos_fechamento_mensal (mes, produto_id, saldo, valor_total)
+        SELECT ?, produto_id, saldo, valor_total
+        FROM saldos_fechamento_mensal
+        WHERE mes = ?
+          AND produto_id NOT IN (
+              SELECT id_produto FROM movimentacoes
+              WHERE data_movimento >= ? AND data_movimento < ?
+          )
+    ''', (mes, _mes_anterior(mes), inicio, fim))
+
+    db.execute('''
+        INSERT OR REPLACE INTO saldos_fechamento_mensal (mes, produto_id, saldo, valor_total)
+        SELECT ?, id_produto, COALESCE(saldo_apos, 0), COALESCE(valor_apos, 0)
+        FROM (
+            SELECT id_produto, saldo_apos, valor_apos,
+                   ROW_NUMBER() OVER (PARTITION BY id_produto ORDER BY data_movimento DESC, id DESC) AS ordem
+            FROM movimentacoes
+            WHERE data_movimento >= ? AND data_movimento < ?
+        )
+        WHERE ordem = 1
+    ''', (mes, inicio, fim))
+
+
+def gerar_fechamentos_pendentes(db, hoje=None):
+    """
+    Gera os checkpoints que faltam, do mês seguinte ao último gerado (ou da
+    primeira movimentação) até o mês anterior ao atual.
+
+    Returns:
+        list: meses gerados ('YYYY-MM')
+    """
+    hoje = hoje or date.today()
+    ultimo_fechado = (hoje.replace(day=1) - timedelta(days=1)).strftime('%Y-%m')
+
+    iniciar_transacao_imediata(db)
+    try:
+        row = db.execute('SELECT MAX(mes) AS mes FROM saldos_fechamento_mensal').fetchone()
+        if row['mes']:
+            mes = _mes_seguinte(row['mes'])
+        else:
+            row = db.execute('SELECT MIN(data_movimento) AS data FROM movimentacoes').fetchone()
+            if not row['data']:
+                db.rollback()
+                return []
+            mes = str(row['data'])[:7]
+
+        gerados = []
+        while mes <= ultimo_fechado:
+            _gerar_fechamento_mes(db, mes)
+            gerados.append(mes)
+            mes = _mes_seguinte(mes)
+
+        if gerados:
+            db.execute(
+                'INSERT INTO logs_auditoria (acao, descricao, data_hora) VALUES (?, ?, ?)',
+                ('FECHAMENTO_MENSAL_SALDO',
+                 f"Checkpoints de saldo gerados: {gerados[0]} a {gerados[-1]}",
+                 datetime.now().isoformat())
+            )
+        db.commit()
+        return gerados
+    except Exception:
+        db.rollback()
+        raise
+
+
+def _sql_posicoes(db, limite, produto_id=None, categoria_id=None):
+    """
+    SELECT (produto_id, saldo, valor_total) da posição de cada produto antes
+    de limite (ISO, exclusivo): checkpoint do último mês fechado antes de
+    limite + saldo_apos da última movimentação de cada produto que se moveu
+    entre o checkpoint e limite (busca por faixa em idx_movimentacoes_kardex).
+
+    Returns:
+        tuple: (sql, params)
+    """
+    row = db.execute(
+        'SELECT MAX(mes) AS mes FROM saldos_fechamento_mensal WHERE mes < ?',
+        (limite[:7],)
+    ).fetchone()
+    mes = row['mes'] if row else None
+    inicio_janela = _primeiro_dia(_mes_seguinte(mes)).isoformat() if mes else ''
+
+    filtros_ck = ['c.mes = ?']
+    params_ck = [mes]
+    filtros_mov = ['m.data_movimento >= ?', 'm.data_movimento < ?']
+    params_mov = [inicio_janela, limite]
+    if produto_id:
+        filtros_ck.append('c.produto_id = ?')
+        params_ck.append(produto_id)
+        filtros_mov.append('m.id_produto = ?')
+        params_mov.append(produto_id)
+    if categoria_id:
+        filtros_ck.append('c.produto_id IN (SELECT id_produto FROM produto_categoria_inventario WHERE id_categoria = ?)')
+        params_ck.append(categoria_id)
+        filtros_mov.append('m.id_produto IN (SELECT id_produto FROM produto_categoria_inventario WHERE id_categoria = ?)')
+        params_mov.append(categoria_id)
+
+    sql = f'''
+        SELECT produto_id, COALESCE(saldo_apos, 0) AS saldo, COALESCE(valor_apos, 0) AS valor_total
+        FROM (
+            SELECT m.id_produto AS produto_id, m.saldo_apos, m.valor_apos,
+                   ROW_NUMBER() OVER (PARTITION BY m.id_produto ORDER BY m.data_movimento DESC, m.id DESC) AS ordem
+            FROM movimentacoes m
+            WHERE {' AND '.join(filtros_mov)}
+        )
+        WHERE ordem = 1
+        UNION ALL
+        SELECT c.produto_id, c.saldo, c.valor_total
+        FROM saldos_fechamento_mensal c
+        WHERE {' AND '.join(filtros_ck)}
+          AND NOT EXISTS (
+              SELECT 1 FROM movimentacoes m
+              WHERE m.id_produto = c.produto_id AND m.data_movimento >= ? AND m.data_movimento < ?
+          )
+    '''
+    return sql, params_mov + params_ck + [inicio_janela, limite]
+
+
+def saldo_em(db, data_ref, produto_id=None, categoria_id=None):
+    """
+    Saldo (quantidade e valor) no início de data_ref, somado para todos os
+    produtos ou filtrado por produto/categoria (ver _sql_posicoes).
+
+    Returns:
+        dict: {'saldo': float, 'valor_total': float}
+    """
+    if isinstance(data_ref, date):
+        data_ref = data_ref.isoformat()
+    sql, params = _sql_posicoes(db, str(data_ref)[:10], produto_id, categoria_id)
+
+    row = db.execute(f'''
+        SELECT COALESCE(SUM(saldo), 0) AS saldo, COALESCE(SUM(valor_total), 0) AS valor_total
+        FROM ({sql})
+    ''', params).fetchone()
+
+    return {
+        'saldo': round(float(row['saldo']), 2),
+        'valor_total': round(float(row['valor_total']), 2)
+    }
+
+
+def posicoes_em(db, instante, produto_id=None, categoria_id=None):
+    """
+    Posição de cada produto (quantidade e valor) num instante. Um date vale
+    como fim do dia; um datetime inclui as movimentações até aquele instante.
+    Produtos com saldo e valor zerados ficam de fora.
+
+    Returns:
+        list[dict]: {'produto_id', 'nome', 'saldo', 'valor_total', 'custo_medio'}
+    """
+    if isinstance(instante, datetime):
+        limite = (instante + timedelta(microseconds=1)).isoformat()
+    else:
+        limite = (instante + timedelta(days=1)).isoformat()
+    sql, params = _sql_posicoes(db, limite, produto_id, categoria_id)
+
+    rows = db.execute(f'''
+        SELECT x.produto_id, p.nome, x.saldo, x.valor_total
+        FROM ({sql}) x
+        JOIN produtos p ON p.id = x.produto_id
+        WHERE x.saldo <> 0 OR x.valor_total <> 0
+        ORDER BY p.nome
+    ''', params).fetchall()
+
+    return [
+        {
+            'produto_id': row['produto_id'],
+            'nome': row['nome'],
+            'saldo': round(float(row['saldo']), 4),
+            'valor_total': round(float(row['valor_total']), 2),
+            'custo_medio': round(float(row['valor_total']) / float(row['saldo']), 4) if row['saldo'] else 0.0
+        }
+        for row in rows
+    ]
+
+
+def iniciar_job_fechamento_mensal(app):
+    """Agenda a geração dos checkpoints no dia 1 de cada mês (00:05)."""
+    def _executar():
+        with conexao(app) as db:
+            gerados = gerar_fechamentos_pendentes(db)
+        if gerados:
+            app.logger.info(f"Checkpoints de saldo gerados: {', '.join(gerados)}")
+
+    try:
+        from apscheduler.schedulers.background import BackgroundScheduler
+
+        scheduler = BackgroundScheduler()
+        scheduler.add_job(
+            func=_executar,
+            trigger='cron',
+            day=1,
+            hour=0,
+            minute=5,
+            id='fechamento_mensal_job',
+            name='Checkpoints mensais de saldo',
+            replace_existing=True
+        )
+        scheduler.start()
+
+        import atexit
+        atexit.register(lambda: scheduler.shutdown())
+
+    except ImportError:
+        app.logger.warning("⚠️  APScheduler não está instalado. Checkpoints mensais só serão gerados na inicialização.")
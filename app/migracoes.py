@@ -0,0 +1,862 @@
+"""
+Migrações de esquema do banco de dados.
+
+Cada migração é aplicada uma única vez, em ordem, e a versão atual do esquema
+fica gravada em PRAGMA user_version. O runner é chamado apenas na inicialização
+(create_app); as rotas não executam mais DDL.
+
+Para alterar o esquema, acrescente uma nova função ao final de MIGRACOES
+(nunca altere uma migração já publicada).
+"""
+import importlib.util
+import os
+from datetime import datetime
+
+from .db import iniciar_transacao_imediata
+
+CAMINHO_SETUP = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'database', 'setup_db_v2.py')
+
+
+def _tabela_existe(db, tabela):
+    row = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (tabela,)
+    ).fetchone()
+    return row is not None
+
+
+def _colunas(db, tabela):
+    return {row['name'] for row in db.execute(f'PRAGMA table_info({tabela})').fetchall()}
+
+
+def _adicionar_coluna(db, tabela, coluna, definicao):
+    """ALTER TABLE ADD COLUMN apenas se a tabela existir e ainda não tiver a coluna."""
+    if not _tabela_existe(db, tabela):
+        return False
+    if coluna in _colunas(db, tabela):
+        return False
+    db.execute(f'ALTER TABLE {tabela} ADD COLUMN {coluna} {definicao}')
+    return True
+
+
+def _carregar_setup():
+    spec = importlib.util.spec_from_file_location('setup_db_v2', CAMINHO_SETUP)
+    modulo = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modulo)
+    return modulo
+
+
+# ----------------------------
+# Migrações
+# ----------------------------
+
+def _m001_esquema_base(db):
+    """
+    Esquema base do database/setup_db_v2.py + colunas que antes eram
+    garantidas em tempo de requisição (ensure_finance_schema,
+    ensure_materias_primas_schema e _garantir_colunas_financeiras).
+    """
+    # Bancos antigos: colunas adicionadas depois da criação das tabelas.
+    # Precisam existir antes dos CREATE INDEX do setup.
+    _adicionar_coluna(db, 'produtos', 'materia_prima_id', 'INTEGER')
+    _adicionar_coluna(db, 'lotes_movimentacao', 'exportado_financeiro', 'INTEGER NOT NULL DEFAULT 0')
+    _adicionar_coluna(db, 'estoque_saldos', 'valor_total', 'REAL NOT NULL DEFAULT 0.0')
+    _adicionar_coluna(db, 'estoque_saldos', 'custo_medio', 'REAL NOT NULL DEFAULT 0.0')
+
+    # Sem commit: o esquema base grava junto com o user_version desta migração
+    _carregar_setup().criar_tabelas(db, commit=False)
+
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_materias_primas_nome ON materias_primas(nome)")
+
+    # Valoriza saldos que ainda não têm valor_total (preço de custo atual do produto)
+    db.execute('''
+        UPDATE estoque_saldos
+        SET valor_total = COALESCE((
+            SELECT COALESCE(p.preco_custo, 0) * estoque_saldos.saldo
+            FROM produtos p WHERE p.id = estoque_saldos.produto_id
+        ), 0)
+        WHERE saldo <> 0 AND valor_total = 0
+    ''')
+    db.execute('''
+        UPDATE estoque_saldos
+        SET custo_medio = CASE WHEN saldo <> 0 THEN valor_total / saldo ELSE 0 END
+        WHERE saldo <> 0 AND custo_medio = 0
+    ''')
+
+
+def _m002_chave_posicao_estoque(db):
+    """
+    Índice único em (produto, setor, local) com NULL normalizado para 0.
+    O UNIQUE original não impede duplicatas com NULL (NULL <> NULL); as
+    eventuais duplicatas são somadas na linha de menor id antes do índice.
+    """
+    db.execute('''
+        CREATE TEMP TABLE _posicoes_duplicadas AS
+        SELECT MIN(id) AS id_manter,
+               produto_id,
+               IFNULL(setor_id, 0) AS setor_chave,
+               IFNULL(local_id, 0) AS local_chave,
+               SUM(saldo) AS saldo,
+               SUM(valor_total) AS valor_total
+        FROM estoque_saldos
+        GROUP BY produto_id, IFNULL(setor_id, 0), IFNULL(local_id, 0)
+        HAVING COUNT(*) > 1
+    ''')
+    db.execute('''
+        UPDATE estoque_saldos
+        SET saldo = d.saldo,
+            valor_total = d.valor_total,
+            custo_medio = CASE WHEN d.saldo > 0 THEN ROUND(d.valor_total / d.saldo, 2) ELSE 0 END
+        FROM _posicoes_duplicadas d
+        WHERE estoque_saldos.id = d.id_manter
+    ''')
+    db.execute('''
+        DELETE FROM estoque_saldos
+        WHERE id IN (
+            SELECT es.id
+            FROM estoque_saldos es
+            JOIN _posicoes_duplicadas d
+              ON d.produto_id = es.produto_id
+             AND d.setor_chave = IFNULL(es.setor_id, 0)
+             AND d.local_chave = IFNULL(es.local_id, 0)
+            WHERE es.id <> d.id_manter
+        )
+    ''')
+    db.execute('DROP TABLE _posicoes_duplicadas')
+
+    db.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_estoque_saldos_posicao
+        ON estoque_saldos(produto_id, IFNULL(setor_id, 0), IFNULL(local_id, 0))
+    ''')
+
+
+def _sql_recalcular_rollups(ref):
+    """
+    Comandos (para corpo de trigger) que recalculam os totais do produto e do
+    setor da linha NEW/OLD de estoque_saldos. A soma é refeita a partir das
+    posições (poucas por produto, via índice) em vez de aplicar deltas, para
+    que o total nunca acumule erro de ponto flutuante. Produto/setor sem
+    posições fica sem linha (leitores usam COALESCE(..., 0)).
+    """
+    return f'''
+        DELETE FROM estoque_saldos_produto WHERE produto_id = {ref}.produto_id;
+
+        INSERT INTO estoque_saldos_produto (produto_id, saldo, valor_total)
+        SELECT produto_id, SUM(saldo), SUM(valor_total)
+        FROM estoque_saldos WHERE produto_id = {ref}.produto_id
+        GROUP BY produto_id;
+
+        DELETE FROM estoque_saldos_setor
+        WHERE {ref}.setor_id IS NOT NULL
+          AND produto_id = {ref}.produto_id AND setor_id = {ref}.setor_id;
+
+        INSERT INTO estoque_saldos_setor (produto_id, setor_id, saldo, valor_total)
+        SELECT {ref}.produto_id, {ref}.setor_id, SUM(saldo), SUM(valor_total)
+        FROM estoque_saldos
+        WHERE {ref}.setor_id IS NOT NULL
+          AND produto_id = {ref}.produto_id AND setor_id = {ref}.setor_id
+        GROUP BY produto_id, setor_id;
+    '''
+
+
+def _m003_rollups_saldo(db):
+    """
+    Totais mantidos de estoque_saldos: por produto (leitura do modo CENTRAL)
+    e por produto/setor (total do setor no modo LOCAL). Mantidos por triggers
+    para que qualquer escrita em estoque_saldos (motor de movimentos,
+    migrações, ferramentas) os atualize na mesma transação.
+    """
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS estoque_saldos_produto (
+            produto_id INTEGER PRIMARY KEY,
+            saldo REAL NOT NULL DEFAULT 0,
+            valor_total REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS estoque_saldos_setor (
+            produto_id INTEGER NOT NULL,
+            setor_id INTEGER NOT NULL,
+            saldo REAL NOT NULL DEFAULT 0,
+            valor_total REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (produto_id, setor_id)
+        ) WITHOUT ROWID
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_estoque_saldos_setor_setor ON estoque_saldos_setor(setor_id)')
+
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_estoque_saldos_rollup_ins
+        AFTER INSERT ON estoque_saldos
+        BEGIN {_sql_recalcular_rollups('NEW')} END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_estoque_saldos_rollup_del
+        AFTER DELETE ON estoque_saldos
+        BEGIN {_sql_recalcular_rollups('OLD')} END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_estoque_saldos_rollup_upd
+        AFTER UPDATE OF produto_id, setor_id, saldo, valor_total ON estoque_saldos
+        BEGIN {_sql_recalcular_rollups('OLD')} {_sql_recalcular_rollups('NEW')} END
+    ''')
+
+    db.execute('DELETE FROM estoque_saldos_produto')
+    db.execute('''
+        INSERT INTO estoque_saldos_produto (produto_id, saldo, valor_total)
+        SELECT produto_id, SUM(saldo), SUM(valor_total)
+        FROM estoque_saldos
+        GROUP BY produto_id
+    ''')
+    db.execute('DELETE FROM estoque_saldos_setor')
+    db.execute('''
+        INSERT INTO estoque_saldos_setor (produto_id, setor_id, saldo, valor_total)
+        SELECT produto_id, setor_id, SUM(saldo), SUM(valor_total)
+        FROM estoque_saldos
+        WHERE setor_id IS NOT NULL
+        GROUP BY produto_id, setor_id
+    ''')
+
+
+def _m004_saldo_apos_movimentacoes(db):
+    """
+    Saldo do produto (quantidade e valor) logo após cada movimentação, gravado
+    pelo motor de movimentos, e índice (produto, data, id) para paginar o Kardex.
+    O histórico existente é preenchido a partir do saldo atual (rollup da
+    migração 3), descontando os movimentos posteriores; o valor é aproximado
+    (não reproduz o zeramento de custo em saldo <= 0) e pode ser recalculado
+    exatamente com tools/recalcular_custo_medio.py.
+    """
+    _adicionar_coluna(db, 'movimentacoes', 'saldo_apos', 'REAL')
+    _adicionar_coluna(db, 'movimentacoes', 'valor_apos', 'REAL')
+
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_movimentacoes_kardex
+        ON movimentacoes(id_produto, data_movimento, id)
+    ''')
+
+    # Ancorado no saldo atual: saldo após o movimento = saldo atual - efeito dos movimentos seguintes
+    db.execute('''
+        WITH posteriores AS (
+            SELECT id, id_produto,
+                   SUM(CASE WHEN tipo = 'ENTRADA' THEN quantidade ELSE -quantidade END) OVER w AS qtd_depois,
+                   SUM(CASE WHEN tipo = 'ENTRADA' THEN COALESCE(valor_total, 0) ELSE -ABS(COALESCE(valor_total, 0)) END) OVER w AS valor_depois
+            FROM movimentacoes
+            WINDOW w AS (
+                PARTITION BY id_produto ORDER BY data_movimento, id
+                ROWS BETWEEN 1 FOLLOWING AND UNBOUNDED FOLLOWING
+            )
+        )
+        UPDATE movimentacoes
+        SET saldo_apos = ROUND(COALESCE(rs.saldo, 0) - COALESCE(a.qtd_depois, 0), 2),
+            valor_apos = COALESCE(rs.valor_total, 0) - COALESCE(a.valor_depois, 0)
+        FROM posteriores a
+        LEFT JOIN estoque_saldos_produto rs ON rs.produto_id = a.id_produto
+        WHERE movimentacoes.id = a.id
+    ''')
+
+
+
+def _m005_saldos_fechamento_mensal(db):
+    """
+    Checkpoint do saldo de cada produto no fim de cada mês (saldo_apos da
+    última movimentação do mês), gerado por app/fechamento_mensal.py. Saldos
+    iniciais passam a ser o checkpoint anterior + as movimentações do mês.
+    """
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS saldos_fechamento_mensal (
+            mes TEXT NOT NULL,
+            produto_id INTEGER NOT NULL,
+            saldo REAL NOT NULL DEFAULT 0,
+            valor_total REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (mes, produto_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _m006_indices_periodo(db):
+    """Índices para os filtros de período (intervalo semiaberto) em lotes e inventários."""
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_lotes_status_data
+        ON lotes_movimentacao(status, data_criacao)
+    ''')
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_lotes_data
+        ON lotes_movimentacao(data_criacao)
+    ''')
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_inventarios_data_criacao
+        ON inventarios(data_criacao)
+    ''')
+
+
+def _m007_snapshots_delta(db):
+    """
+    saldos_historico passa a guardar só mudanças: um quadro COMPLETO por mês
+    (primeiro dia gerado no mês) e, nos demais dias, apenas os produtos cujo
+    saldo mudou (quantidade 0 = produto saiu do estoque). saldos_historico_dias
+    registra os dias gerados e o tipo de cada um (ver app/snapshots.py).
+    Os snapshots completos já gravados são convertidos para esse formato.
+    """
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS saldos_historico_dias (
+            data_ref TEXT PRIMARY KEY,
+            tipo TEXT NOT NULL CHECK(tipo IN ('COMPLETO', 'DELTA'))
+        ) WITHOUT ROWID
+    ''')
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_saldos_historico_dias_tipo
+        ON saldos_historico_dias(tipo, data_ref)
+    ''')
+
+    db.execute('''
+        INSERT OR IGNORE INTO saldos_historico_dias (data_ref, tipo)
+        SELECT data_ref,
+               CASE WHEN data_ref = MIN(data_ref) OVER (PARTITION BY substr(data_ref, 1, 7))
+                    THEN 'COMPLETO' ELSE 'DELTA' END
+        FROM (SELECT DISTINCT data_ref FROM saldos_historico)
+    ''')
+
+    # Dia anterior gerado de cada dia DELTA (todos os dias existentes ainda são completos)
+    db.execute('''
+        CREATE TEMP TABLE _dias_delta AS
+        SELECT data_ref, anterior FROM (
+            SELECT data_ref, tipo, LAG(data_ref) OVER (ORDER BY data_ref) AS anterior
+            FROM saldos_historico_dias
+        )
+        WHERE tipo = 'DELTA'
+    ''')
+    db.execute('''
+        CREATE TEMP TABLE _sem_mudanca AS
+        SELECT sh.id
+        FROM saldos_historico sh
+        JOIN _dias_delta d ON d.data_ref = sh.data_ref
+        JOIN saldos_historico ant
+          ON ant.data_ref = d.anterior AND ant.produto_id = sh.produto_id
+        WHERE ant.quantidade = sh.quantidade AND ant.valor_total = sh.valor_total
+    ''')
+    db.execute('''
+        CREATE TEMP TABLE _saidas AS
+        SELECT d.data_ref, ant.produto_id
+        FROM _dias_delta d
+        JOIN saldos_historico ant ON ant.data_ref = d.anterior
+        WHERE NOT EXISTS (
+            SELECT 1 FROM saldos_historico sh
+            WHERE sh.data_ref = d.data_ref AND sh.produto_id = ant.produto_id
+        )
+    ''')
+
+    db.execute('DELETE FROM saldos_historico WHERE id IN (SELECT id FROM _sem_mudanca)')
+    db.execute('''
+        INSERT OR IGNORE INTO saldos_historico (data_ref, produto_id, quantidade, preco_custo_unitario, valor_total)
+        SELECT data_ref, produto_id, 0, 0, 0 FROM _saidas
+    ''')
+
+    db.execute('DROP TABLE _dias_delta')
+    db.execute('DROP TABLE _sem_mudanca')
+    db.execute('DROP TABLE _saidas')
+
+
+def _sql_versionar_catalogo(ref_produto=None):
+    """
+    Comandos (para corpo de trigger) que incrementam a versão do catálogo e,
+    se ref_produto for dado, marcam o produto com a nova versão.
+    """
+    sql = 'UPDATE catalogo_versao SET versao = versao + 1 WHERE id = 1;'
+    if ref_produto:
+        sql += f'''
+        UPDATE produtos SET versao_catalogo = (SELECT versao FROM catalogo_versao WHERE id = 1)
+        WHERE id = {ref_produto};
+        '''
+    return sql
+
+
+def _m008_versao_catalogo(db):
+    """
+    Versão do catálogo de contagem (/api/catalogo): contador único em
+    catalogo_versao, incrementado por triggers a cada mudança em produtos,
+    unidades do produto, categorias do produto ou unidades de medida.
+    produtos.versao_catalogo guarda a versão da última mudança de cada
+    produto e catalogo_removidos os produtos excluídos, para que os tablets
+    baixem só o que mudou desde a versão que já têm.
+    """
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS catalogo_versao (
+            id INTEGER PRIMARY KEY CHECK(id = 1),
+            versao INTEGER NOT NULL
+        )
+    ''')
+    db.execute('INSERT OR IGNORE INTO catalogo_versao (id, versao) VALUES (1, 1)')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS catalogo_removidos (
+            produto_id INTEGER PRIMARY KEY,
+            versao INTEGER NOT NULL
+        )
+    ''')
+
+    if _adicionar_coluna(db, 'produtos', 'versao_catalogo', 'INTEGER NOT NULL DEFAULT 0'):
+        db.execute('UPDATE produtos SET versao_catalogo = 1')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_produtos_versao_catalogo ON produtos(versao_catalogo)')
+
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_catalogo_produtos_ins
+        AFTER INSERT ON produtos
+        BEGIN {_sql_versionar_catalogo('NEW.id')} END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_catalogo_produtos_upd
+        AFTER UPDATE OF nome, id_erp, gtin, id_unidade_padrao, ativo ON produtos
+        BEGIN {_sql_versionar_catalogo('NEW.id')} END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_catalogo_produtos_del
+        AFTER DELETE ON produtos
+        BEGIN
+            {_sql_versionar_catalogo()}
+            INSERT OR REPLACE INTO catalogo_removidos (produto_id, versao)
+            VALUES (OLD.id, (SELECT versao FROM catalogo_versao WHERE id = 1));
+        END
+    ''')
+
+    for tabela in ('produtos_unidades', 'produto_categoria_inventario'):
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_catalogo_{tabela}_ins
+            AFTER INSERT ON {tabela}
+            BEGIN {_sql_versionar_catalogo('NEW.id_produto')} END
+        ''')
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_catalogo_{tabela}_upd
+            AFTER UPDATE ON {tabela}
+            BEGIN {_sql_versionar_catalogo('OLD.id_produto')} {_sql_versionar_catalogo('NEW.id_produto')} END
+        ''')
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_catalogo_{tabela}_del
+            AFTER DELETE ON {tabela}
+            BEGIN {_sql_versionar_catalogo('OLD.id_produto')} END
+        ''')
+
+    for evento in ('INSERT', 'UPDATE', 'DELETE'):
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_catalogo_unidades_medida_{evento.lower()[:3]}
+            AFTER {evento} ON unidades_medida
+            BEGIN {_sql_versionar_catalogo()} END
+        ''')
+
+
+def _m009_uuid_contagens(db):
+    """
+    contagens.uuid: identificador gerado no tablet para cada contagem da
+    fila offline. O índice único torna o reenvio (/salvar_contagens) idempotente.
+    """
+    _adicionar_coluna(db, 'contagens', 'uuid', 'TEXT')
+    db.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_contagens_uuid
+        ON contagens(uuid) WHERE uuid IS NOT NULL
+    ''')
+
+
+def _m010_indice_historico_local(db):
+    """Histórico de contagens de um local (tela de contagem e /historico?desde=)."""
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_contagens_local
+        ON contagens(id_inventario, id_local, id)
+    ''')
+
+
+def _m011_versao_dados(db):
+    """
+    Contador de versão dos dados do inventário (heartbeat e /api/eventos):
+    incrementado por triggers a cada escrita em contagens, ocorrências,
+    status dos locais e status dos inventários, em vez de derivado de COUNT(*).
+    """
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS versao_dados (
+            id INTEGER PRIMARY KEY CHECK(id = 1),
+            versao INTEGER NOT NULL
+        )
+    ''')
+    db.execute('INSERT OR IGNORE INTO versao_dados (id, versao) VALUES (1, 1)')
+
+    gatilhos = [
+        ('contagens', 'INSERT', 'ins'),
+        ('contagens', 'UPDATE', 'upd'),
+        ('contagens', 'DELETE', 'del'),
+        ('ocorrencias', 'INSERT', 'ins'),
+        ('ocorrencias', 'UPDATE', 'upd'),
+        ('ocorrencias', 'DELETE', 'del'),
+        ('locais', 'UPDATE OF status', 'upd'),
+        ('inventarios', 'INSERT', 'ins'),
+        ('inventarios', 'UPDATE OF status', 'upd'),
+    ]
+    for tabela, evento, sufixo in gatilhos:
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_versao_dados_{tabela}_{sufixo}
+            AFTER {evento} ON {tabela}
+            BEGIN UPDATE versao_dados SET versao = versao + 1 WHERE id = 1; END
+        ''')
+
+
+def _sql_totais_contagem(ref, sinal):
+    """
+    Comandos (para corpo de trigger) que somam (sinal '+') ou subtraem ('-')
+    a linha NEW/OLD de contagens nos totais por produto e por local. Ao
+    contrário dos totais de saldo (migração 3), aplicam a diferença: excluir
+    um inventário inteiro custa uma atualização por contagem, não uma nova
+    soma por contagem. Quando a última contagem de uma chave sai, a linha é
+    removida, o que também descarta qualquer resíduo de ponto flutuante.
+    """
+    if sinal == '+':
+        return f'''
+            INSERT INTO contagens_totais_produto
+                (id_inventario, id_produto, id_unidade, quantidade, qtd_contagens)
+            VALUES ({ref}.id_inventario, {ref}.id_produto, {ref}.id_unidade_usada, {ref}.quantidade, 1)
+            ON CONFLICT (id_inventario, id_produto, id_unidade) DO UPDATE SET
+                quantidade = quantidade + excluded.quantidade,
+                qtd_contagens = qtd_contagens + 1;
+
+            INSERT INTO contagens_totais_local
+                (id_inventario, id_local, id_produto, id_unidade, quantidade, qtd_contagens)
+            VALUES ({ref}.id_inventario, {ref}.id_local, {ref}.id_produto, {ref}.id_unidade_usada, {ref}.quantidade, 1)
+            ON CONFLICT (id_inventario, id_local, id_produto, id_unidade) DO UPDATE SET
+                quantidade = quantidade + excluded.quantidade,
+                qtd_contagens = qtd_contagens + 1;
+        '''
+    chave_produto = f'''
+        id_inventario = {ref}.id_inventario AND id_produto = {ref}.id_produto
+        AND id_unidade = {ref}.id_unidade_usada
+    '''
+    chave_local = f'{chave_produto} AND id_local = {ref}.id_local'
+    return f'''
+        UPDATE contagens_totais_produto
+        SET quantidade = quantidade - {ref}.quantidade, qtd_contagens = qtd_contagens - 1
+        WHERE {chave_produto};
+        DELETE FROM contagens_totais_produto WHERE {chave_produto} AND qtd_contagens <= 0;
+
+        UPDATE contagens_totais_local
+        SET quantidade = quantidade - {ref}.quantidade, qtd_contagens = qtd_contagens - 1
+        WHERE {chave_local};
+        DELETE FROM contagens_totais_local WHERE {chave_local} AND qtd_contagens <= 0;
+    '''
+
+
+def _m012_totais_contagem(db):
+    """
+    Totais contados do inventário, mantidos por triggers em contagens: por
+    produto/unidade (dashboard, monitoramento, detalhe do produto) e por
+    local/produto/unidade (monitoramento do setor). Guardam a quantidade na
+    unidade usada; fator de conversão e preço continuam lidos na hora, como
+    antes. As telas passam a custar proporcional aos itens distintos, não ao
+    número de contagens lançadas.
+    """
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS contagens_totais_produto (
+            id_inventario INTEGER NOT NULL,
+            id_produto INTEGER NOT NULL,
+            id_unidade INTEGER NOT NULL,
+            quantidade REAL NOT NULL DEFAULT 0,
+            qtd_contagens INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (id_inventario, id_produto, id_unidade)
+        ) WITHOUT ROWID
+    ''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS contagens_totais_local (
+            id_inventario INTEGER NOT NULL,
+            id_local INTEGER NOT NULL,
+            id_produto INTEGER NOT NULL,
+            id_unidade INTEGER NOT NULL,
+            quantidade REAL NOT NULL DEFAULT 0,
+            qtd_contagens INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (id_inventario, id_local, id_produto, id_unidade)
+        ) WITHOUT ROWID
+    ''')
+
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_contagens_totais_ins
+        AFTER INSERT ON contagens
+        BEGIN {_sql_totais_contagem('NEW', '+')} END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_contagens_totais_del
+        AFTER DELETE ON contagens
+        BEGIN {_sql_totais_contagem('OLD', '-')} END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_contagens_totais_upd
+        AFTER UPDATE OF id_inventario, id_local, id_produto, id_unidade_usada, quantidade ON contagens
+        BEGIN {_sql_totais_contagem('OLD', '-')} {_sql_totais_contagem('NEW', '+')} END
+    ''')
+
+    # Inventário aberto (lido por todas as telas de contagem e monitoramento)
+    db.execute('CREATE INDEX IF NOT EXISTS idx_inventarios_status ON inventarios(status)')
+
+    db.execute('DELETE FROM contagens_totais_produto')
+    db.execute('''
+        INSERT INTO contagens_totais_produto (id_inventario, id_produto, id_unidade, quantidade, qtd_contagens)
+        SELECT id_inventario, id_produto, id_unidade_usada, SUM(quantidade), COUNT(*)
+        FROM contagens
+        GROUP BY id_inventario, id_produto, id_unidade_usada
+    ''')
+    db.execute('DELETE FROM contagens_totais_local')
+    db.execute('''
+        INSERT INTO contagens_totais_local (id_inventario, id_local, id_produto, id_unidade, quantidade, qtd_contagens)
+        SELECT id_inventario, id_local, id_produto, id_unidade_usada, SUM(quantidade), COUNT(*)
+        FROM contagens
+        GROUP BY id_inventario, id_local, id_produto, id_unidade_usada
+    ''')
+
+
+def _m013_busca_produtos(db):
+    """
+    Índice FTS5 de busca de produtos (app/busca_produtos.py) sobre nome,
+    id_erp, gtin e categoria, sem acentos e com índice de prefixo, sincronizado
+    com produtos por triggers. Índice em gtin para a busca exata por código
+    (id_erp já tem o índice único).
+    """
+    db.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS produtos_busca USING fts5(
+            nome, id_erp, gtin, categoria,
+            content='produtos', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    colunas = 'nome, id_erp, gtin, categoria'
+    novos = 'NEW.id, NEW.nome, NEW.id_erp, NEW.gtin, NEW.categoria'
+    antigos = 'OLD.id, OLD.nome, OLD.id_erp, OLD.gtin, OLD.categoria'
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_produtos_busca_ins
+        AFTER INSERT ON produtos
+        BEGIN
+            INSERT INTO produtos_busca (rowid, {colunas}) VALUES ({novos});
+        END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_produtos_busca_del
+        AFTER DELETE ON produtos
+        BEGIN
+            INSERT INTO produtos_busca (produtos_busca, rowid, {colunas}) VALUES ('delete', {antigos});
+        END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_produtos_busca_upd
+        AFTER UPDATE OF nome, id_erp, gtin, categoria ON produtos
+        BEGIN
+            INSERT INTO produtos_busca (produtos_busca, rowid, {colunas}) VALUES ('delete', {antigos});
+            INSERT INTO produtos_busca (rowid, {colunas}) VALUES ({novos});
+        END
+    ''')
+    db.execute("INSERT INTO produtos_busca (produtos_busca) VALUES ('rebuild')")
+
+    db.execute('CREATE INDEX IF NOT EXISTS idx_produtos_gtin ON produtos(gtin) WHERE gtin IS NOT NULL')
+
+
+def _m014_indice_nome_produtos(db):
+    """Ordem (nome, id) das listagens de produtos paginadas por cursor (app/paginacao.py)."""
+    db.execute('CREATE INDEX IF NOT EXISTS idx_produtos_nome ON produtos(nome)')
+
+
+def _m015_plano_fechamento(db):
+    """
+    Plano de fechamento do inventário (app/fechamento_inventario.py): a
+    comparação contado x sistema por produto, calculada uma vez no preview e
+    usada pela exportação e pela confirmação, e a versão dos dados com que
+    foi gerada.
+    """
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS fechamento_plano (
+            id_inventario INTEGER NOT NULL,
+            produto_id INTEGER NOT NULL,
+            produto_nome TEXT NOT NULL,
+            id_erp TEXT,
+            gtin TEXT,
+            unidade_padrao TEXT,
+            estoque_sistema REAL NOT NULL,
+            valor_total_estoque REAL NOT NULL,
+            preco_custo REAL NOT NULL,
+            quantidade_contada REAL NOT NULL,
+            total_contagens INTEGER NOT NULL,
+            diferenca REAL NOT NULL,
+            tipo_ajuste TEXT NOT NULL CHECK(tipo_ajuste IN ('OK', 'ENTRADA', 'SAIDA')),
+            custo_medio_atual REAL NOT NULL,
+            valor_ajuste REAL NOT NULL,
+            PRIMARY KEY (id_inventario, produto_id),
+            FOREIGN KEY (id_inventario) REFERENCES inventarios(id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS fechamento_plano_estado (
+            id_inventario INTEGER PRIMARY KEY,
+            versao TEXT NOT NULL,
+            gerado_em TEXT NOT NULL,
+            FOREIGN KEY (id_inventario) REFERENCES inventarios(id) ON DELETE CASCADE
+        )
+    ''')
+
+
+def _m016_jobs_fechamento(db):
+    """
+    Job de fechamento do inventário em background (app/fechamento_inventario.py):
+    fase atual e posição dentro dela, para exibir o progresso e retomar após
+    uma queda. O índice único parcial permite um só fechamento não concluído
+    por inventário; enquanto ele existe, as contagens do inventário ficam
+    bloqueadas.
+    """
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS fechamento_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id_inventario INTEGER NOT NULL,
+            id_usuario INTEGER,
+            versao_plano TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'PENDENTE'
+                CHECK(status IN ('PENDENTE', 'EXECUTANDO', 'CONCLUIDO', 'ERRO')),
+            fase TEXT NOT NULL DEFAULT 'SNAPSHOT_LOCAIS'
+                CHECK(fase IN ('SNAPSHOT_LOCAIS', 'AJUSTES', 'RESET_LOCAIS', 'FECHAR')),
+            ultimo_produto_id INTEGER NOT NULL DEFAULT 0,
+            produtos_processados INTEGER NOT NULL DEFAULT 0,
+            total_produtos INTEGER NOT NULL DEFAULT 0,
+            total_entradas INTEGER NOT NULL DEFAULT 0,
+            total_saidas INTEGER NOT NULL DEFAULT 0,
+            erro TEXT,
+            criado_em TEXT NOT NULL,
+            iniciado_em TEXT,
+            atualizado_em TEXT,
+            concluido_em TEXT,
+            FOREIGN KEY (id_inventario) REFERENCES inventarios(id) ON DELETE CASCADE
+        )
+    ''')
+    db.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_fechamento_jobs_ativo
+        ON fechamento_jobs(id_inventario) WHERE status <> 'CONCLUIDO'
+    ''')
+
+    em_fechamento = '''
+        EXISTS (SELECT 1 FROM fechamento_jobs
+                WHERE id_inventario = {ref}.id_inventario AND status <> 'CONCLUIDO')
+    '''
+    for evento, sufixo, ref in (('INSERT', 'ins', 'NEW'), ('UPDATE', 'upd', 'OLD'), ('DELETE', 'del', 'OLD')):
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_contagens_fechamento_{sufixo}
+            BEFORE {evento} ON contagens
+            WHEN {em_fechamento.format(ref=ref)}
+            BEGIN SELECT RAISE(ABORT, 'Inventário em fechamento: contagens bloqueadas'); END
+        ''')
+
+
+def _m017_fila_lotes_pendentes(db):
+    """
+    Fila de aprovação dos lotes (v_lotes_fila): posição de cada lote pendente
+    por ordem de criação, calculada numa única leitura por janela sobre o
+    índice (status, data_criacao) da migração 6, que cobre id e data_criacao.
+    v_lotes_pendentes passa a trazer a posição e o número de lotes anteriores
+    pendentes, que a tela de pendentes calculava com um COUNT por lote.
+    """
+    db.execute('''
+        CREATE VIEW IF NOT EXISTS v_lotes_fila AS
+        SELECT id,
+               data_criacao,
+               ROW_NUMBER() OVER (ORDER BY data_criacao, id) AS posicao_fila
+        FROM lotes_movimentacao
+        WHERE status = 'PENDENTE_APROVACAO'
+    ''')
+    db.execute('DROP VIEW IF EXISTS v_lotes_pendentes')
+    db.execute('''
+        CREATE VIEW v_lotes_pendentes AS
+        SELECT
+            l.*,
+            f.posicao_fila,
+            f.posicao_fila - 1 AS lotes_anteriores_pendentes,
+            u.nome AS usuario_nome,
+            u.funcao AS usuario_funcao,
+            COUNT(i.id) AS total_itens,
+            SUM(i.quantidade_original * i.fator_conversao * COALESCE(i.preco_custo_unitario, 0)) AS valor_total
+        FROM v_lotes_fila f
+        JOIN lotes_movimentacao l ON l.id = f.id
+        LEFT JOIN usuarios u ON l.id_usuario = u.id
+        LEFT JOIN lotes_movimentacao_itens i ON l.id = i.id_lote
+        GROUP BY l.id
+    ''')
+
+
+# (versão, descrição, função) — em ordem crescente de versão
+def _m018_versao_produtos(db):
+    """
+    Contador de versão da tabela produtos, incrementado por triggers a cada
+    INSERT, UPDATE (qualquer coluna) ou DELETE. Os agregados de listagem em
+    cache (agregar_com_cache) que dependem de preço, curva ABC ou categoria
+    usam este contador: catalogo_versao só acompanha as colunas do catálogo
+    dos tablets.
+    """
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS produtos_versao (
+            id INTEGER PRIMARY KEY CHECK(id = 1),
+            versao INTEGER NOT NULL
+        )
+    ''')
+    db.execute('INSERT OR IGNORE INTO produtos_versao (id, versao) VALUES (1, 1)')
+
+    for evento, sufixo in (('INSERT', 'ins'), ('UPDATE', 'upd'), ('DELETE', 'del')):
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_produtos_versao_{sufixo}
+            AFTER {evento} ON produtos
+            BEGIN UPDATE produtos_versao SET versao = versao + 1 WHERE id = 1; END
+        ''')
+
+
+MIGRACOES = [
+    (1, 'Esquema base e colunas financeiras', _m001_esquema_base),
+    (2, 'Chave normalizada de posição em estoque_saldos', _m002_chave_posicao_estoque),
+    (3, 'Totais de saldo por produto e por setor', _m003_rollups_saldo),
+    (4, 'Saldo acumulado (saldo_apos/valor_apos) em movimentacoes', _m004_saldo_apos_movimentacoes),
+    (5, 'Checkpoints mensais de saldo (saldos_fechamento_mensal)', _m005_saldos_fechamento_mensal),
+    (6, 'Índices de período em lotes e inventários', _m006_indices_periodo),
+    (7, 'Snapshots de saldo por quadro mensal + mudanças diárias', _m007_snapshots_delta),
+    (8, 'Versão do catálogo de contagem', _m008_versao_catalogo),
+    (9, 'UUID das contagens enviadas pelos tablets', _m009_uuid_contagens),
+    (10, 'Índice do histórico de contagens por local', _m010_indice_historico_local),
+    (11, 'Contador de versão dos dados do inventário', _m011_versao_dados),
+    (12, 'Totais contados por produto e por local', _m012_totais_contagem),
+    (13, 'Índice de busca de produtos (FTS5)', _m013_busca_produtos),
+    (14, 'Índice de nome dos produtos', _m014_indice_nome_produtos),
+    (15, 'Plano de fechamento do inventário', _m015_plano_fechamento),
+    (16, 'Job de fechamento do inventário', _m016_jobs_fechamento),
+    (17, 'Fila de aprovação dos lotes pendentes', _m017_fila_lotes_pendentes),
+    (18, 'Contador de versão dos produtos', _m018_versao_produtos),
+]
+
+
+def versao_esquema(db):
+    return db.execute('PRAGMA user_version').fetchone()[0]
+
+
+def aplicar_migracoes(db, logger=None):
+    """
+    Aplica as migrações pendentes, cada uma em sua própria transação.
+
+    Returns:
+        list: versões aplicadas nesta execução
+    """
+    aplicadas = []
+    for versao, descricao, migracao in MIGRACOES:
+        if versao <= versao_esquema(db):
+            continue
+
+        iniciar_transacao_imediata(db)
+        try:
+            # Outro processo pode ter aplicado enquanto aguardávamos o lock
+            if versao <= versao_esquema(db):
+                db.rollback()
+                continue
+
+            migracao(db)
+            db.execute(f'PRAGMA user_version = {int(versao)}')
+            db.execute(
+                'INSERT INTO logs_auditoria (acao, descricao, data_hora) VALUES (?, ?, ?)',
+                ('MIGRACAO_ESQUEMA', f'Migração {versao} aplicada: {descricao}', datetime.now().isoformat())
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        aplicadas.append(versao)
+        if logger:
+            logger.info(f"Migração {versao} aplicada: {descricao}")
+    return aplicadas
@@ -0,0 +1,140 @@
+"""
+Paginação por cursor (keyset) das listagens do admin.
+
+Cada listagem ordena por chaves estáveis terminadas em um id único
+(data_movimento, id / nome, id ...). Em vez de LIMIT/OFFSET, a página
+seguinte começa logo depois da última linha exibida:
+
+    WHERE (chave1, chave2) > (?, ?) ORDER BY chave1, chave2 LIMIT n + 1
+
+e o custo de qualquer página é o mesmo da primeira. Os links levam tokens
+opacos (?apos= / ?antes=) com os valores das chaves da linha de borda;
+?ultima=1 abre a última página. O total de registros vem de agregar_com_cache():
+o COUNT(*) fica guardado enquanto a versão da listagem (consulta barata,
+p. ex. MAX(id)) não mudar, por no máximo CONTAGEM_TTL_S segundos.
+"""
+import base64
+import binascii
+import json
+import threading
+import time
+
+from flask import current_app
+
+CONTAGEM_TTL_S = 300
+CONTAGEM_MAX_ENTRADAS = 256
+
+_agregados = {}
+_agregados_lock = threading.Lock()
+
+
+def codificar_cursor(valores):
+    dados = json.dumps(list(valores), separators=(',', ':'), ensure_ascii=False)
+    return base64.urlsafe_b64encode(dados.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decodificar_cursor(token, tamanho):
+    """Valores das chaves contidos no token, ou None se o token for inválido."""
+    if not token:
+        return None
+    try:
+        dados = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        valores = json.loads(dados.decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    if not isinstance(valores, list) or len(valores) != tamanho:
+        return None
+    if any(isinstance(v, (list, dict)) for v in valores):
+        return None
+    return valores
+
+
+def preparar_pagina(args, chaves, descendente=False):
+    """
+    Lê ?apos=, ?antes= ou ?ultima=1 e monta o trecho da consulta.
+
+    Args:
+        args: request.args
+        chaves: expressões SQL da ordenação; a última deve ser única (ex.: p.id)
+        descendente: ordem da listagem (todas as chaves no mesmo sentido)
+
+    Returns:
+        dict: 'where' (condição ou None), 'params', 'order_by' e o estado
+        usado por montar_pagina()
+    """
+    apos = decodificar_cursor(args.get('apos'), len(chaves))
+    antes = None if apos else decodificar_cursor(args.get('antes'), len(chaves))
+    ultima = not apos and not antes and args.get('ultima') == '1'
+
+    invertida = bool(antes) or ultima
+    sentido = 'DESC' if descendente != invertida else 'ASC'
+    comparacao = '<' if sentido == 'DESC' else '>'
+
+    where, params = None, []
+    if apos or antes:
+        where = f"({', '.join(chaves)}) {comparacao} ({', '.join('?' for _ in chaves)})"
+        params = list(apos or antes)
+
+    return {
+        'where': where,
+        'params': params,
+        'order_by': ', '.join(f'{chave} {sentido}' for chave in chaves),
+        'invertida': invertida,
+        'com_cursor': bool(apos or antes),
+        'ultima': ultima,
+    }
+
+
+def montar_pagina(pagina, linhas, por_pagina, chave_linha):
+    """
+    Recorta as linhas (buscadas com LIMIT por_pagina + 1) e gera os tokens.
+
+    Args:
+        pagina: retorno de preparar_pagina()
+        chave_linha: função linha -> valores das chaves (na ordem de `chaves`)
+
+    Returns:
+        dict: 'itens', 'apos' (token da próxima página ou None),
+        'antes' (token da anterior ou None) e 'primeira' (se é a primeira página)
+    """
+    tem_mais = len(linhas) > por_pagina
+    itens = list(linhas[:por_pagina])
+    if pagina['invertida']:
+        itens.reverse()
+
+    if pagina['invertida']:
+        ha_anterior = tem_mais
+        ha_proxima = not pagina['ultima']
+    else:
+        ha_anterior = pagina['com_cursor']
+        ha_proxima = tem_mais
+
+    return {
+        'itens': itens,
+        'apos': codificar_cursor(chave_linha(itens[-1])) if itens and ha_proxima else None,
+        'antes': codificar_cursor(chave_linha(itens[0])) if itens and ha_anterior else None,
+        'primeira': not ha_anterior,
+    }
+
+
+def agregar_com_cache(db, sql, params, sql_versao):
+    """
+    Resultado (dict) de uma consulta agregada de listagem (COUNT(*) e totais),
+    reaproveitado enquanto sql_versao (SELECT barato que muda quando os dados
+    mudam) devolver o mesmo valor e por no máximo CONTAGEM_TTL_S segundos.
+    """
+    versao = tuple(db.execute(sql_versao).fetchone())
+    chave = (current_app.config.get('DATABASE'), sql, tuple(params))
+    agora = time.monotonic()
+
+    with _agregados_lock:
+        guardado = _agregados.get(chave)
+    if guardado and guardado[1] == versao and agora - guardado[2] < CONTAGEM_TTL_S:
+        return dict(guardado[0])
+
+    resultado = dict(db.execute(sql, params).fetchone())
+    with _agregados_lock:
+        if len(_agregados) >= CONTAGEM_MAX_ENTRADAS:
+            _agregados.clear()
+        _agregados[chave] = (resultado, versao, agora)
+    return dict(resultado)
@@ -0,0 +1,215 @@
+"""
+Snapshots diários de saldo valorizado (tabela saldos_historico).
+
+O histórico é gravado por mudança: no primeiro dia gerado de cada mês
+(ou quando ainda não existe quadro anterior) grava-se um quadro COMPLETO
+com todos os produtos em estoque; nos demais dias, apenas os produtos cujo
+saldo mudou em relação ao dia anterior (quantidade 0 = saiu do estoque).
+saldos_historico_dias registra cada dia gerado e seu tipo.
+
+A posição de uma data é reconstruída por posicao_em()/valor_em(): último
+quadro COMPLETO até a data + a linha mais recente de cada produto desde ele.
+
+Na inicialização, os dias sem snapshot (do último gerado até ontem) são
+preenchidos em uma thread de background, sem atrasar a subida do servidor,
+cada dia em sua própria transação curta. Em seguida a mesma thread gera os
+checkpoints mensais pendentes (fechamento_mensal).
+"""
+import threading
+from datetime import date, datetime, timedelta
+
+from .db import conexao, iniciar_transacao_imediata
+from .fechamento_mensal import gerar_fechamentos_pendentes
+
+
+def _sql_posicao(categoria_id=None):
+    """
+    SELECT que reconstrói a posição (produto_id, quantidade, preco_custo_unitario,
+    valor_total) numa data. Parâmetros: data_ref, data_ref[, categoria_id].
+    """
+    filtro_categoria = ''
+    if categoria_id:
+        filtro_categoria = 'AND sh.produto_id IN (SELECT id_produto FROM produto_categoria_inventario WHERE id_categoria = ?)'
+    return f'''
+        SELECT produto_id, quantidade, preco_custo_unitario, valor_total
+        FROM (
+            SELECT sh.produto_id, sh.quantidade, sh.preco_custo_unitario, sh.valor_total,
+                   ROW_NUMBER() OVER (PARTITION BY sh.produto_id ORDER BY sh.data_ref DESC) AS ordem
+            FROM saldos_historico sh
+            WHERE sh.data_ref >= (
+                      SELECT MAX(data_ref) FROM saldos_historico_dias
+                      WHERE tipo = 'COMPLETO' AND data_ref <= ?
+                  )
+              AND sh.data_ref <= ?
+              {filtro_categoria}
+        )
+        WHERE ordem = 1 AND quantidade > 0
+    '''
+
+
+def _params_posicao(data_ref, categoria_id=None):
+    params = [data_ref, data_ref]
+    if categoria_id:
+        params.append(categoria_id)
+    return params
+
+
+def posicao_em(db, data_ref, categoria_id=None):
+    """
+    Posição completa (produtos com saldo > 0) registrada no snapshot de data_ref.
+
+    Returns:
+        dict: {produto_id: {'quantidade', 'preco_custo_unitario', 'valor_total'}}
+    """
+    data_ref = data_ref.isoformat() if isinstance(data_ref, date) else str(data_ref)
+    rows = db.execute(_sql_posicao(categoria_id), _params_posicao(data_ref, categoria_id)).fetchall()
+    return {
+        row['produto_id']: {
+            'quantidade': float(row['quantidade']),
+            'preco_custo_unitario': float(row['preco_custo_unitario']),
+            'valor_total': float(row['valor_total'])
+        }
+        for row in rows
+    }
+
+
+def valor_em(db, data_ref, categoria_id=None):
+    """Valor total do estoque no snapshot de data_ref (0.0 sem snapshot)."""
+    data_ref = data_ref.isoformat() if isinstance(data_ref, date) else str(data_ref)
+    row = db.execute(
+        f'SELECT COALESCE(SUM(valor_total), 0) AS valor FROM ({_sql_posicao(categoria_id)})',
+        _params_posicao(data_ref, categoria_id)
+    ).fetchone()
+    return float(row['valor'])
+
+
+def dia_gerado(db, data_ref):
+    """True se existe snapshot gerado para data_ref."""
+    data_ref = data_ref.isoformat() if isinstance(data_ref, date) else str(data_ref)
+    row = db.execute('SELECT 1 FROM saldos_historico_dias WHERE data_ref = ?', (data_ref,)).fetchone()
+    return row is not None
+
+
+def ultimo_dia_gerado(db, inicio, fim):
+    """Último dia com snapshot no intervalo [inicio, fim] (ISO) ou None."""
+    row = db.execute(
+        'SELECT MAX(data_ref) AS data_ref FROM saldos_historico_dias WHERE data_ref BETWEEN ? AND ?',
+        (inicio.isoformat(), fim.isoformat())
+    ).fetchone()
+    return row['data_ref'] if row else None
+
+
+def gerar_snapshot_dia(db, data_ref):
+    """
+    Grava o snapshot de um dia (produtos ativos com controle de estoque e saldo > 0):
+    quadro COMPLETO no primeiro dia do mês, senão só as mudanças desde o dia anterior.
+    """
+    dia = data_ref.isoformat()
+    ultimo_quadro = db.execute(
+        "SELECT MAX(data_ref) AS data_ref FROM saldos_historico_dias WHERE tipo = 'COMPLETO' AND data_ref < ?",
+        (dia,)
+    ).fetchone()['data_ref']
+    completo = data_ref.day == 1 or not ultimo_quadro or ultimo_quadro[:7] != dia[:7]
+
+    sql_atual = '''
+        SELECT r.produto_id, r.saldo AS quantidade, r.valor_total
+        FROM estoque_saldos_produto r
+        JOIN produtos p ON p.id = r.produto_id
+        WHERE p.ativo = 1 AND p.controla_estoque = 1 AND r.saldo > 0
+    '''
+    if completo:
+        cursor = db.execute(f'''
+            INSERT OR REPLACE INTO saldos_historico
+                (data_ref, produto_id, quantidade, preco_custo_unitario, valor_total)
+            SELECT ?, produto_id, quantidade, valor_total / quantidade, valor_total
+            FROM ({sql_atual})
+        ''', (dia,))
+    else:
+        anterior = (data_ref - timedelta(days=1)).isoformat()
+        cursor = db.execute(f'''
+            WITH atual AS ({sql_atual}),
+                 anterior AS ({_sql_posicao()})
+            INSERT OR REPLACE INTO saldos_historico
+                (data_ref, produto_id, quantidade, preco_custo_unitario, valor_total)
+            SELECT ?, a.produto_id, a.quantidade, a.valor_total / a.quantidade, a.valor_total
+            FROM atual a
+            LEFT JOIN anterior b ON b.produto_id = a.produto_id
+            WHERE b.produto_id IS NULL OR b.quantidade <> a.quantidade OR b.valor_total <> a.valor_total
+            UNION ALL
+            SELECT ?, b.produto_id, 0, 0, 0
+            FROM anterior b
+            WHERE NOT EXISTS (SELECT 1 FROM atual a WHERE a.produto_id = b.produto_id)
+        ''', _params_posicao(anterior) + [dia, dia])
+    inseridos = cursor.rowcount
+
+    tipo = 'COMPLETO' if completo else 'DELTA'
+    db.execute(
+        'INSERT OR REPLACE INTO saldos_historico_dias (data_ref, tipo) VALUES (?, ?)',
+        (dia, tipo)
+    )
+    db.execute(
+        'INSERT INTO logs_auditoria (acao, descricao, data_hora) VALUES (?, ?, ?)',
+        (
+            'SNAPSHOT_SALDO',
+            f"Snapshot {tipo} gerado para {dia}: {inseridos} produto(s)",
+            datetime.now().isoformat()
+        )
+    )
+    return inseridos
+
+
+def dias_pendentes(db, hoje=None):
+    """Dias sem snapshot, do dia seguinte ao último gerado até ontem (ou só ontem, se não houver nenhum)."""
+    ontem = (hoje or date.today()) - timedelta(days=1)
+    row = db.execute('SELECT MAX(data_ref) AS max_ref FROM saldos_historico_dias').fetchone()
+    max_ref = row['max_ref'] if row else None
+
+    inicio = ontem
+    if max_ref:
+        try:
+            inicio = date.fromisoformat(max_ref) + timedelta(days=1)
+        except ValueError:
+            pass
+
+    dias = []
+    dia = inicio
+    while dia <= ontem:
+        dias.append(dia)
+        dia += timedelta(days=1)
+    return dias
+
+
+def gerar_snapshots_pendentes(db, hoje=None, logger=None):
+    """
+    Preenche os dias pendentes, um commit por dia.
+
+    Returns:
+        int: quantidade de dias gerados
+    """
+    dias = dias_pendentes(db, hoje)
+    for posicao, dia in enumerate(dias, start=1):
+        iniciar_transacao_imediata(db)
+        try:
+            inseridos = gerar_snapshot_dia(db, dia)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        if logger:
+            logger.info(f"Snapshot de saldo {posicao}/{len(dias)} ({dia.isoformat()}): {inseridos} produto(s)")
+    return len(dias)
+
+
+def iniciar_geracao_snapshots(app):
+    """Dispara, em thread de background, os snapshots diários e checkpoints mensais pendentes."""
+    def _executar():
+        try:
+            with conexao(app) as db:
+                gerar_snapshots_pendentes(db, logger=app.logger)
+                gerar_fechamentos_pendentes(db)
+        except Exception:
+            app.logger.exception("Falha ao gerar snapshots de saldo pendentes")
+
+    thread = threading.Thread(target=_executar, name='snapshots_saldo', daemon=True)
+    thread.start()
+    return thread
@@ -14,6 +14,7 @@ Autor: Sistema de Estoque
 
 import os
 import shutil
+import sqlite3
 from datetime import datetime
 
 # Configurações
@@ -21,6 +22,33 @@ CAMINHO_BANCO_LOCAL = 'database/database.db'
 NOME_ARQUIVO_NUVEM = 'database.db'
 
 
+def copiar_banco_consistente(origem, destino):
+    """
+    Copia um banco SQLite usando a API de backup do próprio SQLite.
+    Com journal_mode=WAL, parte dos dados pode estar só no arquivo -wal;
+    copiar apenas o .db geraria uma cópia desatualizada ou corrompida.
+    """
+    temporario = destino + '.tmp'
+    src = sqlite3.connect(origem)
+    try:
+        dst = sqlite3.connect(temporario)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    os.replace(temporario, destino)
+
+
+def _remover_arquivos_wal(caminho_banco):
+    """Remove -wal/-shm antigos para não serem aplicados sobre o banco baixado."""
+    for sufixo in ('-wal', '-shm'):
+        arquivo = caminho_banco + sufixo
+        if os.path.exists(arquivo):
+            os.remove(arquivo)
+
+
 def exportar_para_nuvem(caminho_drive):
     """
     Exporta (copia) o banco de dados local para o Google Drive.
@@ -58,7 +86,7 @@ def exportar_para_nuvem(caminho_drive):
         # Copia o arquivo
         print(f"📋 Copiando: {CAMINHO_BANCO_LOCAL}")
         print(f"📂 Destino:  {destino}")
-        shutil.copy2(CAMINHO_BANCO_LOCAL, destino)
+        copiar_banco_consistente(CAMINHO_BANCO_LOCAL, destino)
         
         # Informações sobre o arquivo
         tamanho_mb = os.path.getsize(destino) / (1024 * 1024)
@@ -136,6 +164,7 @@ def sincronizar_do_nuvem(caminho_drive):
             
             print(f"\n📥 Baixando: {origem}")
             print(f"📂 Destino:  {os.path.abspath(CAMINHO_BANCO_LOCAL)}")
+            _remover_arquivos_wal(CAMINHO_BANCO_LOCAL)
             shutil.copy2(origem, CAMINHO_BANCO_LOCAL)
             
             tamanho_mb = os.path.getsize(CAMINHO_BANCO_LOCAL) / (1024 * 1024)
@@ -184,6 +213,7 @@ def sincronizar_do_nuvem_forcado(caminho_drive):
         
         print(f"\n📥 Baixando: {origem}")
         print(f"📂 Destino:  {os.path.abspath(CAMINHO_BANCO_LOCAL)}")
+        _remover_arquivos_wal(CAMINHO_BANCO_LOCAL)
         shutil.copy2(origem, CAMINHO_BANCO_LOCAL)
         
         tamanho_mb = os.path.getsize(CAMINHO_BANCO_LOCAL) / (1024 * 1024)
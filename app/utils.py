@@ -1,6 +1,10 @@
+import json
 import socket
 from datetime import datetime, timedelta
 
+from .configuracoes import configuracoes
+from .db import iniciar_transacao_imediata
+
 
 def format_reais(valor):
     """Formata número para padrão brasileiro 1.234,56."""
@@ -42,6 +46,31 @@ def format_datetime_br(valor):
         return valor
 
 
+def filtro_periodo(coluna, data_inicio=None, data_fim=None):
+    """
+    Filtro de período por intervalo semiaberto na própria coluna (usa índice):
+    coluna >= data_inicio AND coluna < dia seguinte a data_fim.
+    Equivale a DATE(coluna) BETWEEN data_inicio AND data_fim para datas ISO.
+
+    Returns:
+        tuple: (lista de cláusulas SQL, lista de parâmetros)
+    """
+    clausulas = []
+    params = []
+    if data_inicio:
+        clausulas.append(f'{coluna} >= ?')
+        params.append(str(data_inicio)[:10])
+    if data_fim:
+        try:
+            fim = datetime.strptime(str(data_fim)[:10], '%Y-%m-%d') + timedelta(days=1)
+        except ValueError:
+            fim = None  # data_fim inválida: filtro ignorado
+        if fim:
+            clausulas.append(f'{coluna} < ?')
+            params.append(fim.strftime('%Y-%m-%d'))
+    return clausulas, params
+
+
 def get_local_ip():
     """Retorna IP local tentando conectar a um host público."""
     try:
@@ -64,6 +93,7 @@ def registrar_movimento(db, produto_id, tipo, quantidade_original, motivo,
                        origem=None, usuario_id=None, observacao=None):
     """
     Registra uma movimentação de estoque (Kardex) e atualiza o saldo do produto.
+    Atalho para registrar_movimentos() com um único item.
     
     Args:
         db: Conexão com banco de dados
@@ -84,111 +114,328 @@ def registrar_movimento(db, produto_id, tipo, quantidade_original, motivo,
         ValueError: Se o tipo não for ENTRADA ou SAIDA
         ValueError: Se tentar dar saída maior que estoque disponível
     """
-    # Validações
     if tipo not in ['ENTRADA', 'SAIDA']:
         raise ValueError("Tipo deve ser 'ENTRADA' ou 'SAIDA'")
-    
-    if quantidade_original <= 0:
-        raise ValueError("Quantidade deve ser maior que zero")
-    
-    if fator_conversao <= 0:
-        raise ValueError("Fator de conversão deve ser maior que zero")
-    
-    # Calcular quantidade convertida para unidade padrão
-    quantidade_convertida = quantidade_original * fator_conversao
-    
-    # Buscar dados do produto
-    produto = db.execute('''
-        SELECT estoque_atual, controla_estoque, nome, id_unidade_padrao, preco_custo
-        FROM produtos 
-        WHERE id = ?
-    ''', (produto_id,)).fetchone()
-    
-    if not produto:
-        raise ValueError(f"Produto ID {produto_id} não encontrado")
-    
-    controla_estoque = int(produto['controla_estoque'])
-    preco_custo = float(produto['preco_custo'] or 0.0)
-    
-    # Se unidade_movimentacao não foi fornecida, usar a unidade padrão
-    if not unidade_movimentacao:
-        unidade_padrao = db.execute(
-            'SELECT sigla FROM unidades_medida WHERE id = ?',
-            (produto['id_unidade_padrao'],)
-        ).fetchone()
-        unidade_movimentacao = unidade_padrao['sigla'] if unidade_padrao else 'UN'
-    
-    # Verificar se permite estoque negativo (buscar da config)
-    config_negativo = db.execute(
-        "SELECT valor FROM configs WHERE chave = 'PERMITIR_ESTOQUE_NEGATIVO'"
-    ).fetchone()
-    permite_negativo = int(config_negativo['valor']) if config_negativo else 0
-
-    # Saldo atual (modo central) e custo médio vigente
-    saldo_atual = obter_saldo(db, produto_id)
-    custo_medio_atual = obter_custo_medio(db, produto_id)
-
-    # Calcular novo saldo (sempre usar quantidade convertida)
-    if tipo == 'SAIDA':
-        novo_saldo = saldo_atual - quantidade_convertida
-        if not permite_negativo and novo_saldo < 0 and controla_estoque:
-            raise ValueError(
-                f"Estoque insuficiente! Disponível: {saldo_atual:.2f}, "
-                f"Solicitado: {quantidade_convertida:.2f}"
-            )
-    else:  # ENTRADA
-        novo_saldo = saldo_atual + quantidade_convertida
-
-    # Calcular valor financeiro da movimentação usando custo informado ou custo médio
-    if tipo == 'SAIDA':
-        preco_custo_unitario = custo_medio_atual
-        valor_total = -quantidade_convertida * preco_custo_unitario
-    else:
-        preco_custo_unitario = preco_custo
-        valor_total = quantidade_convertida * preco_custo_unitario
-    
-    # 1. Inserir movimentação na tabela movimentacoes
-    cursor = db.execute('''
+
+    ids = registrar_movimentos(db, [{
+        'produto_id': produto_id,
+        'tipo': tipo,
+        'quantidade_original': quantidade_original,
+        'motivo': motivo,
+        'unidade_movimentacao': unidade_movimentacao,
+        'fator_conversao': fator_conversao,
+        'origem': origem,
+        'usuario_id': usuario_id,
+        'observacao': observacao
+    }])
+    return ids[0]
+
+
+def registrar_movimentos(db, itens, validar_estoque=True, auditar=True, permite_negativo=None):
+    """
+    Registra várias movimentações de uma vez (fechamento de inventário, lotes).
+
+    Abre a transação com BEGIN IMMEDIATE, lê todas as posições envolvidas numa
+    única consulta, calcula saldos e custos médios em memória (itens do mesmo
+    produto/posição são encadeados na ordem recebida) e grava movimentos,
+    posições (UPSERT) e auditoria com executemany. O commit fica com o chamador.
+
+    Cada item é um dict com:
+        produto_id, tipo ('ENTRADA', 'SAIDA' ou 'TRANSFERENCIA'),
+        quantidade_original, motivo
+    e, opcionalmente:
+        unidade_movimentacao, fator_conversao (1.0), origem, usuario_id, observacao,
+        custo_unitario (ENTRADA; padrão = preco_custo do produto),
+        setor_origem_id, local_origem_id, setor_destino_id, local_destino_id
+
+    TRANSFERENCIA gera SAIDA na origem + ENTRADA no destino ao custo médio da origem.
+
+    Args:
+        validar_estoque: Bloqueia saídas que deixariam saldo negativo
+        auditar: Grava uma linha MOVIMENTACAO_ESTOQUE por movimento em logs_auditoria
+        permite_negativo: Sobrepõe a config PERMITIR_ESTOQUE_NEGATIVO
+
+    Returns:
+        list: IDs das movimentações criadas (TRANSFERENCIA gera dois IDs)
+
+    Raises:
+        ValueError: Dados inválidos ou estoque insuficiente (nada é gravado)
+    """
+    # Lock de escrita antes de ler as posições: ninguém altera o saldo entre o cálculo e a gravação
+    iniciar_transacao_imediata(db)
+    plano = simular_movimentos(db, itens, validar_estoque, permite_negativo)
+    return aplicar_plano_movimentos(db, plano, auditar)
+
+
+def _carregar_produtos(db, produto_ids):
+    rows = db.execute('''
+        SELECT p.id, p.nome, p.controla_estoque, p.preco_custo, um.sigla AS unidade_padrao,
+               COALESCE(rs.saldo, 0) AS saldo_produto,
+               COALESCE(rs.valor_total, 0) AS valor_produto
+        FROM produtos p
+        LEFT JOIN unidades_medida um ON um.id = p.id_unidade_padrao
+        LEFT JOIN estoque_saldos_produto rs ON rs.produto_id = p.id
+        WHERE p.id IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(list(produto_ids)),)).fetchall()
+    return {row['id']: row for row in rows}
+
+
+def _carregar_posicoes(db, nivel, produto_ids):
+    """
+    Posições atuais dos produtos informados, indexadas por (produto_id, setor_id, local_id).
+    No modo CENTRAL a posição é o agregado do produto; 'outros_*' guarda a parte
+    que não está na linha (produto, NULL, NULL), onde os ajustes são gravados.
+    """
+    ids_json = json.dumps(list(produto_ids))
+    posicoes = {}
+
+    if nivel == 'CENTRAL':
+        # Total do produto vem do rollup; a linha (produto, NULL, NULL) pelo índice de posição
+        rows = db.execute('''
+            SELECT r.produto_id,
+                   r.saldo,
+                   r.valor_total,
+                   r.saldo - COALESCE(es.saldo, 0) AS outros_saldo,
+                   r.valor_total - COALESCE(es.valor_total, 0) AS outros_valor
+            FROM estoque_saldos_produto r
+            LEFT JOIN estoque_saldos es
+              ON es.produto_id = r.produto_id
+             AND IFNULL(es.setor_id, 0) = 0
+             AND IFNULL(es.local_id, 0) = 0
+            WHERE r.produto_id IN (SELECT value FROM json_each(?))
+        ''', (ids_json,)).fetchall()
+        for row in rows:
+            saldo = float(row['saldo'] or 0)
+            valor_total = float(row['valor_total'] or 0)
+            posicoes[(row['produto_id'], None, None)] = {
+                'saldo': saldo,
+                'valor_total': valor_total,
+                'custo_medio': (valor_total / saldo) if saldo > 0 else 0.0,
+                'outros_saldo': float(row['outros_saldo'] or 0),
+                'outros_valor': float(row['outros_valor'] or 0)
+            }
+        return posicoes
+
+    rows = db.execute('''
+        SELECT produto_id, setor_id, local_id, saldo, valor_total, custo_medio
+        FROM estoque_saldos
+        WHERE produto_id IN (SELECT value FROM json_each(?))
+    ''', (ids_json,)).fetchall()
+    for row in rows:
+        saldo = float(row['saldo'] or 0)
+        valor_total = float(row['valor_total'] or 0)
+        custo_medio = (valor_total / saldo) if saldo > 0 else 0.0
+        posicoes[(row['produto_id'], row['setor_id'], row['local_id'])] = {
+            'saldo': saldo,
+            'valor_total': valor_total,
+            'custo_medio': float(row['custo_medio'] or custo_medio),
+            'outros_saldo': 0.0,
+            'outros_valor': 0.0
+        }
+    return posicoes
+
+
+def simular_movimentos(db, itens, validar_estoque=True, permite_negativo=None):
+    """
+    Fase de cálculo de registrar_movimentos(): não grava nada.
+
+    Returns:
+        dict: {'movimentos': [...], 'posicoes': {chave: posição final}, 'iniciais': {...}}
+    """
+    nivel = obter_nivel_controle(db)
+    if permite_negativo is None:
+        config_negativo = configuracoes.config_db(db, 'PERMITIR_ESTOQUE_NEGATIVO')
+        permite_negativo = bool(int(config_negativo)) if config_negativo else False
+
+    produto_ids = {item['produto_id'] for item in itens}
+    produtos = _carregar_produtos(db, produto_ids)
+    posicoes = _carregar_posicoes(db, nivel, produto_ids)
+    iniciais = {chave: dict(pos) for chave, pos in posicoes.items()}
+    # Saldo total do produto (todas as posições), gravado em movimentacoes.saldo_apos/valor_apos
+    totais = {
+        produto_id: {'saldo': float(p['saldo_produto']), 'valor_total': float(p['valor_produto'])}
+        for produto_id, p in produtos.items()
+    }
+
+    def posicao(produto_id, setor_id, local_id):
+        if nivel == 'CENTRAL':
+            setor_id, local_id = None, None
+        elif nivel == 'SETOR':
+            local_id = None
+        chave = (produto_id, setor_id, local_id)
+        if chave not in posicoes:
+            posicoes[chave] = {
+                'saldo': 0.0, 'valor_total': 0.0, 'custo_medio': 0.0,
+                'outros_saldo': 0.0, 'outros_valor': 0.0
+            }
+        return chave, posicoes[chave]
+
+    agora = datetime.now().isoformat()
+    movimentos = []
+
+    def movimento(item, produto, tipo, qtd, custo, chave, pos, setor_origem_id, local_origem_id,
+                  setor_destino_id, local_destino_id, origem):
+        controla_estoque = int(produto['controla_estoque'] or 0)
+        saldo_antes = pos['saldo']
+        valor_antes = pos['valor_total']
+        total = totais[item['produto_id']]
+
+        if tipo == 'SAIDA':
+            novo_saldo = round(saldo_antes - qtd, 2)
+            if validar_estoque and not permite_negativo and controla_estoque and saldo_antes - qtd < 0:
+                raise ValueError(
+                    f"Estoque insuficiente para {produto['nome']}! Disponível: {saldo_antes:.2f}, "
+                    f"Solicitado: {qtd:.2f}"
+                )
+            valor_mov = -qtd * custo
+        else:
+            novo_saldo = round(saldo_antes + qtd, 2)
+            valor_mov = qtd * custo
+
+        if controla_estoque:
+            novo_valor = pos['valor_total'] + valor_mov
+            novo_custo = round((novo_valor / novo_saldo), 2) if novo_saldo > 0 else 0.0
+            if tipo == 'SAIDA' and novo_saldo <= 0:
+                novo_valor = 0.0
+                novo_custo = 0.0
+            pos['saldo'] = novo_saldo
+            pos['valor_total'] = novo_valor
+            pos['custo_medio'] = novo_custo
+            pos['alterada'] = True
+            total['saldo'] = round(total['saldo'] + novo_saldo - saldo_antes, 2)
+            total['valor_total'] += novo_valor - valor_antes
+
+        movimentos.append({
+            'produto_id': item['produto_id'],
+            'produto_nome': produto['nome'],
+            'controla_estoque': controla_estoque,
+            'tipo': tipo,
+            'motivo': item['motivo'],
+            'quantidade': qtd,
+            'unidade_movimentacao': item.get('unidade_movimentacao') or produto['unidade_padrao'] or 'UN',
+            'fator_conversao': float(item.get('fator_conversao') or 1.0),
+            'quantidade_original': float(item['quantidade_original']),
+            'preco_custo_unitario': custo,
+            'valor_total': valor_mov,
+            'setor_origem_id': setor_origem_id,
+            'local_origem_id': local_origem_id,
+            'setor_destino_id': setor_destino_id,
+            'local_destino_id': local_destino_id,
+            'data_movimento': agora,
+            'origem': origem,
+            'usuario_id': item.get('usuario_id'),
+            'observacao': item.get('observacao'),
+            'saldo_antes': saldo_antes,
+            'saldo_depois': novo_saldo,
+            'saldo_apos': total['saldo'],
+            'valor_apos': total['valor_total'],
+            'chave': chave
+        })
+
+    for item in itens:
+        tipo = item['tipo']
+        if tipo not in ['ENTRADA', 'SAIDA', 'TRANSFERENCIA']:
+            raise ValueError("Tipo deve ser 'ENTRADA', 'SAIDA' ou 'TRANSFERENCIA'")
+
+        quantidade_original = float(item['quantidade_original'] or 0)
+        fator_conversao = float(item.get('fator_conversao') or 1.0)
+        if quantidade_original <= 0:
+            raise ValueError("Quantidade deve ser maior que zero")
+        if fator_conversao <= 0:
+            raise ValueError("Fator de conversão deve ser maior que zero")
+
+        produto = produtos.get(item['produto_id'])
+        if not produto:
+            raise ValueError(f"Produto ID {item['produto_id']} não encontrado")
+
+        qtd = quantidade_original * fator_conversao
+        so, lo = item.get('setor_origem_id'), item.get('local_origem_id')
+        sd, ld = item.get('setor_destino_id'), item.get('local_destino_id')
+
+        if tipo == 'TRANSFERENCIA':
+            chave_o, pos_o = posicao(item['produto_id'], so, lo)
+            chave_d, pos_d = posicao(item['produto_id'], sd, ld)
+            custo = pos_o['custo_medio']
+            movimento(item, produto, 'SAIDA', qtd, custo, chave_o, pos_o, so, lo, None, None, item.get('origem'))
+            movimento(item, produto, 'ENTRADA', qtd, custo, chave_d, pos_d, None, None, sd, ld, item.get('origem'))
+        elif tipo == 'SAIDA':
+            chave, pos = posicao(item['produto_id'], so, lo)
+            movimento(item, produto, 'SAIDA', qtd, pos['custo_medio'], chave, pos, so, lo, sd, ld, item.get('origem'))
+        else:
+            chave, pos = posicao(item['produto_id'], sd, ld)
+            custo = item.get('custo_unitario')
+            if custo is None:
+                custo = produto['preco_custo']
+            movimento(item, produto, 'ENTRADA', qtd, float(custo or 0.0), chave, pos, so, lo, sd, ld, item.get('origem'))
+
+    return {
+        'movimentos': movimentos,
+        'posicoes': {chave: pos for chave, pos in posicoes.items() if pos.get('alterada')},
+        'iniciais': iniciais
+    }
+
+
+def aplicar_plano_movimentos(db, plano, auditar=True):
+    """Fase de gravação de registrar_movimentos(): movimentos, posições e auditoria."""
+    movimentos = plano['movimentos']
+    if not movimentos:
+        return []
+
+    db.executemany('''
         INSERT INTO movimentacoes (
-            id_produto, tipo, motivo, quantidade, 
+            id_produto, tipo, motivo, quantidade,
             unidade_movimentacao, fator_conversao_usado, quantidade_original,
             preco_custo_unitario, valor_total,
-            data_movimento, origem, id_usuario, observacao
+            setor_origem_id, local_origem_id,
+            setor_destino_id, local_destino_id,
+            data_movimento, origem, id_usuario, observacao,
+            saldo_apos, valor_apos
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (
+            m['produto_id'], m['tipo'], m['motivo'], m['quantidade'],
+            m['unidade_movimentacao'], m['fator_conversao'], m['quantidade_original'],
+            m['preco_custo_unitario'], m['valor_total'],
+            m['setor_origem_id'], m['local_origem_id'],
+            m['setor_destino_id'], m['local_destino_id'],
+            m['data_movimento'], m['origem'], m['usuario_id'], m['observacao'],
+            m['saldo_apos'], m['valor_apos']
         )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        produto_id, tipo, motivo, quantidade_convertida,
-        unidade_movimentacao, fator_conversao, quantidade_original,
-        preco_custo_unitario, valor_total,
-        datetime.now().isoformat(), origem, usuario_id, observacao
-    ))
-    
-    movimentacao_id = cursor.lastrowid
-    
-    # 2. Atualizar saldo na tabela estoque_saldos (apenas se controla_estoque = 1)
-    if controla_estoque:
-        if tipo == 'ENTRADA':
-            ajustar_saldo(db, produto_id, quantidade_convertida, 'ENTRADA', custo_unitario=preco_custo_unitario)
-        else:
-            ajustar_saldo(db, produto_id, quantidade_convertida, 'SAIDA')
-    
-    # 3. Registrar no log de auditoria
-    if fator_conversao != 1.0 or unidade_movimentacao:
-        acao_desc = f"{tipo} - {motivo}: {quantidade_original:.2f} {unidade_movimentacao} ({quantidade_convertida:.2f} un. padrão) do produto '{produto['nome']}' | Valor: R$ {valor_total:.2f}"
-    else:
-        acao_desc = f"{tipo} - {motivo}: {quantidade_convertida:.2f} un. do produto '{produto['nome']}' | Valor: R$ {valor_total:.2f}"
-    
-    if controla_estoque:
-        acao_desc += f" | Saldo: {saldo_atual:.2f} → {novo_saldo:.2f}"
+        for m in movimentos
+    ])
+    # AUTOINCREMENT dentro da mesma transação: IDs consecutivos até o último inserido
+    ultimo_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
+    ids = list(range(ultimo_id - len(movimentos) + 1, ultimo_id + 1))
+
+    # Modo CENTRAL: a linha (produto, NULL, NULL) absorve a diferença do agregado
+    db.executemany(SQL_UPSERT_POSICAO, [
+        (produto_id, setor_id, local_id,
+         pos['saldo'] - pos['outros_saldo'], pos['valor_total'] - pos['outros_valor'], pos['custo_medio'])
+        for (produto_id, setor_id, local_id), pos in plano['posicoes'].items()
+    ])
+
+    if auditar:
+        db.executemany('''
+            INSERT INTO logs_auditoria (acao, descricao, data_hora)
+            VALUES (?, ?, ?)
+        ''', [
+            ('MOVIMENTACAO_ESTOQUE', _descricao_auditoria_movimento(m), m['data_movimento'])
+            for m in movimentos
+        ])
+
+    return ids
+
+
+def _descricao_auditoria_movimento(m):
+    acao_desc = (
+        f"{m['tipo']} - {m['motivo']}: {m['quantidade_original']:.2f} {m['unidade_movimentacao']} "
+        f"({m['quantidade']:.2f} un. padrão) do produto '{m['produto_nome']}' | Valor: R$ {m['valor_total']:.2f}"
+    )
+    if m['controla_estoque']:
+        acao_desc += f" | Saldo: {m['saldo_antes']:.2f} → {m['saldo_depois']:.2f}"
     else:
         acao_desc += " | (Produto sem controle de estoque)"
-    
-    db.execute('''
-        INSERT INTO logs_auditoria (acao, descricao, data_hora)
-        VALUES (?, ?, ?)
-    ''', ('MOVIMENTACAO_ESTOQUE', acao_desc, datetime.now().isoformat()))
-    
-    return movimentacao_id
+    return acao_desc
 
 
 def obter_nivel_controle(db):
@@ -199,163 +446,124 @@ def obter_nivel_controle(db):
     Returns:
         str: 'CENTRAL', 'SETOR' ou 'LOCAL'
     """
-    from dotenv import load_dotenv
-    import os
-    
     # 1º: Tentar ler do .env (permite configurar por instalação)
-    load_dotenv()
-    nivel_env = os.getenv('NIVEL_CONTROLE_ESTOQUE', '').strip().upper()
+    nivel_env = configuracoes.env('NIVEL_CONTROLE_ESTOQUE').upper()
     
     if nivel_env in ['CENTRAL', 'SETOR', 'LOCAL']:
         return nivel_env
     
     # 2º: Fallback para banco de dados
-    config = db.execute(
-        "SELECT valor FROM configs WHERE chave = 'NIVEL_CONTROLE_ESTOQUE'"
-    ).fetchone()
+    config = configuracoes.config_db(db, 'NIVEL_CONTROLE_ESTOQUE')
     
-    return config['valor'].upper() if config else 'CENTRAL'
-
-
-def obter_saldo(db, produto_id, setor_id=None, local_id=None):
-    """Obtém o saldo disponível considerando o nível de controle."""
-    nivel = obter_nivel_controle(db)
-
-    if nivel == 'CENTRAL':
-        row = db.execute(
-            '''SELECT COALESCE(SUM(saldo), 0) AS saldo_total
-               FROM estoque_saldos
-               WHERE produto_id = ?''',
-            (produto_id,)
-        ).fetchone()
-        return float(row['saldo_total']) if row else 0.0
+    return config.upper() if config else 'CENTRAL'
 
-    if nivel == 'SETOR':
-        row = db.execute(
-            '''SELECT saldo FROM estoque_saldos
-               WHERE produto_id = ? AND setor_id = ? AND local_id IS NULL''',
-            (produto_id, setor_id)
-        ).fetchone()
-        return float(row['saldo']) if row else 0.0
-
-    if nivel == 'LOCAL':
-        row = db.execute(
-            '''SELECT saldo FROM estoque_saldos
-               WHERE produto_id = ? AND setor_id = ? AND local_id = ?''',
-            (produto_id, setor_id, local_id)
-        ).fetchone()
-        return float(row['saldo']) if row else 0.0
-
-    return 0.0
 
+def obter_saldos_posicoes(db, produto_ids, nivel=None):
+    """
+    Saldos gravados de todas as posições dos produtos informados, numa única consulta.
 
-def obter_custo_medio(db, produto_id, setor_id=None, local_id=None):
-    """Retorna custo médio atual da posição (ou 0.0 se inexistente)."""
-    posicao = _obter_posicao_estoque(db, produto_id, setor_id, local_id)
-    return posicao['custo_medio']
+    Returns:
+        dict: {(produto_id, setor_id, local_id): saldo}, com as chaves de
+        _carregar_posicoes() (CENTRAL: total do produto em (produto, None, None)).
+        Leia sempre com saldo_na_posicao().
+    """
+    if not produto_ids:
+        return {}
+    nivel = nivel or obter_nivel_controle(db)
+    return {chave: pos['saldo'] for chave, pos in _carregar_posicoes(db, nivel, produto_ids).items()}
 
 
-def _normalizar_localizacao(db, setor_id, local_id):
-    """Normaliza setor/local conforme nível configurado."""
-    nivel = obter_nivel_controle(db)
+def saldo_na_posicao(saldos, nivel, produto_id, setor_id=None, local_id=None):
+    """
+    Saldo disponível numa posição, a partir de obter_saldos_posicoes().
+    CENTRAL lê o total do produto; SETOR só a linha do setor (local NULL);
+    LOCAL sem local soma todos os locais do setor (como estoque_saldos_setor).
+    """
     if nivel == 'CENTRAL':
-        return None, None
+        return saldos.get((produto_id, None, None), 0.0)
     if nivel == 'SETOR':
-        return setor_id, None
-    return setor_id, local_id
+        return saldos.get((produto_id, setor_id, None), 0.0)
+    if setor_id is not None and local_id is None:
+        return sum(
+            saldo for (pid, sid, _), saldo in saldos.items()
+            if pid == produto_id and sid == setor_id
+        )
+    return saldos.get((produto_id, setor_id, local_id), 0.0)
 
 
-def _obter_posicao_estoque(db, produto_id, setor_id=None, local_id=None):
-    """Lê saldo, valor_total e custo_medio para a posição atual."""
-    setor_id, local_id = _normalizar_localizacao(db, setor_id, local_id)
-    nivel = obter_nivel_controle(db)
+def faltas_na_posicao(saldos, nivel, quantidades, nomes, setor_id=None, local_id=None):
+    """
+    Produtos sem saldo suficiente numa posição de origem.
 
-    if nivel == 'CENTRAL':
-        row = db.execute(
-            '''SELECT COALESCE(SUM(saldo), 0) AS saldo,
-                      COALESCE(SUM(valor_total), 0) AS valor_total
-               FROM estoque_saldos
-               WHERE produto_id = ?''',
-            (produto_id,)
-        ).fetchone()
-        saldo = float(row['saldo'] or 0)
-        valor_total = float(row['valor_total'] or 0)
-    else:
-        row = db.execute(
-            '''SELECT saldo, valor_total, custo_medio FROM estoque_saldos
-               WHERE produto_id = ? AND setor_id IS ? AND local_id IS ?''',
-            (produto_id, setor_id, local_id)
-        ).fetchone()
-        saldo = float(row['saldo'] or 0) if row else 0.0
-        valor_total = float(row['valor_total'] or 0) if row else 0.0
-
-    custo_medio = (valor_total / saldo) if saldo > 0 else 0.0
-    # Se não há linha (saldo zero), ainda retornamos custo_medio 0.0
-    if row and nivel != 'CENTRAL':
-        custo_medio = float(row['custo_medio'] or custo_medio)
+    Args:
+        saldos: ver obter_saldos_posicoes()
+        quantidades: {produto_id: quantidade na unidade padrão}, já somando
+            as linhas repetidas do mesmo produto
+        nomes: {produto_id: nome}
 
-    return {
-        'saldo': saldo,
-        'valor_total': valor_total,
-        'custo_medio': custo_medio
-    }
+    Returns:
+        list: faltas, uma por produto sem saldo suficiente, em ordem de nome:
+        {'produto_id', 'produto_nome', 'disponivel', 'solicitado', 'falta'}
+    """
+    faltas = []
+    for produto_id, solicitado in quantidades.items():
+        disponivel = float(saldo_na_posicao(saldos, nivel, produto_id, setor_id, local_id))
+        solicitado = float(solicitado)
+        if disponivel < solicitado:
+            faltas.append({
+                'produto_id': produto_id,
+                'produto_nome': nomes[produto_id],
+                'disponivel': disponivel,
+                'solicitado': solicitado,
+                'falta': solicitado - disponivel
+            })
+    return sorted(faltas, key=lambda f: f['produto_nome'])
+
+
+def validar_saldos_lote(db, quantidades, setor_id=None, local_id=None, nivel=None):
+    """
+    Confere o saldo de vários produtos numa mesma posição de origem, com uma
+    leitura de posições para todos (obter_saldos_posicoes) e as regras de
+    posição de saldo_na_posicao().
 
+    Args:
+        quantidades: {produto_id: quantidade na unidade padrão}, já somando
+            as linhas repetidas do mesmo produto
+        nivel: nível de controle (padrão: obter_nivel_controle())
 
-def ajustar_saldo(db, produto_id, quantidade_convertida, tipo,
-                  setor_id=None, local_id=None, custo_unitario=None):
-    """Atualiza saldo + valor financeiro, mantendo custo médio ponderado."""
-    setor_id, local_id = _normalizar_localizacao(db, setor_id, local_id)
-    pos = _obter_posicao_estoque(db, produto_id, setor_id, local_id)
-
-    qtd = float(quantidade_convertida or 0)
-    if qtd <= 0:
-        return
-
-    saldo_atual = pos['saldo']
-    valor_atual = pos['valor_total']
-    custo_atual = pos['custo_medio']
-
-    if tipo == 'ENTRADA':
-        custo_mov = float(custo_unitario or 0)
-        novo_valor = valor_atual + (qtd * custo_mov)
-        novo_saldo = round(saldo_atual + qtd, 2)
-        novo_custo = round((novo_valor / novo_saldo), 2) if novo_saldo > 0 else 0.0
-        _upsert_posicao(db, produto_id, setor_id, local_id, novo_saldo, novo_valor, novo_custo)
-
-    elif tipo == 'SAIDA':
-        custo_mov = custo_atual
-        valor_mov = qtd * custo_mov
-        novo_valor = valor_atual - valor_mov
-        novo_saldo = round(saldo_atual - qtd, 2)
-        novo_custo = round((novo_valor / novo_saldo), 2) if novo_saldo > 0 else 0.0
-        if novo_saldo <= 0:
-            novo_valor = 0.0
-            novo_custo = 0.0
-        _upsert_posicao(db, produto_id, setor_id, local_id, novo_saldo, novo_valor, novo_custo)
-    # TRANSFERENCIA = SAIDA + ENTRADA (tratada no chamador)
-
-
-def _upsert_posicao(db, produto_id, setor_id, local_id, saldo, valor_total, custo_medio):
-    """UPSERT na tabela estoque_saldos mantendo valor financeiro."""
-    existe = db.execute(
-        '''SELECT id FROM estoque_saldos
-           WHERE produto_id = ? AND setor_id IS ? AND local_id IS ?''',
-        (produto_id, setor_id, local_id)
-    ).fetchone()
-
-    if existe:
-        db.execute(
-            '''UPDATE estoque_saldos
-               SET saldo = ?, valor_total = ?, custo_medio = ?
-               WHERE produto_id = ? AND setor_id IS ? AND local_id IS ?''',
-            (saldo, valor_total, custo_medio, produto_id, setor_id, local_id)
-        )
-    else:
-        db.execute(
-            '''INSERT INTO estoque_saldos (produto_id, setor_id, local_id, saldo, valor_total, custo_medio)
-               VALUES (?, ?, ?, ?, ?, ?)''',
-            (produto_id, setor_id, local_id, saldo, valor_total, custo_medio)
-        )
+    Returns:
+        list: faltas (ver faltas_na_posicao)
+    """
+    if not quantidades:
+        return []
+    nivel = nivel or obter_nivel_controle(db)
+
+    nomes = {
+        row['id']: row['nome']
+        for row in db.execute(
+            'SELECT id, nome FROM produtos WHERE id IN (SELECT value FROM json_each(?))',
+            (json.dumps(list(quantidades)),)
+        ).fetchall()
+    }
+    saldos = obter_saldos_posicoes(db, nomes, nivel)
+    return faltas_na_posicao(
+        saldos, nivel,
+        {produto_id: qtd for produto_id, qtd in quantidades.items() if produto_id in nomes},
+        nomes, setor_id, local_id
+    )
+
+
+# Chave de posição normalizada (NULL -> 0): usa o índice único idx_estoque_saldos_posicao.
+# Sem RETURNING: aplicar_plano_movimentos grava saldos já calculados pelo plano, com
+# o lock de escrita (BEGIN IMMEDIATE) tomado antes da leitura das posições.
+SQL_UPSERT_POSICAO = '''
+    INSERT INTO estoque_saldos (produto_id, setor_id, local_id, saldo, valor_total, custo_medio)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (produto_id, IFNULL(setor_id, 0), IFNULL(local_id, 0)) DO UPDATE SET
+        saldo = excluded.saldo,
+        valor_total = excluded.valor_total,
+        custo_medio = excluded.custo_medio
+'''
 
 
 def validar_localizacao(db, tipo, setor_origem_id=None, local_origem_id=None,
@@ -421,23 +629,17 @@ def obter_requer_aprovacao(db):
     Returns:
         int: 0 (não requer/direto) ou 1 (requer aprovação)
     """
-    from dotenv import load_dotenv
-    import os
-    
     # 1º: Tentar ler do .env (permite configurar por instalação)
-    load_dotenv()
-    requer_env = os.getenv('REQUER_APROVACAO_MOVIMENTACAO', '').strip()
+    requer_env = configuracoes.env('REQUER_APROVACAO_MOVIMENTACAO')
     
     if requer_env in ['0', '1']:
         return int(requer_env)
     
     # 2º: Fallback para banco de dados
-    config = db.execute(
-        "SELECT valor FROM configs WHERE chave = 'REQUER_APROVACAO_MOVIMENTACAO'"
-    ).fetchone()
+    config = configuracoes.config_db(db, 'REQUER_APROVACAO_MOVIMENTACAO')
     
     if config:
-        return int(config['valor'])
+        return int(config)
     
     # 3º: Default = 1 (requer aprovação por segurança)
     return 1
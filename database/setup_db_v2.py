@@ -18,7 +18,13 @@ from datetime import datetime, date
 DB_PATH = os.path.join(os.path.dirname(__file__), 'database.db')
 
 
-def criar_tabelas(conn):
+def criar_tabelas(conn, commit=True):
+    """
+    Cria tabelas, índices e views (IF NOT EXISTS).
+
+    Com commit=False deixa a transação aberta para quem chamou: a migração
+    001 grava o esquema junto com o PRAGMA user_version.
+    """
     cursor = conn.cursor()
     
     print("\n📋 Criando tabelas básicas ...")
@@ -560,7 +566,8 @@ def criar_tabelas(conn):
         GROUP BY l.id
     ''')
     
-    conn.commit()
+    if commit:
+        conn.commit()
     print("\n✅ Todas as tabelas foram criadas com sucesso!")
 
 
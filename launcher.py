@@ -11,7 +11,7 @@ from threading import Timer
 from dotenv import load_dotenv
 from app import create_app  # Importa a factory
 from config import Config
-from app.sync_drive import exportar_para_nuvem, sincronizar_do_nuvem, sincronizar_do_nuvem_forcado
+from app.sync_drive import exportar_para_nuvem, sincronizar_do_nuvem, sincronizar_do_nuvem_forcado, copiar_banco_consistente
 
 # Carrega variáveis de ambiente do arquivo .env
 load_dotenv()
@@ -33,7 +33,7 @@ def fazer_backup():
     backup_file = os.path.join(backup_dir, f"padaria_{timestamp}.db")
     
     try:
-        shutil.copy2(db_file, backup_file)
+        copiar_banco_consistente(db_file, backup_file)
         print(f"✅ Backup realizado com sucesso: {backup_file}")
         
         # Limpeza: Mantém apenas os últimos 5 backups para não lotar o disco
@@ -0,0 +1,239 @@
+"""
+Benchmark: caminho original item a item x registrar_movimentos (em lote).
+
+Cria um banco temporário com o esquema atual (app/migracoes.py), cadastra
+N produtos com saldo e simula os ajustes de um fechamento de inventário
+(metade entradas, metade saídas) por três caminhos, para separar os ganhos:
+
+1. original: registrar_movimento() como era antes do motor em lote (modo
+   CENTRAL). Para cada movimento lê produto, unidade, configs, saldo e custo
+   médio, insere o movimento, faz o read-modify-write da posição (SELECT +
+   UPDATE/INSERT) e a auditoria; obter_nivel_controle() era chamado 6 vezes
+   por movimento e relia o .env (load_dotenv) a cada chamada.
+2. item a item com configurações em cache: o mesmo caminho, com o nível lido
+   de configuracoes (cache do .env e da tabela configs).
+3. registrar_movimentos(): motor em lote.
+
+(1 -> 2) é o ganho do cache de configurações; (2 -> 3) o do motor em lote.
+Em SQLite local, com a transação única que os dois últimos caminhos já usam,
+quase todo o tempo do caminho original é a releitura do .env: o motor em
+lote, sozinho, tem ganho pequeno. registrar_movimento() hoje delega ao motor
+em lote, então o caminho original fica reproduzido aqui.
+
+Uso:
+    python tools/benchmark_movimentos.py [--produtos 5000] [--sem-original]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from app.migracoes import aplicar_migracoes  # noqa: E402
+from app.utils import obter_nivel_controle, registrar_movimentos  # noqa: E402
+
+
+def preparar_banco(caminho, total_produtos):
+    conn = sqlite3.connect(caminho)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    with contextlib.redirect_stdout(io.StringIO()):
+        aplicar_migracoes(conn)
+    conn.execute("INSERT INTO unidades_medida (sigla, nome) VALUES ('UN', 'Unidade')")
+    conn.executemany(
+        'INSERT INTO produtos (id, nome, id_unidade_padrao, preco_custo) VALUES (?, ?, 1, ?)',
+        [(i, f'Produto {i}', 1.0 + (i % 50)) for i in range(1, total_produtos + 1)]
+    )
+    conn.executemany(
+        'INSERT INTO estoque_saldos (produto_id, saldo, valor_total, custo_medio) VALUES (?, 100, ?, ?)',
+        [(i, 100 * (1.0 + (i % 50)), 1.0 + (i % 50)) for i in range(1, total_produtos + 1)]
+    )
+    conn.commit()
+    return conn
+
+
+def ajustes(total_produtos):
+    return [
+        {
+            'produto_id': i,
+            'tipo': 'ENTRADA' if i % 2 else 'SAIDA',
+            'quantidade_original': 3.0,
+            'motivo': 'AJUSTE_INVENTARIO',
+            'unidade_movimentacao': 'UN',
+            'origem': 'Benchmark',
+            'observacao': 'Benchmark'
+        }
+        for i in range(1, total_produtos + 1)
+    ]
+
+
+def medir(titulo, total_produtos, executar):
+    with tempfile.TemporaryDirectory() as pasta:
+        conn = preparar_banco(os.path.join(pasta, 'bench.db'), total_produtos)
+        itens = ajustes(total_produtos)
+        inicio = time.perf_counter()
+        executar(conn, itens)
+        conn.commit()
+        duracao = time.perf_counter() - inicio
+        conn.close()
+    print(f"{titulo:<40} {duracao:8.3f} s")
+    return duracao
+
+
+# --- Caminho anterior (antes de registrar_movimentos), modo CENTRAL ---
+
+def nivel_original(conn):
+    """obter_nivel_controle() original: relê o .env a cada chamada."""
+    load_dotenv()
+    nivel_env = os.getenv('NIVEL_CONTROLE_ESTOQUE', '').strip().upper()
+    if nivel_env in ['CENTRAL', 'SETOR', 'LOCAL']:
+        return nivel_env
+    row = conn.execute("SELECT valor FROM configs WHERE chave = 'NIVEL_CONTROLE_ESTOQUE'").fetchone()
+    return row['valor'].upper() if row else 'CENTRAL'
+
+
+def _posicao_legado(conn, produto_id):
+    row = conn.execute(
+        '''SELECT COALESCE(SUM(saldo), 0) AS saldo,
+                  COALESCE(SUM(valor_total), 0) AS valor_total
+           FROM estoque_saldos
+           WHERE produto_id = ?''',
+        (produto_id,)
+    ).fetchone()
+    saldo = float(row['saldo'] or 0)
+    valor_total = float(row['valor_total'] or 0)
+    return saldo, valor_total, (valor_total / saldo) if saldo > 0 else 0.0
+
+
+def _upsert_posicao_legado(conn, produto_id, saldo, valor_total, custo_medio):
+    existe = conn.execute(
+        'SELECT id FROM estoque_saldos WHERE produto_id = ? AND setor_id IS NULL AND local_id IS NULL',
+        (produto_id,)
+    ).fetchone()
+    if existe:
+        conn.execute(
+            '''UPDATE estoque_saldos SET saldo = ?, valor_total = ?, custo_medio = ?
+               WHERE produto_id = ? AND setor_id IS NULL AND local_id IS NULL''',
+            (saldo, valor_total, custo_medio, produto_id)
+        )
+    else:
+        conn.execute(
+            '''INSERT INTO estoque_saldos (produto_id, setor_id, local_id, saldo, valor_total, custo_medio)
+               VALUES (?, NULL, NULL, ?, ?, ?)''',
+            (produto_id, saldo, valor_total, custo_medio)
+        )
+
+
+def _ajustar_saldo_legado(conn, nivel, produto_id, qtd, tipo, custo_unitario=None):
+    nivel(conn)  # _normalizar_localizacao
+    nivel(conn), nivel(conn)  # _obter_posicao_estoque: _normalizar_localizacao + nível
+    saldo, valor, custo = _posicao_legado(conn, produto_id)
+    if tipo == 'ENTRADA':
+        novo_valor = valor + qtd * float(custo_unitario or 0)
+        novo_saldo = round(saldo + qtd, 2)
+        novo_custo = round(novo_valor / novo_saldo, 2) if novo_saldo > 0 else 0.0
+    else:
+        novo_valor = valor - qtd * custo
+        novo_saldo = round(saldo - qtd, 2)
+        novo_custo = round(novo_valor / novo_saldo, 2) if novo_saldo > 0 else 0.0
+        if novo_saldo <= 0:
+            novo_valor, novo_custo = 0.0, 0.0
+    _upsert_posicao_legado(conn, produto_id, novo_saldo, novo_valor, novo_custo)
+
+
+def registrar_movimento_legado(conn, item, nivel):
+    """Um movimento pelo caminho anterior: ~12 comandos SQL e 6 leituras do nível por item."""
+    qtd = float(item['quantidade_original'])
+    produto = conn.execute(
+        'SELECT controla_estoque, nome, id_unidade_padrao, preco_custo FROM produtos WHERE id = ?',
+        (item['produto_id'],)
+    ).fetchone()
+    conn.execute('SELECT sigla FROM unidades_medida WHERE id = ?', (produto['id_unidade_padrao'],)).fetchone()
+    conn.execute("SELECT valor FROM configs WHERE chave = 'PERMITIR_ESTOQUE_NEGATIVO'").fetchone()
+
+    nivel(conn)
+    saldo_atual, _, _ = _posicao_legado(conn, item['produto_id'])   # obter_saldo
+    nivel(conn), nivel(conn)
+    _, _, custo_medio = _posicao_legado(conn, item['produto_id'])   # obter_custo_medio
+    if item['tipo'] == 'SAIDA':
+        custo = custo_medio
+        valor_total = -qtd * custo
+        novo_saldo = saldo_atual - qtd
+    else:
+        custo = float(produto['preco_custo'] or 0)
+        valor_total = qtd * custo
+        novo_saldo = saldo_atual + qtd
+
+    conn.execute('''
+        INSERT INTO movimentacoes (
+            id_produto, tipo, motivo, quantidade,
+            unidade_movimentacao, fator_conversao_usado, quantidade_original,
+            preco_custo_unitario, valor_total,
+            data_movimento, origem, id_usuario, observacao
+        )
+        VALUES (?, ?, ?, ?, ?, 1.0, ?, ?, ?, ?, ?, NULL, ?)
+    ''', (
+        item['produto_id'], item['tipo'], item['motivo'], qtd,
+        item['unidade_movimentacao'], qtd, custo, valor_total,
+        datetime.now().isoformat(), item['origem'], item['observacao']
+    ))
+
+    if produto['controla_estoque']:
+        _ajustar_saldo_legado(conn, nivel, item['produto_id'], qtd, item['tipo'], custo_unitario=custo)
+
+    conn.execute(
+        'INSERT INTO logs_auditoria (acao, descricao, data_hora) VALUES (?, ?, ?)',
+        ('MOVIMENTACAO_ESTOQUE',
+         f"{item['tipo']} - {item['motivo']}: {qtd:.2f} do produto '{produto['nome']}' | "
+         f"Saldo: {saldo_atual:.2f} → {novo_saldo:.2f}",
+         datetime.now().isoformat())
+    )
+
+
+def original(conn, itens):
+    for item in itens:
+        registrar_movimento_legado(conn, item, nivel_original)
+
+
+def item_a_item_em_cache(conn, itens):
+    for item in itens:
+        registrar_movimento_legado(conn, item, obter_nivel_controle)
+
+
+def em_lote(conn, itens):
+    registrar_movimentos(conn, itens)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--produtos', type=int, default=5000)
+    parser.add_argument('--sem-original', action='store_true',
+                        help='não mede o caminho original (lento: relê o .env a cada movimento)')
+    args = parser.parse_args()
+
+    print(f"\n📊 Ajustes de fechamento para {args.produtos} produtos\n")
+    t_original = None if args.sem_original else medir('original (relê o .env)', args.produtos, original)
+    t_cache = medir('item a item, configurações em cache', args.produtos, item_a_item_em_cache)
+    t_lote = medir('registrar_movimentos (em lote)', args.produtos, em_lote)
+
+    print()
+    if t_original is not None:
+        print(f"⚡ Cache de configurações:  {t_original / t_cache:6.1f}x")
+    print(f"⚡ Motor em lote:           {t_cache / t_lote:6.1f}x")
+    if t_original is not None:
+        print(f"⚡ Total sobre o original:  {t_original / t_lote:6.1f}x")
+    print()
+
+
+if __name__ == '__main__':
+    main()
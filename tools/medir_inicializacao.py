@@ -0,0 +1,118 @@
+"""
+Mede o tempo de inicialização (import de app + create_app) e verifica o orçamento.
+
+Roda a inicialização em um processo separado com `python -X importtime`,
+sobre um banco temporário já migrado (a primeira execução cria o banco e é
+descartada), e:
+
+- falha se create_app passar do orçamento (ORCAMENTO_MS);
+- falha se alguma dependência pesada (PESADAS) for importada na thread
+  principal durante a inicialização; elas devem ser importadas dentro das
+  rotas e jobs que as usam;
+- lista os módulos de topo que mais pesam no import.
+
+Uso:
+    python tools/medir_inicializacao.py [--orcamento 800] [--top 10]
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Orçamento de create_app (import do pacote app incluído), com banco já
+# migrado. Medido em desenvolvimento: ~350 ms; margem para máquinas de loja.
+ORCAMENTO_MS = 800
+
+# Só podem ser importadas sob demanda (rotas de importação/exportação, QR code, jobs)
+PESADAS = ['pandas', 'numpy', 'openpyxl', 'qrcode', 'PIL', 'apscheduler']
+
+SCRIPT = r'''
+import json, os, sys, threading, time
+sys.path.insert(0, {raiz!r})
+os.chdir({raiz!r})
+
+pesadas = set({pesadas!r})
+na_thread_principal = []
+
+def _auditar(evento, args):
+    if evento == 'import' and threading.current_thread() is threading.main_thread():
+        raiz = args[0].split('.')[0]
+        if raiz in pesadas and raiz not in na_thread_principal:
+            na_thread_principal.append(raiz)
+
+sys.addaudithook(_auditar)
+
+class Config:
+    SECRET_KEY = 'medir-inicializacao'
+    DATABASE = {banco!r}
+    UPLOAD_FOLDER = {uploads!r}
+
+inicio = time.perf_counter()
+from app import create_app
+create_app(Config)
+decorrido = (time.perf_counter() - inicio) * 1000
+print(json.dumps({{'ms': decorrido, 'pesadas': na_thread_principal}}))
+'''
+
+RE_IMPORTTIME = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def executar(banco, uploads):
+    codigo = SCRIPT.format(raiz=RAIZ, pesadas=PESADAS, banco=banco, uploads=uploads)
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', codigo],
+        capture_output=True, text=True, cwd=RAIZ
+    )
+    if proc.returncode != 0:
+        print(proc.stderr)
+        sys.exit(f"Falha ao iniciar o app (código {proc.returncode})")
+    resultado = json.loads(proc.stdout.strip().splitlines()[-1])
+
+    imports = []
+    for linha in proc.stderr.splitlines():
+        m = RE_IMPORTTIME.match(linha)
+        if m and len(m.group(3)) <= 3:  # módulos de topo e seus imports diretos
+            imports.append((int(m.group(2)) / 1000, m.group(4)))
+    imports.sort(reverse=True)
+    return resultado, imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orcamento', type=float, default=ORCAMENTO_MS, help='Orçamento de create_app em ms')
+    parser.add_argument('--top', type=int, default=10, help='Quantidade de imports listados')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as pasta:
+        banco = os.path.join(pasta, 'inicializacao.db')
+        uploads = os.path.join(pasta, 'uploads')
+        executar(banco, uploads)  # cria e migra o banco
+        resultado, imports = executar(banco, uploads)
+
+    print(f"\n⏱️  create_app: {resultado['ms']:.0f} ms (orçamento {args.orcamento:.0f} ms)\n")
+    print("Imports mais pesados (acumulado):")
+    for ms, nome in imports[:args.top]:
+        print(f"  {ms:8.1f} ms  {nome}")
+
+    falhas = []
+    if resultado['ms'] > args.orcamento:
+        falhas.append(f"create_app levou {resultado['ms']:.0f} ms, acima do orçamento de {args.orcamento:.0f} ms")
+    for nome in resultado['pesadas']:
+        falhas.append(f"'{nome}' importado na thread principal durante a inicialização")
+
+    if falhas:
+        print()
+        for falha in falhas:
+            print(f"✗ {falha}")
+        print("\n❌ Inicialização fora do orçamento\n")
+        sys.exit(1)
+    print("\n✅ Inicialização dentro do orçamento, sem dependências pesadas\n")
+
+
+if __name__ == '__main__':
+    main()
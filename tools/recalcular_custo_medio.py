@@ -14,6 +14,13 @@ def garantir_colunas(conn):
     if "custo_medio" not in cols:
         cur.execute("ALTER TABLE estoque_saldos ADD COLUMN custo_medio REAL NOT NULL DEFAULT 0.0")
         altered = True
+    cols_mov = {row[1] for row in cur.execute("PRAGMA table_info(movimentacoes)")}
+    if "saldo_apos" not in cols_mov:
+        cur.execute("ALTER TABLE movimentacoes ADD COLUMN saldo_apos REAL")
+        altered = True
+    if "valor_apos" not in cols_mov:
+        cur.execute("ALTER TABLE movimentacoes ADD COLUMN valor_apos REAL")
+        altered = True
     if altered:
         conn.commit()
 
@@ -85,6 +92,20 @@ def upsert_posicao(conn, produto_id, setor_id, local_id, saldo, valor_total, cus
         )
 
 
+def gravar_saldo_apos(conn, mov_id, produto_id):
+    """Grava na movimentação o saldo total do produto (todas as posições) após ela."""
+    cur = conn.cursor()
+    saldo, valor_total = cur.execute(
+        """SELECT COALESCE(SUM(saldo),0), COALESCE(SUM(valor_total),0)
+               FROM estoque_saldos WHERE produto_id=?""",
+        (produto_id,)
+    ).fetchone()
+    cur.execute(
+        "UPDATE movimentacoes SET saldo_apos=?, valor_apos=? WHERE id=?",
+        (round(float(saldo or 0), 2), float(valor_total or 0), mov_id)
+    )
+
+
 def reprocessar_movimentacoes(conn):
     nivel = obter_nivel_controle(conn)
     cur = conn.cursor()
@@ -152,6 +173,8 @@ def reprocessar_movimentacoes(conn):
             # Tipo inesperado
             pass
 
+        gravar_saldo_apos(conn, m[0], m[1])
+
         if idx % 1000 == 0:
             conn.commit()
             print(f"Processadas {idx}/{total} movimentações...")
@@ -160,12 +183,24 @@ def reprocessar_movimentacoes(conn):
     print(f"Reprocessamento concluído: {total} movimentações.")
 
 
+def descartar_checkpoints(conn):
+    """Checkpoints mensais dependem de saldo_apos; são refeitos na próxima inicialização do sistema."""
+    cur = conn.cursor()
+    existe = cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'saldos_fechamento_mensal'"
+    ).fetchone()
+    if existe:
+        cur.execute("DELETE FROM saldos_fechamento_mensal")
+        conn.commit()
+
+
 def main():
     print(f"Início: {datetime.now().isoformat()}")
     conn = sqlite3.connect(DB_PATH)
     garantir_colunas(conn)
     zerar_saldos(conn)
     reprocessar_movimentacoes(conn)
+    descartar_checkpoints(conn)
     print(f"Fim: {datetime.now().isoformat()}")
 
 
@@ -0,0 +1,271 @@
+"""
+Verificação de planos de consulta (EXPLAIN QUERY PLAN) das telas mais usadas.
+
+Cria um banco temporário com o esquema atual (app/migracoes.py), popula
+com volume realista (produtos, movimentações espalhadas no tempo, lotes,
+inventários), acessa cada tela com filtros típicos pelo test client do
+Flask e roda EXPLAIN QUERY PLAN em cada SELECT executado.
+
+Falha (código de saída 1) se alguma consulta fizer SCAN de uma tabela
+grande, isto é, leitura completa em vez de busca por índice. Um SCAN só é
+aceito em listagens paginadas: ORDER BY ... LIMIT em que a ordem é a do
+próprio índice percorrido (ou do rowid, para ORDER BY id) e o plano não
+ordena à parte (USE TEMP B-TREE FOR ORDER BY). Só assim a leitura para
+no limite em vez de percorrer a tabela inteira.
+
+Uso:
+    python tools/verificar_planos_consulta.py [--produtos 2000] [--movimentos 40000]
+"""
+import argparse
+import contextlib
+import io
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from app.migracoes import aplicar_migracoes  # noqa: E402
+from app.paginacao import codificar_cursor  # noqa: E402
+from app.utils import registrar_movimentos  # noqa: E402
+
+# Tabelas que crescem com o uso: nunca devem ser lidas por inteiro numa tela
+TABELAS_GRANDES = {
+    'movimentacoes', 'lotes_movimentacao', 'lotes_movimentacao_itens',
+    'contagens', 'inventarios', 'logs_auditoria', 'saldos_historico',
+    'saldos_fechamento_mensal', 'estoque_saldos',
+    'contagens_totais_produto', 'contagens_totais_local', 'fechamento_plano',
+}
+
+PERIODO = 'data_inicio=2024-06-01&data_fim=2024-06-30'
+
+# (descrição, URL) — telas e filtros mais usados
+CENARIOS = [
+    ('Movimentações por período', f'/admin/movimentacoes?{PERIODO}'),
+    ('Movimentações de um produto por período', f'/admin/movimentacoes?produto_id=7&{PERIODO}'),
+    ('Kardex do produto', '/admin/produto_kardex/7'),
+    ('Kardex do produto por período', f'/admin/produto_kardex/7?{PERIODO}'),
+    ('Exportação de lotes por período', f'/admin/lotes/exportar?status=APROVADO&{PERIODO}'),
+    ('Relatório CMV', f'/relatorios/cmv?{PERIODO}'),
+    ('Relatório CMV (JSON)', f'/relatorios/cmv.json?{PERIODO}'),
+    ('Posição do estoque em uma data', '/api/estoque/em?data=2024-06-15'),
+    ('Posição de uma categoria em um instante', '/api/estoque/em?data=2024-06-15T14:30&categoria_id=1'),
+    ('Dashboard do inventário aberto', '/admin/dashboard'),
+    ('Monitoramento do inventário', '/admin/monitoramento'),
+    ('Monitoramento de um setor', '/admin/monitoramento/setor/1'),
+    ('Contagens de um produto no inventário', '/admin/monitoramento/produto/7'),
+    ('Busca de produtos', '/api/produtos/buscar?q=produto%207'),
+    ('Estoque atual com busca', '/admin/estoque_atual?busca=ERP7'),
+    ('Movimentações, página seguinte', f"/admin/movimentacoes?{PERIODO}&apos={codificar_cursor(['2024-06-15 12:00:00', 8000])}"),
+    ('Movimentações, última página', f'/admin/movimentacoes?{PERIODO}&ultima=1'),
+    ('Produtos, página seguinte', f"/admin/produtos?apos={codificar_cursor(['Produto 500', 500])}"),
+    ('Preview do fechamento', '/admin/preview_fechamento'),
+    ('Lotes pendentes de aprovação', '/admin/lotes/pendentes'),
+]
+
+RE_TABELA = re.compile(
+    r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(?!ON\b|WHERE\b|LEFT\b|JOIN\b|INNER\b|CROSS\b|GROUP\b|ORDER\b|LIMIT\b)(\w+))?',
+    re.IGNORECASE
+)
+
+
+def popular_banco(caminho, total_produtos, total_movimentos):
+    conn = sqlite3.connect(caminho)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode = WAL')
+    with contextlib.redirect_stdout(io.StringIO()):
+        aplicar_migracoes(conn)
+
+    conn.execute("INSERT INTO unidades_medida (sigla, nome) VALUES ('UN', 'Unidade')")
+    conn.execute("INSERT INTO usuarios (nome, funcao) VALUES ('Gerente', 'Gerente')")
+    conn.execute("INSERT INTO categorias_inventario (nome) VALUES ('Geral')")
+    conn.executemany(
+        'INSERT INTO produtos (id, nome, id_erp, id_unidade_padrao, preco_custo) VALUES (?, ?, ?, 1, ?)',
+        [(i, f'Produto {i}', f'ERP{i}', 1.0 + (i % 50)) for i in range(1, total_produtos + 1)]
+    )
+    conn.executemany(
+        'INSERT INTO produto_categoria_inventario (id_produto, id_categoria) VALUES (?, 1)',
+        [(i,) for i in range(1, total_produtos + 1, 3)]
+    )
+    conn.commit()
+
+    # Movimentações em lotes de 5000, depois espalhadas de jan/2024 em diante (30 min entre cada)
+    lote = 5000
+    for inicio in range(0, total_movimentos, lote):
+        registrar_movimentos(conn, [
+            {
+                'produto_id': 1 + (n * 7919) % total_produtos,
+                'tipo': 'ENTRADA' if n % 3 else 'SAIDA',
+                'quantidade_original': 1 + n % 5,
+                'motivo': 'AJUSTE',
+                'custo_unitario': 2.0
+            }
+            for n in range(inicio, min(inicio + lote, total_movimentos))
+        ], auditar=False, permite_negativo=True)
+        conn.commit()
+    conn.execute("UPDATE movimentacoes SET data_movimento = datetime('2024-01-01', '+' || (id * 30) || ' minutes')")
+
+    total_lotes = max(total_movimentos // 10, 1)
+    conn.executemany('''
+        INSERT INTO lotes_movimentacao (tipo, motivo, status, id_usuario, data_criacao)
+        VALUES ('ENTRADA', 'COMPRA', ?, 1, datetime('2024-01-01', '+' || ? || ' hours'))
+    ''', [('APROVADO' if n % 4 else ('PENDENTE_APROVACAO' if n % 8 else 'RASCUNHO'), n * 3)
+          for n in range(total_lotes)])
+
+    conn.executemany('''
+        INSERT INTO inventarios (data_criacao, status, descricao)
+        VALUES (date('2024-01-01', '+' || ? || ' days'), 'Fechado', 'Inventário')
+    ''', [(n * 3,) for n in range(200)])
+
+    # Inventário aberto com contagens em 2 setores x 10 locais (3 por produto)
+    conn.executemany('INSERT INTO setores (id, nome) VALUES (?, ?)', [(s, f'Setor {s}') for s in (1, 2)])
+    conn.executemany(
+        'INSERT INTO locais (id, nome, id_setor) VALUES (?, ?, ?)',
+        [(n, f'Local {n}', 1 + n % 2) for n in range(1, 21)]
+    )
+    inv_aberto = conn.execute(
+        "INSERT INTO inventarios (data_criacao, status, descricao) VALUES ('2024-07-01', 'Aberto', 'Aberto')"
+    ).lastrowid
+    conn.executemany('''
+        INSERT INTO contagens
+            (id_inventario, id_local, id_produto, quantidade, id_unidade_usada, id_usuario, data_hora,
+             fator_conversao, quantidade_padrao, preco_custo_snapshot, unidade_padrao_sigla)
+        VALUES (?, ?, ?, 1, 1, 1, '2024-07-01 10:00:00', 1, 1, 1, 'UN')
+    ''', [(inv_aberto, 1 + n % 20, 1 + n % total_produtos) for n in range(total_produtos * 3)])
+    conn.commit()
+    conn.close()
+
+
+def mapa_aliases(sql):
+    aliases = {}
+    for tabela, alias in RE_TABELA.findall(sql):
+        aliases[tabela.lower()] = tabela.lower()
+        if alias:
+            aliases[alias.lower()] = tabela.lower()
+    return aliases
+
+
+RE_ORDER_LIMIT = re.compile(r'\bORDER BY\s+(.+?)\s+LIMIT\b', re.IGNORECASE | re.DOTALL)
+
+
+def ordenacoes_com_limit(sql):
+    """Colunas (sem alias nem direção) de cada ORDER BY seguido de LIMIT."""
+    ordenacoes = []
+    for clausula in RE_ORDER_LIMIT.findall(sql):
+        colunas = []
+        for termo in clausula.split(','):
+            termo = re.sub(r'\s+(ASC|DESC|COLLATE\s+\w+)\b', '', termo.strip(), flags=re.IGNORECASE)
+            colunas.append(termo.split('.')[-1].strip().lower())
+        ordenacoes.append(colunas)
+    return ordenacoes
+
+
+def ordem_do_indice(conn, indice):
+    """Colunas do índice na ordem em que ele é percorrido (termina no rowid)."""
+    colunas = [row[2] and row[2].lower() for row in conn.execute(f'PRAGMA index_info({indice})')]
+    return colunas + ['id']
+
+
+def problemas_do_plano(conn, sql):
+    """Linhas do plano que leem uma tabela grande por inteiro."""
+    plano = conn.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall()
+    aliases = mapa_aliases(sql)
+    # Com ordenação à parte, o LIMIT só corta depois de ler e ordenar tudo
+    ordena_a_parte = any('TEMP B-TREE' in linha[3] and 'ORDER BY' in linha[3] for linha in plano)
+    ordenacoes = [] if ordena_a_parte else ordenacoes_com_limit(sql)
+    problemas = []
+    for linha in plano:
+        detalhe = linha[3]
+        m = re.match(r'SCAN (\w+)(?: USING (?:COVERING )?INDEX (\w+))?', detalhe)
+        if not m:
+            continue
+        tabela = aliases.get(m.group(1).lower(), m.group(1).lower())
+        if tabela not in TABELAS_GRANDES:
+            continue
+        # Percorre o índice (ou o rowid) já na ordem pedida e para no LIMIT
+        ordem = ordem_do_indice(conn, m.group(2)) if m.group(2) else ['id']
+        if detalhe == m.group(0) and any(cols == ordem[:len(cols)] for cols in ordenacoes):
+            continue
+        problemas.append(detalhe)
+    return problemas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--produtos', type=int, default=2000)
+    parser.add_argument('--movimentos', type=int, default=40000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as pasta:
+        caminho = os.path.join(pasta, 'planos.db')
+        popular_banco(caminho, args.produtos, args.movimentos)
+
+        from flask import g
+        from app import create_app
+        from app.db import get_db, fechar_conexoes
+
+        class Config:
+            SECRET_KEY = 'verificar-planos'
+            DATABASE = caminho
+            TESTING = True
+            UPLOAD_FOLDER = os.path.join(pasta, 'uploads')
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            app = create_app(Config)
+
+        capturadas = []
+
+        @app.before_request
+        def _rastrear_consultas():
+            get_db().set_trace_callback(capturadas.append)
+
+        @app.teardown_request
+        def _parar_rastreio(exc=None):
+            if 'db' in g:
+                g.db.set_trace_callback(None)
+
+        cliente = app.test_client()
+        with cliente.session_transaction() as sessao:
+            sessao['is_gerente'] = True
+            sessao['user_id'] = 1
+            sessao['funcao'] = 'Gerente'
+
+        analise = sqlite3.connect(caminho)
+        falhas = 0
+        print(f"\n🔎 Planos de consulta ({args.produtos} produtos, {args.movimentos} movimentações)\n")
+        for descricao, url in CENARIOS:
+            capturadas.clear()
+            resposta = cliente.get(url)
+            if resposta.status_code != 200:
+                print(f"✗ {descricao}: HTTP {resposta.status_code}")
+                falhas += 1
+                continue
+
+            consultas = [s for s in capturadas if re.match(r'\s*(SELECT|WITH)\b', s, re.IGNORECASE)]
+            problemas = []
+            for sql in consultas:
+                for detalhe in problemas_do_plano(analise, sql):
+                    problemas.append((detalhe, ' '.join(sql.split())[:160]))
+
+            if problemas:
+                falhas += 1
+                print(f"✗ {descricao} ({len(consultas)} consultas)")
+                for detalhe, trecho in problemas:
+                    print(f"    {detalhe}\n      ↳ {trecho}")
+            else:
+                print(f"✓ {descricao} ({len(consultas)} consultas)")
+
+        analise.close()
+        fechar_conexoes(app)
+
+    if falhas:
+        print(f"\n❌ {falhas} cenário(s) com leitura completa de tabela grande\n")
+        sys.exit(1)
+    print("\n✅ Nenhuma leitura completa de tabela grande\n")
+
+
+if __name__ == '__main__':
+    main()